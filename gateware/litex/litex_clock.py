@@ -35,7 +35,6 @@ def compute_config_log(logger, config):
 # Lattice / iCE40 ----------------------------------------------------------------------------------
 
 # TODO:
-# - add phase support.
 # - add support for GENCLK_HALF to be able to generate clock down to 8MHz.
 
 class iCE40PLL_90deg(Module):
@@ -85,40 +84,46 @@ class iCE40PLL_90deg(Module):
         self.nclkouts += 1
 
     def create_clkout_90(self, cd, freq, margin=1e-2):
+        # Port B of the shift register, same frequency as port A.
+        assert self.nclkouts == 1, "create_clkout first"
+        (_, main_freq, _, _) = self.clkouts[0]
+        assert abs(freq - main_freq) <= main_freq*margin
         clkout = Signal()
-        #self.clkouts[self.nclkouts] = (clkout, freq, 0, margin)
         self.comb += cd.clk.eq(clkout)
+        create_clkout_log(self.logger, cd.name + " (90deg)", freq, margin, self.nclkouts)
 
         self.clkout_90 = clkout
 
     def compute_config(self):
-        config = {}
+        # PHASE_AND_DELAY feedback is taken after DIVQ, so the output runs
+        # at pfd*(divf + 1) and DIVQ only scales the VCO into range.
+        (clk, f, p, m) = self.clkouts[0]
+        (vco_freq_min, vco_freq_max) = self.vco_freq_range
+        best = None
         for divr in range(*self.divr_range):
+            pfd_freq = self.clkin_freq/(divr + 1)
+            if pfd_freq < 10e6 or pfd_freq > 133e6:
+                continue
             for divf in range(*self.divf_range):
-                all_valid = True
-                vco_freq = self.clkin_freq/(divr + 1)*(divf +  1)
-                (vco_freq_min, vco_freq_max) = self.vco_freq_range
-                if vco_freq >= vco_freq_min and vco_freq <= vco_freq_max:
-                    for n, (clk, f, p, m) in sorted(self.clkouts.items()):
-                        valid = False
-                        for divq in range(*self.divq_range):
-                            clk_freq = vco_freq/(2**divq)
-                            if abs(clk_freq - f) <= f*m:
-                                config["clkout_freq"] = clk_freq
-                                config["divq"]        = divq
-                                valid = True
-                                break
-                        if not valid:
-                            all_valid = False
-                else:
-                    all_valid = False
-                if all_valid:
-                    config["vco"] = vco_freq
-                    config["divr"] = divr
-                    config["divf"] = divf
-                    compute_config_log(self.logger, config)
-                    return config
-        raise ValueError("No PLL config found")
+                clk_freq = pfd_freq*(divf + 1)
+                if abs(clk_freq - f) > f*m:
+                    continue
+                for divq in range(1, self.divq_range[1]):
+                    vco_freq = clk_freq*(2**divq)
+                    if vco_freq < vco_freq_min or vco_freq > vco_freq_max:
+                        continue
+                    if best is None or abs(clk_freq - f) < abs(best["clkout_freq"] - f):
+                        best = {
+                            "clkout_freq": clk_freq,
+                            "vco":         vco_freq,
+                            "divr":        divr,
+                            "divf":        divf,
+                            "divq":        divq,
+                        }
+        if best is None:
+            raise ValueError("No PLL config found")
+        compute_config_log(self.logger, best)
+        return best
 
     def do_finalize(self):
         config = self.compute_config()
@@ -139,8 +144,7 @@ class iCE40PLL_90deg(Module):
             p_PLLOUT_SELECT_PORTA = "SHIFTREG_0deg",
             p_PLLOUT_SELECT_PORTB = "SHIFTREG_90deg",
 
-            #p_FILTER_RANGE  = filter_range,
-            p_FILTER_RANGE  = 1,
+            p_FILTER_RANGE  = filter_range,
             i_RESETB        = ~self.reset,
             o_LOCK          = self.locked,
         )
@@ -150,13 +154,12 @@ class iCE40PLL_90deg(Module):
         if self.primitive == "SB_PLL40_PAD":
             self.params.update(i_PACKAGEPIN=self.clkin)
 
-        # lmao big hack
         if self.primitive == "SB_PLL40_2F_PAD":
             self.params.update(i_PACKAGEPIN = self.clkin)
         for n, (clk, f, p, m) in sorted(self.clkouts.items()):
-            self.params["p_DIVR"]         = 1 #config["divr"]
-            self.params["p_DIVF"]         = 2 #config["divf"]
-            self.params["p_DIVQ"]         = 4 #config["divq"]
+            self.params["p_DIVR"]         = config["divr"]
+            self.params["p_DIVF"]         = config["divf"]
+            self.params["p_DIVQ"]         = config["divq"]
             self.params["o_PLLOUTGLOBALA"] = clk
 
         self.params["o_PLLOUTGLOBALB"] = self.clkout_90
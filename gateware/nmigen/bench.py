@@ -0,0 +1,130 @@
+"""
+Runs the benchmark firmware (irom/bench.s) on each CPU core in the cxxrtl
+simulation, and tabulates the cycle counts it reports over the UART
+against the LUT and EBR cost of the board build.
+
+    python bench.py
+    python bench.py --cores serv --no-area --json bench.json
+
+Simulation models and board builds are cached, so only changed cores are
+rebuilt.
+"""
+
+import os
+import subprocess
+
+from cpu import CPUS
+
+BENCH_IMAGE = os.path.join("irom", "bench.bin")
+BENCHMARKS = ["memcpy", "crc32", "dhry"]
+
+# Gives a UART divisor of 16 in the simulation, enough to sample each bit
+# in the middle while only polling the line every few cycles.
+SIM_CLK = 1.8432
+MAX_CYCLES = 20000000
+
+
+def read_uart(sim, divisor, max_cycles, until="done\r\n"):
+    """ Decodes 8N1 from the ``uart_tx`` wire of CartSim until ``until``
+    was received. The line is polled every quarter bit, the model runs in
+    C in between. """
+    step = max(divisor // 4, 1)
+    out = bytearray()
+    while not out.endswith(until.encode()):
+        if sim.cycle >= max_cycles:
+            raise TimeoutError("no {!r} after {} cycles, got {!r}".format(until, max_cycles, bytes(out)))
+        sim.run(step, stimulus=())
+        if sim.peek("uart_tx"):
+            continue
+
+        # Somewhere in the start bit, move to the middle of bit 0.
+        sim.run(divisor + divisor // 2 - step // 2, stimulus=())
+        byte = 0
+        for bit in range(8):
+            byte |= sim.peek("uart_tx") << bit
+            sim.run(divisor, stimulus=())
+        out.append(byte)
+    return out.decode()
+
+
+def parse_results(text):
+    """ ``name cycles`` lines, cycles in hex. """
+    results = {}
+    for line in text.splitlines():
+        name, _, cycles = line.partition(" ")
+        if name in BENCHMARKS:
+            results[name] = int(cycles, 16)
+    return results
+
+
+def run_core(cpu, max_cycles=MAX_CYCLES):
+    from sim_cxxrtl import build, CxxrtlSim
+
+    os.makedirs(os.path.join("build", "bench"), exist_ok=True)
+    lib = build(sim_v=os.path.join("build", "bench", "cart-sim-{}.v".format(cpu)),
+        sys_clk=SIM_CLK, cpu=cpu, firmware=BENCH_IMAGE)
+
+    with CxxrtlSim(lib) as sim:
+        # Reset, see sim_cxxrtl.DEFAULT_STIMULUS.
+        sim.run(20)
+        text = read_uart(sim, int(SIM_CLK * 1e6 // 115200), max_cycles)
+    return parse_results(text)
+
+
+def area(cpu, sys_clk=50):
+    """ LUTs, EBRs and Fmax of the board build with ``cpu``. """
+    from build_cache import cached_build
+    from n64_board import N64Platform
+    from sweep import NEXTPNR_OPTS, parse_nextpnr_log
+    from top import CartConcretePLL
+
+    platform = N64Platform()
+    concrete = CartConcretePLL(sys_clk=sys_clk, uart_baud=115200, uart_delay=10000, cpu=cpu)
+    products = cached_build(platform, concrete, read_verilog_opts="-I../serv/rtl",
+        nextpnr_opts=NEXTPNR_OPTS)
+
+    log = parse_nextpnr_log(products.get("top.tim", "t"))
+    return dict(
+        luts=log["util"].get("ICESTORM_LC", (0, 0))[0],
+        ebr=log["util"].get("ICESTORM_RAM", (0, 0))[0],
+        fmax=log["fmax"])
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cores", nargs="+", choices=sorted(CPUS), default=sorted(CPUS, reverse=True))
+    parser.add_argument("--no-area", action="store_true", help="skip the board builds")
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES)
+    parser.add_argument("--json", default=None)
+    args = parser.parse_args()
+
+    subprocess.check_call(["make", "-C", "irom", "bench.bin"])
+
+    rows = []
+    for cpu in args.cores:
+        row = dict(cpu=cpu, cycles=run_core(cpu, args.max_cycles))
+        if not args.no_area:
+            row.update(area(cpu))
+        rows.append(row)
+
+    print("{:10s} {:>6s} {:>4s} {:>8s}".format("core", "LUTs", "EBR", "fmax") +
+        "".join(" {:>10s}".format(b) for b in BENCHMARKS))
+    for row in rows:
+        print("{:10s} {:>6} {:>4} {:>8}".format(row["cpu"], row.get("luts", "-"), row.get("ebr", "-"),
+                "{:.2f}".format(row["fmax"]) if "fmax" in row else "-") +
+            "".join(" {:>10}".format(row["cycles"].get(b, "-")) for b in BENCHMARKS))
+
+    # Relative to the first core: speedup per benchmark and LUT cost.
+    base = rows[0]
+    for row in rows[1:]:
+        speedups = ", ".join("{} {:.1f}x".format(b, base["cycles"][b] / row["cycles"][b])
+            for b in BENCHMARKS if b in row["cycles"] and b in base["cycles"])
+        cost = " for {:.1f}x the LUTs".format(row["luts"] / base["luts"]) if "luts" in row and base.get("luts") else ""
+        print("{} vs {}: {}{}".format(row["cpu"], base["cpu"], speedups, cost))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
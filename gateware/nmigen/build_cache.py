@@ -0,0 +1,95 @@
+"""
+Content-addressed cache for generated Verilog and bitstreams.
+
+The key is a hash of the elaborated RTLIL (with ``src`` attributes
+stripped, so moving code around doesn't count as a change) and the
+toolchain options, so editing tooling or comments doesn't rerun yosys or
+nextpnr. The irom image is part of the RTLIL as memory init, unless the
+design was built with placeholder ROMs (firmware.py), in which case
+firmware changes don't invalidate the bitstream at all.
+"""
+
+import hashlib
+import os
+import re
+
+from nmigen.build.run import LocalBuildProducts
+
+CACHE_DIR = os.path.join("build", "cache")
+
+_src_attr = re.compile(r"^\s*attribute \\src .*$\n?", re.MULTILINE)
+
+
+def _update(hasher, name, content):
+    if isinstance(content, str):
+        if name.endswith(".il"):
+            content = _src_attr.sub("", content)
+        content = content.encode()
+    hasher.update(name.encode())
+    hasher.update(content)
+
+
+def _write_if_changed(path, text):
+    """ Keep the mtime of ``path`` if nothing changed, so make doesn't
+    rebuild whatever depends on it. """
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == text:
+                return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def cached_verilog(make_top, name="top", path=None):
+    """
+    Verilog for ``make_top()``, only running yosys if the design changed.
+
+    ``make_top`` is called once to hash the RTLIL and, on a miss, once more
+    to convert, since an elaboratable should only be elaborated once. If
+    ``path`` is given, the Verilog is also written there (only when it
+    changed).
+    """
+    from nmigen.back import rtlil, verilog
+
+    top = make_top()
+    hasher = hashlib.sha256()
+    _update(hasher, name + ".il", rtlil.convert(top, name=name, ports=top.ports()))
+    cached = os.path.join(CACHE_DIR, hasher.hexdigest()[:16] + ".v")
+
+    if os.path.exists(cached):
+        with open(cached) as f:
+            text = f.read()
+    else:
+        top = make_top()
+        text = verilog.convert(top, name=name, ports=top.ports())
+        _write_if_changed(cached, text)
+
+    if path is not None:
+        _write_if_changed(path, text)
+    return text
+
+
+def cached_build(platform, elaboratable, name="top", do_program=False, program_opts=None, **kwargs):
+    """
+    Drop-in for ``platform.build()``. Synthesis and place-and-route only
+    run if no earlier build had the same inputs; products for each input
+    hash live in ``build/cache/<hash>/``.
+    """
+    plan = platform.prepare(elaboratable, name, **kwargs)
+
+    hasher = hashlib.sha256()
+    for filename in sorted(plan.files):
+        _update(hasher, filename, plan.files[filename])
+    root = os.path.join(CACHE_DIR, hasher.hexdigest()[:16])
+
+    if os.path.exists(os.path.join(root, name + ".bin")):
+        print("build cache hit: {}".format(root))
+        products = LocalBuildProducts(root)
+    else:
+        products = plan.execute_local(root)
+
+    if do_program:
+        platform.toolchain_program(products, name, **(program_opts or {}))
+    return products
@@ -1,54 +1,309 @@
+import math
 import os
 import struct
 
 from nmigen import *
-from misc import EdgeDetector
+from wb import WishboneBus
+from save import SaveMemory, SAVE_NONE, SAVE_WORDS
+from sdram import BURST_WORDS
+from simtest import sim_test
+
+# PI timings count in RCP clocks.
+RCP_CLK_MHZ = 62.5
+# Domain 1 read pulse width boot code programs from the ROM header.
+PI_PWD_DEFAULT = 0x12
+# Estimates: ad setup to the rising /RD edge the console samples on, and
+# the pad input plus clock to output delays of the iCE40.
+PI_SETUP_NS = 10
+PI_PAD_NS = 8
+
+# The header word boot code reads the domain 1 timings from, as two
+# halves: 0x80 and RLS/PGS, then PWD and LAT.
+PI_HEADER_ADDR = 0x10000000
+
+# Byte orders of ROM dumps, as in their file extensions: big endian like
+# the console, 16 bit words swapped, 32 bit words swapped.
+BYTE_ORDER_Z64 = 0
+BYTE_ORDER_V64 = 1
+BYTE_ORDER_N64 = 2
+
+# First 16 bits of each dump, the 0x80371240 header magic as stored.
+BYTE_ORDER_MAGIC = {
+    0x8037: BYTE_ORDER_Z64,
+    0x3780: BYTE_ORDER_V64,
+    0x4012: BYTE_ORDER_N64,
+}
+
+# Register offsets.
+CART_BYTE_ORDER = 0x0
+CART_HEADER = 0x4
+CART_SAVE_TYPE = 0x8
+# Bit 0: a save write was dropped, see SaveMemory. Writing clears it.
+CART_SAVE_STATUS = 0xc
+
+# Largest ROM in bytes. The top of SDRAM holds the calibration pattern
+# (see sdram_cal.py) and the save area, which a 64MB ROM would overlap.
+ROM_MAX_BYTES = 2 * (2 ** 25 - SAVE_WORDS - BURST_WORDS)
+
+
+def pi_budget_ns(pwd=PI_PWD_DEFAULT):
+    """ Time from /RD falling until ad has to be valid. """
+    return (pwd + 1) * 1e3 / RCP_CLK_MHZ - PI_SETUP_NS
+
+
+def pi_latency_ns(sys_clk, sync_stages=1, ddr=False):
+    """
+    Worst case from /RD falling until ad is driven, ``sys_clk`` in MHz.
+    The pad samples up to a clock later, half a clock with ``ddr``, then
+    come the synchronizer stages, the ``ad_o`` register and the output
+    register of the pad.
+    """
+    period = 1e3 / sys_clk
+    cycles = (0.5 if ddr else 1) + sync_stages + 1 + 1
+    return cycles * period + PI_PAD_NS
+
+
+def pi_fast_timing(sys_clk, sync_stages=1, ddr=False):
+    """
+    Shortest ``(pwd, rls)`` the cart keeps up with at ``sys_clk`` MHz,
+    encoded like the header, RCP clocks minus one. /RD has to be high for
+    a sample and one more clock, so the front end sees every edge.
+    """
+    rcp = 1e3 / RCP_CLK_MHZ
+    pwd = math.ceil((pi_latency_ns(sys_clk, sync_stages, ddr) + PI_SETUP_NS) / rcp) - 1
+    rls = math.ceil(2 * 1e3 / sys_clk / rcp) - 1
+    if rls > 3:
+        raise ValueError("No release time the PI can program is long enough at {} MHz".format(sys_clk))
+    return pwd, rls
+
+
+class PIFrontEnd(Elaboratable):
+    """
+        Brings the PI strobes into the sync domain and finds their edges.
+
+        ``sync_stages`` registers follow the input register of the pad and
+        edges are decoded combinationally from the last one, so a strobe
+        is acted on ``sync_stages`` clocks after the pad sampled it. With
+        ``ddr`` the strobes are sampled on both clock edges, earlier
+        sample in bit 0, which halves the wait for the first sample. The
+        platform registers DDR inputs once more, that counts as the first
+        stage.
+
+        ``ad_i`` goes through the same number of stages, so it stays
+        aligned with ``ale_l`` and ``ale_h``. ``write_rise`` is the end of
+        a write pulse.
+    """
+    def __init__(self, n64, sync_stages=1, ddr=False):
+        if ddr and sync_stages < 1:
+            raise ValueError("DDR inputs take at least one synchronizer stage")
+        self.n64 = n64
+        self.sync_stages = sync_stages
+        self.ddr = ddr
+
+        self.ad_i = Signal(16)
+        self.read = Signal()
+        self.read_fall = Signal()
+        self.write = Signal()
+        self.write_fall = Signal()
+        self.write_rise = Signal()
+        self.ale_l = Signal()
+        self.ale_l_fall = Signal()
+        self.ale_h = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        def synchronize(value, stages):
+            for i in range(stages):
+                stage = Signal.like(value)
+                m.d.sync += stage.eq(value)
+                value = stage
+            return value
+
+        m.d.comb += self.ad_i.eq(synchronize(self.n64.ad_i, self.sync_stages))
+
+        stages = self.sync_stages - self.ddr
+        for name in ["read", "write", "ale_l", "ale_h"]:
+            samples = synchronize(getattr(self.n64, name), stages)
+            level = getattr(self, name)
+            last = Signal()
+            m.d.comb += level.eq(samples[-1])
+            m.d.sync += last.eq(level)
+            if hasattr(self, name + "_fall"):
+                m.d.comb += getattr(self, name + "_fall").eq(last & ~samples.all())
+            if hasattr(self, name + "_rise"):
+                m.d.comb += getattr(self, name + "_rise").eq(~last & level)
+
+        return m
+
 
 class Cart(Elaboratable):
-    def __init__(self, sys_clk):
+    """
+        PI side of the cartridge.
+
+        Reads are answered with ``rom_data``, the 16 bits stored at
+        ``rom_addr``, in the order they are in the dump.
+
+        ``byte_order`` says how the dump is stored, reads are put in the
+        console's order on the way to ``ad_o``. Writing the first 16 bits
+        of a dump to ``CART_HEADER`` when it is loaded sets it from the
+        header magic, anything else leaves it alone. ``CART_BYTE_ORDER``
+        reads it and can be written to override it.
+
+        Elaboration fails if reads can't be answered within the pulse
+        width ``pi_pwd`` programs, see ``pi_latency_ns``. ``None`` skips
+        the check.
+
+        With ``fast_pi``, the PWD and RLS fields of the header word are
+        replaced by ``pi_fast_timing`` as they are read, so the console
+        runs all later cartridge reads at the fastest timing the cart
+        keeps up with. The image itself is left alone.
+
+        Only the ROM in domain 1 and, with ``save``, the save memory in
+        domain 2 answer reads. ``CART_SAVE_TYPE`` picks the kind of save
+        memory, ``SAVE_NONE`` until it is written. Save reads go through
+        ``rom_addr`` and ``rom_data`` as well, at ``save.sdram_addr`` in
+        words, unless ``save`` has the data itself. Only ROMs up to
+        ``ROM_MAX_BYTES`` fit next to the save area.
+    """
+    def __init__(self, sys_clk, sync_stages=1, ddr=False, pi_pwd=PI_PWD_DEFAULT, fast_pi=False,
+                 save=False):
+        samples = 2 if ddr else 1
         self.n64 = Record([
             ("ad_i", 16),
             ("ad_o", 16),
             ("ad_oe", 1),
-            ("read", 1),
-            ("write", 1),
-            ("ale_l", 1),
-            ("ale_h", 1)
+            ("read", samples),
+            ("write", samples),
+            ("ale_l", samples),
+            ("ale_h", samples)
             ])
 
         self.sys_clk = sys_clk * 1e6
+        self.front_end = PIFrontEnd(self.n64, sync_stages, ddr)
+        self.latency_ns = pi_latency_ns(sys_clk, sync_stages, ddr)
+        self.budget_ns = None if pi_pwd is None else pi_budget_ns(pi_pwd)
+        self.fast_timing = pi_fast_timing(sys_clk, sync_stages, ddr) if fast_pi else None
+
+        self.addr = Signal(32)
+        self.rom_addr = Signal(32)
+        self.rom_data = Signal(16)
+
+        self.bus = WishboneBus()
+        self.byte_order = Signal(2)
+        self.save_type = Signal(2)
+        self.save = SaveMemory() if save else None
+
+        # Pulses when the N64 latches a new address.
+        self.access = Signal()
+        # Pulses when a read is answered with ``rom_data``.
+        self.rom_read = Signal()
 
     def elaborate(self, platform):
+        if self.budget_ns is not None and self.latency_ns > self.budget_ns:
+            raise ValueError("PI reads take {:.1f} ns at {} MHz, the budget is {:.1f} ns".format(
+                self.latency_ns, self.sys_clk / 1e6, self.budget_ns))
+
         m = Module()
 
         timer = Signal(23)
         m.d.sync += timer.eq(timer+1)
 
-        addr = Signal(32)
-        m.submodules.read_edge = read_edge = EdgeDetector(self.n64.read)
-        m.submodules.ale_l_edge = ale_l_edge = EdgeDetector(self.n64.ale_l)
+        addr = self.addr
+        m.submodules.front_end = pi = self.front_end
+
+        # Domain 1 ROM at 0x10000000, domain 2 from 0x08000000.
+        rom_select = addr[28:] == 1
+        save_select = Signal()
+        if self.save is not None:
+            m.d.comb += save_select.eq((addr[27:] == 1) & (self.save_type != SAVE_NONE))
+
+        # n64 dumps have the halves of each word swapped as well.
+        n64_order = self.byte_order == BYTE_ORDER_N64
+        m.d.comb += self.rom_addr.eq(Cat(addr[0], addr[1] ^ n64_order, addr[2:]))
+
+        normalized = Signal(16)
+        with m.If(self.byte_order == BYTE_ORDER_Z64):
+            m.d.comb += normalized.eq(self.rom_data)
+        with m.Else():
+            m.d.comb += normalized.eq(Cat(self.rom_data[8:], self.rom_data[:8]))
+
+        data = Signal(16)
+        m.d.comb += data.eq(normalized)
+        if self.fast_timing is not None:
+            pwd, rls = self.fast_timing
+            with m.If(addr == PI_HEADER_ADDR):
+                m.d.comb += data.eq(Cat(normalized[:4], Const(rls, 2), normalized[6:]))
+            with m.Elif(addr == PI_HEADER_ADDR + 2):
+                m.d.comb += data.eq(Cat(normalized[:8], Const(pwd, 8)))
+
+        # The last data the console drove before the end of /WR.
+        w_data = Signal(16)
+        with m.If(~pi.write):
+            m.d.sync += w_data.eq(pi.ad_i)
+
+        if self.save is not None:
+            m.submodules.save = save = self.save
+            m.d.comb += [
+                save.save_type.eq(self.save_type),
+                save.addr.eq(addr),
+                save.start.eq(pi.ale_l_fall),
+                save.read.eq(pi.read_fall & save_select),
+                save.write.eq(pi.write_rise & save_select),
+                save.w_data.eq(w_data),
+            ]
+            # Saves are stored the way the console wrote them.
+            with m.If(save_select):
+                m.d.comb += self.rom_addr.eq(Cat(Const(0, 1), save.sdram_addr))
+                m.d.comb += data.eq(Mux(save.hit, save.data, self.rom_data))
 
         # Read from memory whenever address changes.
-        with m.If(self.n64.ale_l):
-            with m.If(self.n64.ale_h):
-                m.d.sync += addr[16:32].eq(self.n64.ad_i)
+        with m.If(pi.ale_l):
+            with m.If(pi.ale_h):
+                m.d.sync += addr[16:32].eq(pi.ad_i)
             with m.Else():
-                m.d.sync += addr[0:16].eq(self.n64.ad_i)
+                m.d.sync += addr[0:16].eq(pi.ad_i)
 
-        with m.If(ale_l_edge.fall):
-            # TODO possible optimization: check if addr is in the right range.
-            m.d.sync += [
-                
-            ]
+        m.d.comb += self.access.eq(pi.ale_l_fall)
+        from_rom = rom_select
+        if self.save is not None:
+            from_rom = rom_select | (save_select & ~self.save.hit)
+        m.d.comb += self.rom_read.eq(pi.read_fall & from_rom)
 
-        with m.If(read_edge.fall):
-            m.d.sync += self.n64.ad_oe.eq(1)
-            # TODO data
-            m.d.sync += self.n64.ad_o.eq(0)
+        # The console samples ad as /RD rises, so it is held until then.
+        with m.If(pi.read_fall):
+            m.d.sync += self.n64.ad_oe.eq(rom_select | save_select)
+            m.d.sync += self.n64.ad_o.eq(data)
             m.d.sync += addr.eq(addr+2)
-        with m.Else():
+        with m.Elif(pi.read):
             m.d.sync += self.n64.ad_oe.eq(0)
 
+        with m.If(pi.write_rise):
+            m.d.sync += addr.eq(addr+2)
+
+        bus = self.bus
+        with m.If(bus.cyc & ~bus.ack):
+            with m.Switch(bus.addr[:4]):
+                with m.Case(CART_BYTE_ORDER):
+                    m.d.sync += bus.r_dat.eq(self.byte_order)
+                    with m.If(bus.we):
+                        m.d.sync += self.byte_order.eq(bus.w_dat)
+                with m.Case(CART_HEADER):
+                    with m.If(bus.we):
+                        with m.Switch(bus.w_dat[:16]):
+                            for magic, order in BYTE_ORDER_MAGIC.items():
+                                with m.Case(magic):
+                                    m.d.sync += self.byte_order.eq(order)
+                with m.Case(CART_SAVE_TYPE):
+                    m.d.sync += bus.r_dat.eq(self.save_type)
+                    with m.If(bus.we):
+                        m.d.sync += self.save_type.eq(bus.w_dat)
+                if self.save is not None:
+                    with m.Case(CART_SAVE_STATUS):
+                        m.d.sync += bus.r_dat.eq(self.save.overflow)
+                        m.d.comb += self.save.clear.eq(bus.we)
+        m.d.sync += bus.ack.eq(bus.cyc & ~bus.ack)
+
         return m
 
     def ports(self):
@@ -60,4 +315,195 @@ class Cart(Elaboratable):
             self.n64.write,
             self.n64.ale_l,
             self.n64.ale_h,
-        ]
\ No newline at end of file
+        ]
+
+
+def pi_address(cart, addr):
+    """ Simulation process latching ``addr`` like the console does. """
+    n64 = cart.n64
+    high = (1 << len(n64.read)) - 1
+    yield n64.read.eq(high)
+    yield n64.write.eq(high)
+    yield n64.ale_h.eq(high)
+    yield n64.ale_l.eq(high)
+    yield n64.ad_i.eq(addr >> 16)
+    for _ in range(4):
+        yield
+    yield n64.ale_h.eq(0)
+    yield n64.ad_i.eq(addr & 0xffff)
+    for _ in range(4):
+        yield
+    yield n64.ale_l.eq(0)
+    for _ in range(4):
+        yield
+
+
+def pi_read(cart, addr, count, rom, pace=8):
+    """ Simulation process reading ``count`` halves from ``addr`` like the
+    console does, ``rom`` maps ``cart.rom_addr`` to ``cart.rom_data``.
+    /RD is low for ``pace`` clocks and ad is sampled as it rises. """
+    n64 = cart.n64
+    yield from pi_address(cart, addr)
+
+    words = []
+    for _ in range(count):
+        yield cart.rom_data.eq(rom((yield cart.rom_addr)))
+        yield n64.read.eq(0)
+        for _ in range(pace):
+            yield
+        assert (yield n64.ad_oe), "ad not driven as /RD rises"
+        words.append((yield n64.ad_o))
+        yield n64.read.eq((1 << len(n64.read)) - 1)
+        for _ in range(4):
+            yield
+    return words
+
+
+def pi_write(cart, addr, halves, pace=4):
+    """ Simulation process writing ``halves`` from ``addr`` like the
+    console does, with /WR low and high for ``pace`` clocks each. """
+    n64 = cart.n64
+    idle = (1 << len(n64.write)) - 1
+    yield from pi_address(cart, addr)
+
+    for half in halves:
+        yield n64.ad_i.eq(half)
+        yield n64.write.eq(0)
+        for _ in range(pace):
+            yield
+        yield n64.write.eq(idle)
+        for _ in range(pace):
+            yield
+
+
+def bus_access(cart, addr, we=0, data=0):
+    """ Simulation process accessing the register at ``addr`` through
+    ``cart.bus``. Returns what it reads. """
+    bus = cart.bus
+    yield bus.addr.eq(addr)
+    yield bus.we.eq(we)
+    yield bus.w_dat.eq(data)
+    yield bus.cyc.eq(1)
+    yield
+    while not (yield bus.ack):
+        yield
+    result = yield bus.r_dat
+    yield bus.cyc.eq(0)
+    yield
+    return result
+
+
+@sim_test(sync_stages=[0, 1, 2], ddr=[False, True])
+def sim_pi_latency(sync_stages, ddr):
+    """ Clocks from the pad sampling /RD low to ad_oe match
+    ``pi_latency_ns``. """
+    from nmigen.back.pysim import Simulator
+
+    if ddr and sync_stages == 0:
+        try:
+            Cart(50, sync_stages, ddr)
+        except ValueError:
+            return
+        assert False, "no stage for the DDR register"
+
+    sys_clk = 50
+    cart = Cart(sys_clk, sync_stages, ddr)
+    n64 = cart.n64
+    idle = (1 << len(n64.read)) - 1
+
+    def proc():
+        yield from pi_address(cart, PI_HEADER_ADDR)
+        assert not (yield n64.ad_oe)
+
+        # Only the falling edge sample is low, DDR sees it early.
+        yield n64.read.eq(0b01 if ddr else 0)
+        cycles = 0
+        while not (yield n64.ad_oe):
+            yield
+            cycles += 1
+            if cycles == 1:
+                yield n64.read.eq(0)
+        # pi_latency_ns after the wait for a sample, less the DDR input
+        # register, which is in the pad and counts as a stage. The output
+        # register of the pad isn't here either, but the process sees
+        # registers update a clock late.
+        wait = 0.5 if ddr else 1
+        clocks = (pi_latency_ns(sys_clk, sync_stages, ddr) - PI_PAD_NS) * sys_clk / 1e3 - wait
+        assert cycles == round(clocks) - ddr, (cycles, clocks)
+
+    sim = Simulator(cart)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+    # Too slow for the default pulse width, fine for a longer one.
+    try:
+        Fragment.get(Cart(10, sync_stages=2), None)
+    except ValueError:
+        pass
+    else:
+        assert False, "missed the PI budget"
+    Fragment.get(Cart(10, sync_stages=2, pi_pwd=0x40), None)
+
+
+@sim_test(fast_pi=[False, True])
+def sim_header_override(fast_pi):
+    """ Reads of the header word, with and without the fast timing. """
+    from nmigen.back.pysim import Simulator
+
+    rom = {PI_HEADER_ADDR: 0x8037, PI_HEADER_ADDR + 2: 0x1240, PI_HEADER_ADDR + 4: 0x000f}
+    cart = Cart(50, fast_pi=fast_pi)
+
+    def proc():
+        words = yield from pi_read(cart, PI_HEADER_ADDR, len(rom), rom.__getitem__)
+        if fast_pi:
+            pwd, rls = cart.fast_timing
+            assert pi_budget_ns(pwd) >= cart.latency_ns
+            assert pwd < 0x12
+            assert words == [0x8007 | rls << 4, pwd << 8 | 0x40, 0x000f]
+        else:
+            assert words == [0x8037, 0x1240, 0x000f]
+
+    sim = Simulator(cart)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+@sim_test(order=["z64", "v64", "n64"], fast_pi=[False, True])
+def sim_byte_order(order, fast_pi):
+    """ Dumps in each byte order read the same once the header was seen,
+    with the header override applied in the console's order. """
+    from nmigen.back.pysim import Simulator
+
+    image = bytes([0x80, 0x37, 0x12, 0x40, 0x00, 0x00, 0x00, 0x0f, 0x12, 0x34, 0x56, 0x78])
+    if order == "v64":
+        dump = b"".join(image[i:i+2][::-1] for i in range(0, len(image), 2))
+    elif order == "n64":
+        dump = b"".join(image[i:i+4][::-1] for i in range(0, len(image), 4))
+    else:
+        dump = image
+    halves = struct.unpack(">{}H".format(len(dump) // 2), dump)
+
+    cart = Cart(50, fast_pi=fast_pi)
+
+    def proc():
+        yield from bus_access(cart, CART_HEADER, 1, halves[0])
+        assert (yield from bus_access(cart, CART_BYTE_ORDER)) == ["z64", "v64", "n64"].index(order)
+
+        # Not a header, the setting stays.
+        yield from bus_access(cart, CART_HEADER, 1, 0x1234)
+        assert (yield from bus_access(cart, CART_BYTE_ORDER)) == ["z64", "v64", "n64"].index(order)
+
+        words = yield from pi_read(cart, PI_HEADER_ADDR, len(halves),
+            lambda addr: halves[(addr - PI_HEADER_ADDR) // 2])
+        expected = list(struct.unpack(">{}H".format(len(image) // 2), image))
+        if fast_pi:
+            pwd, rls = cart.fast_timing
+            expected[:2] = [0x8007 | rls << 4, pwd << 8 | 0x40]
+        assert words == expected, [hex(w) for w in words]
+
+    sim = Simulator(cart)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
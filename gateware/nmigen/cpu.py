@@ -43,8 +43,9 @@ class SERV(Elaboratable):
             i_i_dbus_ack = self.dbus.ack,
         )
 
-        #m.d.comb += self.ibus.stb.eq(self.ibus.cyc)
-        #m.d.comb += self.dbus.stb.eq(self.dbus.cyc)
+        # SERV holds cyc for exactly one request, so it doubles as stb.
+        m.d.comb += self.ibus.stb.eq(self.ibus.cyc)
+        m.d.comb += self.dbus.stb.eq(self.dbus.cyc)
 
         """  (
         input wire         clk,
@@ -69,7 +70,7 @@ class SERV(Elaboratable):
 
 class PicoRV32(Elaboratable):
     def __init__(self):
-        #self.timer_irq = Signal()
+        self.timer_irq = Signal()
         
         a_width = 32
         d_width = 32
@@ -85,7 +86,9 @@ class PicoRV32(Elaboratable):
         args = dict(
             i_wb_clk_i = ClockSignal(),
             i_wb_rst_i = ResetSignal(),
-            #i_i_timer_irq = self.timer_irq,
+            # IRQs 0 to 2 are internal, the line goes to the first external one.
+            p_ENABLE_IRQ = 1,
+            i_irq = Cat(C(0, 3), self.timer_irq, C(0, 28)),
             
             i_wbm_dat_i = self.bus.r_dat,
             i_wbm_ack_i = self.bus.ack,
@@ -100,4 +103,11 @@ class PicoRV32(Elaboratable):
 
         m.submodules.picorv32 = Instance("picorv32_wb", **args)
 
-        return m
\ No newline at end of file
+        return m
+
+# Cores selectable in Top. SERV has separate instruction and data buses,
+# PicoRV32 a single one for both.
+CPUS = {
+    "serv": SERV,
+    "picorv32": PicoRV32,
+}
@@ -11,11 +11,21 @@ int main(int argc, char **argv)
 {
     char *filename;
     int dump_level = 0;
+    int cycles = 100000;
+    int trace_start = 0;
+    int trace_stop = cycles;
 
+    // main <vcd> <dump level> [trace start] [trace stop] [cycles]
     if (argc >= 3){
         filename = argv[1];
         dump_level = atoi(argv[2]);
     } 
+    if (argc >= 5){
+        trace_start = atoi(argv[3]);
+        trace_stop = atoi(argv[4]);
+    }
+    if (argc >= 6)
+        cycles = atoi(argv[5]);
 
     cxxrtl_design::p_top top;
     cxxrtl::debug_items all_debug_items;
@@ -38,46 +48,34 @@ int main(int argc, char **argv)
 
     top.step();
 
-    if (dump_level)
+    if (dump_level && trace_start == 0)
         vcd.sample(0);
 
-    for(int j = 0; j < 20; ++j) {
-        if(j == 1) top.p_rst = value<1>{1u};
-        if(j == 10) top.p_rst = value<1>{0u};
-
-        top.p_clk = value<1>{0u};
-        top.step();
-
-        if (dump_level)
-            vcd.sample(j*2 + 0);
+    for(int i = 0; i < cycles; ++i){
+        if(i == 1) top.p_rst = value<1>{1u};
+        if(i == 10) top.p_rst = value<1>{0u};
 
-        top.p_clk = value<1>{1u};
-        top.step();
-        if (dump_level)
-            vcd.sample(j*2 + 1);
+        bool tracing = dump_level && i >= trace_start && i < trace_stop;
 
-        if (dump_level){
-            waves << vcd.buffer;
-            vcd.buffer.clear();
-        }
-    }
-
-    for(int i=20;i<100000;++i){
         top.p_clk = value<1>{0u};
         top.step();
 
-        if (dump_level)
+        if (tracing)
             vcd.sample(i*2 + 0);
 
         top.p_clk = value<1>{1u};
         top.step();
 
-        if (dump_level)
+        if (tracing)
             vcd.sample(i*2 + 1);
 
-        if (dump_level){
+        // Flushing every cycle makes long runs I/O bound.
+        if (vcd.buffer.size() > (1 << 20)){
             waves << vcd.buffer;
             vcd.buffer.clear();
         }
     }
+
+    if (dump_level)
+        waves << vcd.buffer;
 }
\ No newline at end of file
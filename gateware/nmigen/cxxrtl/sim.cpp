@@ -0,0 +1,164 @@
+// Shared library wrapper around the cxxrtl model, driven from sim_cxxrtl.py
+// through ctypes. Build with -DTOP=\"path/to/cart_tb.cpp\".
+
+#include <cstdint>
+#include <fstream>
+#include <string>
+
+#include <backends/cxxrtl/cxxrtl_vcd.h>
+
+#include TOP
+
+using namespace std;
+
+struct sim {
+    cxxrtl_design::p_top top;
+    cxxrtl::debug_items all_debug_items;
+    cxxrtl::vcd_writer vcd;
+    std::ofstream waves;
+
+    int dump_level = 0;
+    uint64_t cycle = 0;
+    uint64_t trace_start = 0;
+    uint64_t trace_stop = UINT64_MAX;
+
+    // Optional trigger: tracing starts once this item equals trigger_value.
+    cxxrtl::debug_item *trigger = nullptr;
+    uint64_t trigger_value = 0;
+    uint64_t trigger_length = 0;
+};
+
+static uint64_t item_value(const cxxrtl::debug_item &item)
+{
+    uint64_t value = item.curr[0];
+    if (item.width > 32)
+        value |= (uint64_t)item.curr[1] << 32;
+    return value;
+}
+
+static bool tracing(sim *s)
+{
+    if (!s->dump_level || s->cycle < s->trace_start)
+        return false;
+
+    if (s->trigger) {
+        if (item_value(*s->trigger) != s->trigger_value)
+            return false;
+        s->trigger = nullptr;
+        if (s->trigger_length)
+            s->trace_stop = s->cycle + s->trigger_length;
+    }
+
+    return s->cycle < s->trace_stop;
+}
+
+static void flush(sim *s)
+{
+    if (!s->vcd.buffer.empty()) {
+        s->waves << s->vcd.buffer;
+        s->vcd.buffer.clear();
+    }
+}
+
+extern "C" {
+
+sim *sim_create(const char *filename, int dump_level)
+{
+    sim *s = new sim;
+    s->top.debug_info(s->all_debug_items);
+    s->dump_level = dump_level;
+
+    if (dump_level) {
+        s->vcd.timescale(1, "us");
+        if (dump_level == 1)
+            s->vcd.add(s->all_debug_items);
+        else if (dump_level == 2)
+            s->vcd.add_without_memories(s->all_debug_items);
+        else if (dump_level == 3)
+            s->vcd.template add(s->all_debug_items, [](const std::string &, const cxxrtl::debug_item &item) {
+                return item.type == cxxrtl::debug_item::WIRE;
+            });
+        s->waves.open(filename);
+    }
+
+    s->top.step();
+    return s;
+}
+
+void sim_destroy(sim *s)
+{
+    flush(s);
+    delete s;
+}
+
+void sim_trace_window(sim *s, uint64_t start, uint64_t stop)
+{
+    s->trace_start = start;
+    s->trace_stop = stop;
+}
+
+// The functions taking a signal name return 0 if there is no such signal.
+int sim_trace_trigger(sim *s, const char *name, uint64_t value, uint64_t length)
+{
+    auto it = s->all_debug_items.table.find(name);
+    if (it == s->all_debug_items.table.end())
+        return 0;
+
+    s->trigger = &it->second.front();
+    s->trigger_value = value;
+    s->trigger_length = length;
+    return 1;
+}
+
+int sim_poke(sim *s, const char *name, uint64_t value)
+{
+    auto it = s->all_debug_items.table.find(name);
+    if (it == s->all_debug_items.table.end())
+        return 0;
+
+    cxxrtl::debug_item &item = it->second.front();
+    cxxrtl::chunk_t *dst = item.next ? item.next : item.curr;
+    dst[0] = (cxxrtl::chunk_t)value;
+    if (item.width > 32)
+        dst[1] = (cxxrtl::chunk_t)(value >> 32);
+    return 1;
+}
+
+int sim_peek(sim *s, const char *name, uint64_t *value)
+{
+    auto it = s->all_debug_items.table.find(name);
+    if (it == s->all_debug_items.table.end())
+        return 0;
+
+    *value = item_value(it->second.front());
+    return 1;
+}
+
+uint64_t sim_cycle(sim *s)
+{
+    return s->cycle;
+}
+
+void sim_run(sim *s, uint64_t cycles)
+{
+    for (uint64_t i = 0; i < cycles; ++i) {
+        s->top.p_clk = value<1>{0u};
+        s->top.step();
+        if (tracing(s))
+            s->vcd.sample(s->cycle*2 + 0);
+
+        s->top.p_clk = value<1>{1u};
+        s->top.step();
+        if (tracing(s))
+            s->vcd.sample(s->cycle*2 + 1);
+
+        s->cycle++;
+
+        // Writing the buffer out every cycle makes the sim I/O bound.
+        if (s->vcd.buffer.size() > (1 << 20))
+            flush(s);
+    }
+    flush(s);
+}
+
+}
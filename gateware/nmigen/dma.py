@@ -0,0 +1,267 @@
+from nmigen import *
+from wb import WishboneBus, CTI_CLASSIC, CTI_INCR_BURST, CTI_END_OF_BURST
+from simtest import sim_test
+
+# Register offsets.
+DMA_SRC = 0x00
+DMA_DST = 0x04
+DMA_LEN = 0x08
+DMA_SRC_STRIDE = 0x0c
+DMA_DST_STRIDE = 0x10
+DMA_FILL = 0x14
+DMA_CTRL = 0x18
+
+# DMA_CTRL bits. Writing clears DONE, reading returns BUSY and DONE.
+DMA_START = 1 << 0
+DMA_FILL_MODE = 1 << 1
+DMA_IRQ_EN = 1 << 2
+DMA_BUSY = 1 << 0
+DMA_DONE = 1 << 1
+
+
+class WishboneDMA(Elaboratable):
+    """
+        Moves ``DMA_LEN`` words from ``DMA_SRC`` to ``DMA_DST``, or writes
+        ``DMA_FILL`` there in fill mode, through the ``master`` bus while
+        the CPU keeps running. Addresses advance by the stride registers
+        (4 after reset).
+
+        Words are read into a ``chunk`` deep buffer and then written out,
+        so source and destination can be on the same slave. With a stride
+        of 4 each chunk goes out as an incrementing burst, one word per
+        cycle on slaves that support them.
+
+        ``irq`` is raised on completion while ``DMA_IRQ_EN`` is set, until
+        ``DMA_CTRL`` is written again. ``DMA_FILL_MODE`` and ``DMA_IRQ_EN``
+        are only taken along with ``DMA_START`` while idle.
+
+    Parameters
+    ----------
+    chunk : int
+        Words buffered between the read and the write phase.
+    """
+    def __init__(self, chunk=8):
+        self.chunk = chunk
+
+        self.bus = WishboneBus()
+        self.master = WishboneBus()
+        self.irq = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        master = self.master
+
+        src = Signal(32)
+        dst = Signal(32)
+        length = Signal(32)
+        src_stride = Signal(32, reset=4)
+        dst_stride = Signal(32, reset=4)
+        fill = Signal(32)
+        fill_mode = Signal()
+        irq_en = Signal()
+        busy = Signal()
+        done = Signal()
+        start = Signal()
+
+        m.d.comb += self.irq.eq(done & irq_en)
+
+        # Registers
+        regs = {
+            DMA_SRC: src,
+            DMA_DST: dst,
+            DMA_LEN: length,
+            DMA_SRC_STRIDE: src_stride,
+            DMA_DST_STRIDE: dst_stride,
+            DMA_FILL: fill,
+        }
+
+        m.d.sync += start.eq(0)
+        with m.If(bus.cyc & ~bus.ack):
+            with m.Switch(bus.addr[:5]):
+                for offset, reg in regs.items():
+                    with m.Case(offset):
+                        m.d.sync += bus.r_dat.eq(reg)
+                        with m.If(bus.we):
+                            m.d.sync += reg.eq(bus.w_dat)
+                with m.Case(DMA_CTRL):
+                    m.d.sync += bus.r_dat.eq(Cat(busy, done))
+                    with m.If(bus.we):
+                        m.d.sync += done.eq(0)
+                        # The mode of a running transfer stays as it was.
+                        with m.If(bus.w_dat[0] & ~busy):
+                            m.d.sync += [
+                                start.eq(1),
+                                fill_mode.eq(bus.w_dat[1]),
+                                irq_en.eq(bus.w_dat[2]),
+                            ]
+
+        m.d.sync += bus.ack.eq(bus.cyc & ~bus.ack)
+
+        # Transfer
+        buffer = Memory(width=32, depth=self.chunk)
+        m.submodules.buf_r = buf_r = buffer.read_port()
+        m.submodules.buf_w = buf_w = buffer.write_port()
+
+        rd_addr = Signal(32)
+        wr_addr = Signal(32)
+        remaining = Signal(32)
+        beats = Signal(range(self.chunk + 1))
+        idx = Signal(range(self.chunk))
+        last = idx == beats - 1
+
+        m.d.comb += [
+            buf_w.addr.eq(idx),
+            buf_w.data.eq(master.r_dat),
+            master.sel.eq(0b1111),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(start):
+                    m.d.sync += [
+                        busy.eq(1),
+                        rd_addr.eq(src),
+                        wr_addr.eq(dst),
+                        remaining.eq(length),
+                    ]
+                    m.next = "NEXT"
+
+            with m.State("NEXT"):
+                m.d.sync += [
+                    idx.eq(0),
+                    beats.eq(Mux(remaining < self.chunk, remaining, self.chunk)),
+                ]
+                with m.If(remaining == 0):
+                    m.d.sync += [
+                        busy.eq(0),
+                        done.eq(1),
+                    ]
+                    m.next = "IDLE"
+                with m.Elif(fill_mode):
+                    m.next = "WRITE"
+                with m.Else():
+                    m.next = "READ"
+
+            with m.State("READ"):
+                m.d.comb += [
+                    master.cyc.eq(1),
+                    master.stb.eq(1),
+                    master.addr.eq(rd_addr),
+                    master.cti.eq(Mux(last, CTI_END_OF_BURST,
+                        Mux(src_stride == 4, CTI_INCR_BURST, CTI_CLASSIC))),
+                    buf_r.addr.eq(0),
+                ]
+                with m.If(master.ack):
+                    m.d.comb += buf_w.en.eq(1)
+                    m.d.sync += [
+                        rd_addr.eq(rd_addr + src_stride),
+                        idx.eq(idx + 1),
+                    ]
+                    with m.If(last):
+                        m.d.sync += idx.eq(0)
+                        m.next = "WRITE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    master.cyc.eq(1),
+                    master.stb.eq(1),
+                    master.we.eq(1),
+                    master.addr.eq(wr_addr),
+                    master.w_dat.eq(Mux(fill_mode, fill, buf_r.data)),
+                    master.cti.eq(Mux(last, CTI_END_OF_BURST,
+                        Mux(dst_stride == 4, CTI_INCR_BURST, CTI_CLASSIC))),
+                    # Read port is synchronous, so look one word ahead.
+                    buf_r.addr.eq(Mux(master.ack, idx + 1, idx)),
+                ]
+                with m.If(master.ack):
+                    m.d.sync += [
+                        wr_addr.eq(wr_addr + dst_stride),
+                        idx.eq(idx + 1),
+                        remaining.eq(remaining - 1),
+                    ]
+                    with m.If(last):
+                        m.next = "NEXT"
+
+        return m
+
+
+@sim_test()
+def sim_dma():
+    from nmigen.back.pysim import Simulator
+    from wb import WishboneRAM, WishboneCrossbar, Peripheral
+
+    ram = WishboneRAM(init=list(range(0x100, 0x140)))
+    dma = WishboneDMA(chunk=4)
+    xbar = WishboneCrossbar(2, [
+        Peripheral(ram, 0x0000, 0x100),
+        Peripheral(dma, 0x1000, 0x20),
+    ])
+
+    m = Module()
+    m.submodules += [ram, dma, xbar]
+    m.d.comb += dma.master.connect_to(xbar.masters[1])
+
+    cpu = xbar.masters[0]
+
+    def access(addr, we=0, data=0):
+        yield cpu.addr.eq(addr)
+        yield cpu.we.eq(we)
+        yield cpu.sel.eq(0b1111)
+        yield cpu.w_dat.eq(data)
+        yield cpu.cyc.eq(1)
+        yield cpu.stb.eq(1)
+        yield
+        while not (yield cpu.ack):
+            yield
+        result = yield cpu.r_dat
+        yield cpu.cyc.eq(0)
+        yield cpu.stb.eq(0)
+        yield
+        return result
+
+    def run(ctrl, **regs):
+        for name, value in regs.items():
+            yield from access(0x1000 + globals()["DMA_" + name.upper()], 1, value)
+        yield from access(0x1000 + DMA_CTRL, 1, DMA_START | DMA_IRQ_EN | ctrl)
+        cycles = 0
+        while not (yield dma.irq):
+            yield
+            cycles += 1
+        assert (yield from access(0x1000 + DMA_CTRL)) == DMA_DONE
+        return cycles
+
+    def read_words(addr, count):
+        words = []
+        for k in range(count):
+            words.append((yield from access(addr + k * 4)))
+        return words
+
+    def proc():
+        # Copy within one RAM, 10 words through a 4 word buffer.
+        cycles = yield from run(0, src=0x00, dst=0x80, len=10)
+        assert (yield from read_words(0x80, 11)) == list(range(0x100, 0x10a)) + [0x12a]
+        # Bursts beat the 4 cycles a word of single reads and writes.
+        assert cycles < 10 * 4, cycles
+
+        # Gather every other word.
+        yield from run(0, src=0x00, dst=0xc0, len=4, src_stride=8)
+        assert (yield from read_words(0xc0, 4)) == [0x100, 0x102, 0x104, 0x106]
+
+        yield from run(DMA_FILL_MODE, dst=0x40, len=5, src_stride=4, fill=0xdeadbeef)
+        assert (yield from read_words(0x3c, 7)) == [0x10f] + [0xdeadbeef] * 5 + [0x115]
+
+        # Starting again while busy changes nothing, the copy completes.
+        yield from access(0x1000 + DMA_DST, 1, 0x80)
+        yield from access(0x1000 + DMA_CTRL, 1, DMA_START | DMA_IRQ_EN)
+        yield from access(0x1000 + DMA_CTRL, 1, DMA_START | DMA_FILL_MODE)
+        assert (yield from access(0x1000 + DMA_CTRL)) == DMA_BUSY
+        while not (yield dma.irq):
+            yield
+        assert (yield from read_words(0x80, 5)) == list(range(0x100, 0x105))
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
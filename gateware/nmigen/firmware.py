@@ -0,0 +1,127 @@
+"""
+Firmware images for the soft CPU, and swapping them into a finished
+bitstream without resynthesis.
+
+A bitstream built with ``irom_placeholder=True`` holds a pseudo-random
+pattern in each ROM instead of irom/irom.bin. ``icebram`` finds that
+pattern in the .asc and replaces it with the real image, then ``icepack``
+packs the result:
+
+    python firmware.py flash          # build once (cached), patch, program
+    python firmware.py patch -o top.bin
+"""
+
+import os
+import random
+import struct
+import subprocess
+import tempfile
+
+IROM = os.path.join("irom", "irom.bin")
+# 256x32 fills the same two EBRs as 128x32 did.
+IROM_WORDS = 256
+
+# Writable program RAM the boot ROM loads into, see irom/boot.s.
+IRAM_BASE = 0x00010000
+IRAM_WORDS = 512
+
+# Code in the SPI flash, past the bitstream, on the instruction bus of
+# split bus cores. See Top's flash_code.
+FLASH_BASE = 0x20000000
+FLASH_OFFSET = 0x40000
+FLASH_SIZE = 0x100000
+
+# Unused ROM words.
+PADDING = 0xbeeffac0
+
+# One placeholder per memory, icebram needs patterns that only match once.
+PLACEHOLDER_SEEDS = {"irom": 0xbeeffac0, "drom": 0xbeeffac1}
+
+
+def load_irom(path=IROM, words=IROM_WORDS):
+    with open(path, "rb") as f:
+        image = [w for (w,) in struct.iter_unpack("<I", f.read())]
+    if len(image) > words:
+        raise ValueError("{} is {} words, ROM holds {}".format(path, len(image), words))
+    return image + [PADDING] * (words - len(image))
+
+
+def placeholder(name, words=IROM_WORDS):
+    rng = random.Random(PLACEHOLDER_SEEDS[name])
+    return [rng.getrandbits(32) for _ in range(words)]
+
+
+def write_hex(words, path):
+    with open(path, "w") as f:
+        for w in words:
+            f.write("{:08x}\n".format(w))
+
+
+def placeholder_names(cpu="serv"):
+    """ The placeholder ROMs in a build for ``cpu``. A core without a
+    separate ibus reads code and data from the same ROM. """
+    from cpu import CPUS
+    if hasattr(CPUS[cpu](), "ibus"):
+        return ["irom", "drom"]
+    return ["irom"]
+
+
+def patch_asc(asc_in, asc_out, image, names=PLACEHOLDER_SEEDS):
+    """ Replace the placeholder ROMs ``names`` in ``asc_in`` with
+    ``image``. icebram fails on a pattern that isn't there. """
+    with tempfile.TemporaryDirectory() as tmp:
+        src = asc_in
+        for name in names:
+            from_hex = os.path.join(tmp, name + "_from.hex")
+            to_hex = os.path.join(tmp, name + "_to.hex")
+            write_hex(placeholder(name, len(image)), from_hex)
+            write_hex(image, to_hex)
+
+            dst = os.path.join(tmp, name + ".asc")
+            with open(src) as fin, open(dst, "w") as fout:
+                subprocess.check_call(["icebram", from_hex, to_hex], stdin=fin, stdout=fout)
+            src = dst
+
+        os.replace(src, asc_out)
+
+
+def build_placeholder(sys_clk=50, cpu="serv"):
+    """ The board bitstream with placeholder ROMs. Cached, so after the
+    first build this only costs an elaboration. """
+    from build_cache import cached_build
+    from n64_board import N64Platform
+    from top import CartConcretePLL
+
+    platform = N64Platform()
+    concrete = CartConcretePLL(sys_clk=sys_clk, uart_baud=115200, uart_delay=10000,
+        irom_placeholder=True, cpu=cpu)
+    return cached_build(platform, concrete, read_verilog_opts="-I../serv/rtl")
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=["build", "patch", "flash"])
+    parser.add_argument("--image", default=IROM)
+    parser.add_argument("--cpu", choices=["serv", "picorv32"], default="serv")
+    parser.add_argument("-o", "--output", default=os.path.join("build", "firmware.bin"))
+    args = parser.parse_args()
+
+    products = build_placeholder(cpu=args.cpu)
+    if args.action == "build":
+        print("placeholder bitstream ready")
+
+    if args.action in ("patch", "flash"):
+        start = time.perf_counter()
+        image = load_irom(args.image)
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        asc = args.output[:-4] + ".asc" if args.output.endswith(".bin") else args.output + ".asc"
+        with products.extract("top.asc") as asc_in:
+            patch_asc(asc_in, asc, image, placeholder_names(args.cpu))
+        subprocess.check_call(["icepack", asc, args.output])
+        print("patched {} in {:.2f}s".format(args.output, time.perf_counter() - start))
+
+    if args.action == "flash":
+        subprocess.check_call([os.environ.get("ICEPROG", "iceprog"), args.output])
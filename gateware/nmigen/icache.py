@@ -0,0 +1,268 @@
+from nmigen import *
+from wb import WishboneBus, CTI_INCR_BURST, CTI_END_OF_BURST
+from simtest import sim_test
+
+# Control register offsets, all read only. Writing anywhere flushes.
+ICACHE_HITS = 0x0
+ICACHE_MISSES = 0x4
+
+
+class WishboneICache(Elaboratable):
+    """
+        Direct mapped, read only cache between a CPU instruction bus
+        (``bus``) and the interconnect (``master``).
+
+        A hit is acked the cycle after the request, like ``WishboneRAM``.
+        A miss refills the whole line with an incrementing burst and then
+        retries. ``ctrl`` exposes the hit and miss counters; writing to it
+        invalidates every line, e.g. after loading new code into RAM.
+
+    Parameters
+    ----------
+    lines : int
+        Number of lines, a power of two.
+    line_words : int
+        Words per line, a power of two.
+    """
+    def __init__(self, lines=16, line_words=4):
+        assert lines & (lines - 1) == 0
+        assert line_words & (line_words - 1) == 0
+
+        self.lines = lines
+        self.line_words = line_words
+
+        self.bus = WishboneBus()
+        self.master = WishboneBus()
+        self.ctrl = WishboneBus()
+
+        self.hits = Signal(32)
+        self.misses = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        master = self.master
+        ctrl = self.ctrl
+
+        offset_bits = (self.line_words - 1).bit_length()
+        index_bits = (self.lines - 1).bit_length()
+        tag_start = 2 + offset_bits + index_bits
+
+        offset = bus.addr[2:2 + offset_bits]
+        index = bus.addr[2 + offset_bits:tag_start]
+        tag = bus.addr[tag_start:]
+
+        tags = Memory(width=len(tag), depth=self.lines)
+        data = Memory(width=32, depth=self.lines * self.line_words)
+        m.submodules.tag_r = tag_r = tags.read_port()
+        m.submodules.tag_w = tag_w = tags.write_port()
+        m.submodules.data_r = data_r = data.read_port()
+        m.submodules.data_w = data_w = data.write_port()
+
+        valid = Signal(self.lines)
+        valid_r = Signal()
+        flush = Signal()
+
+        m.d.comb += [
+            tag_r.addr.eq(index),
+            data_r.addr.eq(Cat(offset, index)),
+            bus.r_dat.eq(data_r.data),
+        ]
+        m.d.sync += valid_r.eq(valid.bit_select(index, 1))
+
+        request = bus.cyc & bus.stb
+        # The memories have been read for the address on the bus.
+        looked_up = Signal()
+        retry = Signal()
+        hit = looked_up & valid_r & (tag_r.data == tag)
+
+        refill = Signal(offset_bits)
+        last = refill == self.line_words - 1
+
+        m.d.comb += [
+            tag_w.addr.eq(index),
+            tag_w.data.eq(tag),
+            data_w.addr.eq(Cat(refill, index)),
+            data_w.data.eq(master.r_dat),
+            master.addr.eq(Cat(C(0, 2), refill, index, tag)),
+            master.sel.eq(0b1111),
+        ]
+
+        with m.FSM():
+            with m.State("LOOKUP"):
+                m.d.sync += looked_up.eq(request & ~bus.ack)
+                with m.If(hit & request):
+                    m.d.comb += bus.ack.eq(1)
+                    m.d.sync += [
+                        looked_up.eq(0),
+                        retry.eq(0),
+                    ]
+                    # The retry after a refill was already counted as a miss.
+                    with m.If(~retry):
+                        m.d.sync += self.hits.eq(self.hits + 1)
+                with m.Elif(looked_up & request):
+                    m.d.sync += [
+                        self.misses.eq(self.misses + 1),
+                        looked_up.eq(0),
+                        retry.eq(0),
+                        refill.eq(0),
+                    ]
+                    m.next = "REFILL"
+
+            with m.State("REFILL"):
+                m.d.comb += [
+                    master.cyc.eq(1),
+                    master.stb.eq(1),
+                    master.cti.eq(Mux(last, CTI_END_OF_BURST, CTI_INCR_BURST)),
+                ]
+                with m.If(master.ack):
+                    m.d.comb += data_w.en.eq(1)
+                    m.d.sync += refill.eq(refill + 1)
+                    with m.If(last):
+                        m.d.comb += tag_w.en.eq(1)
+                        m.d.sync += [
+                            valid.bit_select(index, 1).eq(~flush),
+                            retry.eq(1),
+                        ]
+                        m.next = "LOOKUP"
+
+        # Control
+        with m.If(ctrl.cyc & ~ctrl.ack):
+            m.d.sync += ctrl.r_dat.eq(Mux(ctrl.addr[2], self.misses, self.hits))
+        m.d.sync += ctrl.ack.eq(ctrl.cyc & ~ctrl.ack)
+        m.d.comb += flush.eq(ctrl.cyc & ctrl.we & ~ctrl.ack)
+        with m.If(flush):
+            m.d.sync += valid.eq(0)
+
+        return m
+
+
+@sim_test()
+def sim_icache():
+    from nmigen.back.pysim import Simulator
+    from wb import WishboneRAM
+
+    program = [0x1000 + k for k in range(64)]
+    ram = WishboneRAM(init=program)
+    cache = WishboneICache(lines=4, line_words=4)
+
+    m = Module()
+    m.submodules += [ram, cache]
+    m.d.comb += cache.master.connect_to(ram.bus)
+
+    bus = cache.bus
+
+    def fetch(addr):
+        yield bus.addr.eq(addr)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        yield
+        cycles = 1
+        while not (yield bus.ack):
+            yield
+            cycles += 1
+        result = yield bus.r_dat
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield
+        return result, cycles
+
+    def ctrl(addr, we=0):
+        yield cache.ctrl.addr.eq(addr)
+        yield cache.ctrl.we.eq(we)
+        yield cache.ctrl.cyc.eq(1)
+        yield
+        while not (yield cache.ctrl.ack):
+            yield
+        result = yield cache.ctrl.r_dat
+        yield cache.ctrl.cyc.eq(0)
+        yield
+        return result
+
+    def proc():
+        # A loop over two lines: misses once per line, then hits.
+        latencies = []
+        for _ in range(3):
+            for k in range(8):
+                word, cycles = yield from fetch(0x40 + k * 4)
+                assert word == program[0x10 + k], hex(word)
+                latencies.append(cycles)
+        # Hits take as long as a WishboneRAM access in this loop.
+        assert latencies[1:4] == [2] * 3 and latencies[8:] == [2] * 16, latencies
+        assert (yield from ctrl(ICACHE_HITS)) == 22
+        assert (yield from ctrl(ICACHE_MISSES)) == 2
+
+        # Same index, other tag: evicts line 0x40.
+        word, _ = yield from fetch(0x80)
+        assert word == program[0x20]
+        word, cycles = yield from fetch(0x40)
+        assert word == program[0x10] and cycles > 2
+
+        yield from ctrl(0, we=1)
+        word, cycles = yield from fetch(0x44)
+        assert word == program[0x11] and cycles > 2
+        assert (yield from ctrl(ICACHE_MISSES)) == 5
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+@sim_test()
+def sim_icache_flash():
+    """ Code run from ``WishboneSPIFlash``, where a miss costs about 130
+    clocks: a loop over two lines with and without the cache. """
+    from nmigen.back.pysim import Simulator
+    from spiflash import WishboneSPIFlash, spi_flash_model
+
+    image = bytes(k & 0xff for k in range(0x400))
+
+    def word(addr):
+        return int.from_bytes(image[addr:addr + 4], "little")
+
+    def run(cached):
+        flash = WishboneSPIFlash(size=0x400)
+        m = Module()
+        m.submodules.flash = flash
+        if cached:
+            cache = WishboneICache(lines=4, line_words=4)
+            m.submodules.cache = cache
+            m.d.comb += cache.master.connect_to(flash.bus)
+            bus = cache.bus
+        else:
+            bus = flash.bus
+        model, _ = spi_flash_model(flash.spi, image)
+        total = []
+
+        def proc():
+            cycles = 0
+            for _ in range(4):
+                for k in range(8):
+                    yield bus.addr.eq(0x40 + k * 4)
+                    yield bus.cyc.eq(1)
+                    yield bus.stb.eq(1)
+                    yield
+                    cycles += 1
+                    while not (yield bus.ack):
+                        yield
+                        cycles += 1
+                    assert (yield bus.r_dat) == word(0x40 + k * 4)
+                    yield bus.cyc.eq(0)
+                    yield bus.stb.eq(0)
+                    yield
+                    cycles += 1
+            total.append(cycles)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(model)
+        sim.add_sync_process(proc)
+        sim.run()
+        return total[0]
+
+    uncached = run(False)
+    cached = run(True)
+    # Without the cache every loop jumps back and starts a new read.
+    assert cached * 3 < uncached, (cached, uncached)
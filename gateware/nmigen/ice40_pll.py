@@ -1,6 +1,7 @@
 #!/usr/bin/env nmigen
 
 from collections import namedtuple
+import functools
 import warnings
 
 from nmigen import *
@@ -8,12 +9,56 @@ from nmigen.lib.cdc import ResetSynchronizer
 from nmigen.cli import main
 
 
+PLLConfig = namedtuple('PLLConfig', 'divr divf divq filter_range freq')
+
+# Upper PFD frequency limits (MHz) of each loop filter setting, from icepll.
+FILTER_RANGES = [(17, 1), (26, 2), (44, 3), (66, 4), (101, 5), (133, 6)]
+
+
+@functools.lru_cache(maxsize=None)
+def plan_pll(f_in, f_req, simple_feedback=True):
+    """
+    Closest PLL configuration to ``f_req`` MHz from ``f_in`` MHz, the same
+    search as Icestorm's icepll. Cached, so sweeps and repeated
+    elaboration don't redo it.
+
+    In simple feedback mode ``fout = pfd * (divf + 1) / 2**divq``. Every
+    other mode, e.g. ``PHASE_AND_DELAY``, feeds back after the divider, so
+    ``fout = pfd * (divf + 1)`` and ``divq`` only scales the VCO.
+    """
+    assert 10 <= f_in <= 133
+    assert 16 <= f_req <= 275
+
+    best = None
+    for divr in range(16):
+        pfd = f_in / (divr + 1)
+        if not 10 <= pfd <= 133:
+            continue
+        for divf in range(128):
+            for divq in range(1, 7):
+                if simple_feedback:
+                    vco = pfd * (divf + 1)
+                    fout = vco / 2**divq
+                else:
+                    fout = pfd * (divf + 1)
+                    vco = fout * 2**divq
+                if not 533 <= vco <= 1066:
+                    continue
+                if best is None or abs(fout - f_req) < abs(best.freq - f_req):
+                    filter_range = next(r for limit, r in FILTER_RANGES if pfd < limit)
+                    best = PLLConfig(divr, divf, divq, filter_range, fout)
+
+    if best is None:
+        raise ValueError("No PLL configuration for {} MHz from {} MHz".format(f_req, f_in))
+    return best
+
+
 class PLL(Elaboratable):
 
     """
     Instantiate the iCE40's phase-locked loop (PLL).
 
-    This uses the iCE40's SB_PLL40_PAD primitive in simple feedback
+    This uses the iCE40's SB_PLL40_CORE primitive in simple feedback
     mode.
 
     The reference clock is directly connected to a package pin. To
@@ -26,14 +71,26 @@ class PLL(Elaboratable):
     for other uses.  So you might as well have the PLL generate the
     default 'sync' clock domain.
 
+    With ``phase_domain_name``, it uses SB_PLL40_2F_CORE in
+    PHASE_AND_DELAY mode instead and drives a second domain at the same
+    frequency, 90 degrees behind the first, e.g. for an SDRAM clock that
+    puts the capture point in the middle of the data eye. With
+    ``dynamic_delay`` as well, ``delay`` adds up to 15 fine delay taps of
+    about 150 ps to it at run time, see sdram_cal.py.
+
     This module also has a reset synchronizer -- the domain's reset line
     is not released until a few clocks after the PLL lock signal is
     good.
     """
 
-    def __init__(self, freq_in_mhz, freq_out_mhz, domain_name='pll'):
+    def __init__(self, freq_in_mhz, freq_out_mhz, domain_name='pll', phase_domain_name=None,
+                 dynamic_delay=False):
+        assert phase_domain_name is not None or not dynamic_delay
         self.freq_in = freq_in_mhz
         self.freq_out = freq_out_mhz
+        self.phase_domain_name = phase_domain_name
+        self.dynamic_delay = dynamic_delay
+        self.delay = Signal(4)
         self.coeff = self._calc_freq_coefficients()
         self.clk_pin = Signal()
         self.domain_name = domain_name
@@ -43,53 +100,66 @@ class PLL(Elaboratable):
             self.domain.clk,
             self.domain.rst,
         ]
+        if phase_domain_name is not None:
+            self.phase_domain = ClockDomain(phase_domain_name)
+            self.ports += [
+                self.phase_domain.clk,
+                self.phase_domain.rst,
+            ]
 
     def _calc_freq_coefficients(self):
-        # cribbed from Icestorm's icepll.
         f_in, f_req = self.freq_in, self.freq_out
-        assert 10 <= f_in <= 25
-        assert 16 <= f_req <= 275
-        coefficients = namedtuple('coefficients', 'divr divf divq')
-        divf_range = 128        # see comments in icepll.cc
-        best_fout = float('inf')
-        for divr in range(16):
-            pfd = f_in / (divr + 1)
-            if 10 <= pfd <= 133:
-                for divf in range(divf_range):
-                    vco = pfd * (divf + 1)
-                    if 533 <= vco <= 1066:
-                        for divq in range(1, 7):
-                            fout = vco * 2**-divq
-                            if abs(fout - f_req) < abs(best_fout - f_req):
-                                best_fout = fout
-                                best = coefficients(divr, divf, divq)
-        if best_fout != f_req:
+        best = plan_pll(f_in, f_req, simple_feedback=self.phase_domain_name is None)
+        if best.freq != f_req:
             warnings.warn(
-                f'PLL: requested {f_req} MHz, got {best_fout} MHz)',
+                f'PLL: requested {f_req} MHz, got {best.freq} MHz)',
                 stacklevel=3)
         return best
 
     def elaborate(self, platform):
 
-        # coeff = self._calc_freq_coefficients()
-
         pll_lock = Signal()
         clk_out = Signal()
-        pll = Instance("SB_PLL40_CORE",
-            p_FEEDBACK_PATH='SIMPLE',
+        params = dict(
             p_DIVR=self.coeff.divr,
             p_DIVF=self.coeff.divf,
             p_DIVQ=self.coeff.divq,
-            p_FILTER_RANGE=0b001,
+            p_FILTER_RANGE=self.coeff.filter_range,
 
             i_REFERENCECLK=self.clk_pin,
             i_RESETB=Const(1),
             i_BYPASS=Const(0),
 
-            o_PLLOUTGLOBAL=clk_out,
             o_LOCK=pll_lock)
 
         m = Module()
+
+        if self.phase_domain_name is None:
+            pll = Instance("SB_PLL40_CORE",
+                p_FEEDBACK_PATH='SIMPLE',
+                o_PLLOUTGLOBAL=clk_out,
+                **params)
+        else:
+            clk_phase = Signal()
+            pll = Instance("SB_PLL40_2F_CORE",
+                p_FEEDBACK_PATH='PHASE_AND_DELAY',
+                p_DELAY_ADJUSTMENT_MODE_FEEDBACK='FIXED',
+                p_DELAY_ADJUSTMENT_MODE_RELATIVE='DYNAMIC' if self.dynamic_delay else 'FIXED',
+                p_FDA_FEEDBACK=0,
+                p_FDA_RELATIVE=0,
+                p_SHIFTREG_DIV_MODE=0,
+                p_PLLOUT_SELECT_PORTA='SHIFTREG_0deg',
+                p_PLLOUT_SELECT_PORTB='SHIFTREG_90deg',
+                o_PLLOUTGLOBALA=clk_out,
+                o_PLLOUTGLOBALB=clk_phase,
+                # Feedback delay in the low bits, relative in the high bits.
+                i_DYNAMICDELAY=Cat(Const(0, 4), self.delay),
+                **params)
+
+            platform.add_clock_constraint(clk_phase, self.freq_out * 1e6)
+            m.d.comb += ClockSignal(self.phase_domain_name).eq(clk_phase)
+            m.submodules += ResetSynchronizer(~pll_lock, domain=self.phase_domain_name)
+
         platform.add_clock_constraint(clk_out, self.freq_out * 1e6)
         m.d.comb += ClockSignal(self.domain_name).eq(clk_out)
         m.submodules += pll
@@ -0,0 +1,198 @@
+# Benchmarks for comparing CPU cores, see bench.py. Each one prints its
+# name and the mtime cycles it took in hex,
+#
+#   memcpy 00001234
+#
+# and "done" at the end.
+
+.equ MTIME, 0x0200bff8
+.equ IRAM_BASE, 0x10000
+.equ DHRY_RUNS, 50
+
+.globl _start
+_start:
+li sp, 0x400
+
+la a0, name_memcpy
+la a1, bench_memcpy
+jal run
+la a0, name_crc32
+la a1, bench_crc32
+jal run
+la a0, name_dhry
+la a1, bench_dhry
+jal run
+
+la a0, done
+jal uart_print_string
+.halt:
+j .halt
+
+# name in a0, benchmark in a1
+run:
+addi sp, sp, -12
+sw ra, 0(sp)
+sw s0, 4(sp)
+sw s1, 8(sp)
+
+mv s1, a1
+jal uart_print_string
+li a0, ' '
+jal uart_print_char
+
+li t0, MTIME
+lw s0, 0(t0)
+jalr s1
+li t0, MTIME
+lw a0, 0(t0)
+sub a0, a0, s0
+jal print_hex
+
+la a0, crlf
+jal uart_print_string
+
+lw s1, 8(sp)
+lw s0, 4(sp)
+lw ra, 0(sp)
+addi sp, sp, 12
+jr ra
+
+# value in a0, printed as 8 hex digits
+print_hex:
+addi sp, sp, -12
+sw ra, 0(sp)
+sw s0, 4(sp)
+sw s1, 8(sp)
+
+mv s0, a0
+li s1, 28
+.hex_loop:
+srl a0, s0, s1
+andi a0, a0, 15
+li t0, 10
+blt a0, t0, .hex_digit
+addi a0, a0, 'a' - '0' - 10
+.hex_digit:
+addi a0, a0, '0'
+jal uart_print_char
+addi s1, s1, -4
+bgez s1, .hex_loop
+
+lw s1, 8(sp)
+lw s0, 4(sp)
+lw ra, 0(sp)
+addi sp, sp, 12
+jr ra
+
+# Copy the first 256 bytes of the ROM to IRAM, a word at a time.
+bench_memcpy:
+li t0, 0
+li t1, IRAM_BASE
+addi t2, t1, 256
+.memcpy_loop:
+lw t3, 0(t0)
+sw t3, 0(t1)
+addi t0, t0, 4
+addi t1, t1, 4
+bne t1, t2, .memcpy_loop
+jr ra
+
+# Bitwise CRC-32 of the first 128 bytes of the ROM, result in a0.
+bench_crc32:
+li a0, -1
+li t0, 0
+li t1, 128
+li t4, 0xedb88320
+.crc_byte:
+lbu t2, 0(t0)
+xor a0, a0, t2
+li t3, 8
+.crc_bit:
+andi t5, a0, 1
+srli a0, a0, 1
+beqz t5, .crc_next
+xor a0, a0, t4
+.crc_next:
+addi t3, t3, -1
+bnez t3, .crc_bit
+addi t0, t0, 1
+bne t0, t1, .crc_byte
+not a0, a0
+jr ra
+
+# Dhrystone-like mix of record copies, calls, arithmetic, branches and
+# string compares.
+bench_dhry:
+addi sp, sp, -8
+sw ra, 0(sp)
+sw s0, 4(sp)
+
+li s0, DHRY_RUNS
+.dhry_loop:
+li t0, IRAM_BASE + 0x400
+addi t1, t0, 16
+lw t2, 0(t0)
+sw t2, 0(t1)
+lw t2, 4(t0)
+sw t2, 4(t1)
+lw t2, 8(t0)
+sw t2, 8(t1)
+lw t2, 12(t0)
+sw t2, 12(t1)
+
+li a0, 7
+li a1, 3
+jal dhry_proc
+
+la a0, dhry_str1
+la a1, dhry_str2
+jal dhry_strcmp
+
+addi s0, s0, -1
+bnez s0, .dhry_loop
+
+lw s0, 4(sp)
+lw ra, 0(sp)
+addi sp, sp, 8
+jr ra
+
+# a0 = (a0 + a1) * 2 - a1, minus one unless that is below a1
+dhry_proc:
+add a0, a0, a1
+slli a0, a0, 1
+sub a0, a0, a1
+blt a0, a1, .proc_done
+addi a0, a0, -1
+.proc_done:
+jr ra
+
+# strings in a0 and a1, a0 = 0 if they are equal
+dhry_strcmp:
+lbu t0, 0(a0)
+lbu t1, 0(a1)
+bne t0, t1, .strcmp_differ
+beqz t0, .strcmp_equal
+addi a0, a0, 1
+addi a1, a1, 1
+j dhry_strcmp
+.strcmp_equal:
+li a0, 0
+jr ra
+.strcmp_differ:
+sub a0, t0, t1
+jr ra
+
+name_memcpy:
+.asciz "memcpy"
+name_crc32:
+.asciz "crc32"
+name_dhry:
+.asciz "dhry"
+crlf:
+.asciz "\r\n"
+done:
+.asciz "done\r\n"
+dhry_str1:
+.asciz "DHRYSTONE PROGRAM, 1'ST STRING"
+dhry_str2:
+.asciz "DHRYSTONE PROGRAM, 1'ST STRING"
@@ -0,0 +1,105 @@
+# UART bootloader. Waits for a frame
+#
+#   "BOOT", length (u32 LE, bytes, multiple of 4), payload,
+#   checksum (u32 LE, sum of the payload words)
+#
+# copies the payload to IRAM, answers 'O' and jumps to it. On a bad length
+# or checksum it answers 'E' and waits for the next frame.
+# scripts/uart_boot.py is the host side.
+
+.equ IRAM_BASE, 0x10000
+.equ IRAM_SIZE, 0x800
+
+.globl boot
+boot:
+li a0, 'B'
+jal uart_print_char
+
+.sync:
+li s0, 0
+.sync_next:
+jal uart_read_char
+.sync_cmp:
+la t0, magic
+add t0, t0, s0
+lbu t0, 0(t0)
+beq a0, t0, .sync_match
+beqz s0, .sync_next
+# retry this byte as the start of the magic
+li s0, 0
+j .sync_cmp
+.sync_match:
+addi s0, s0, 1
+li t0, 4
+bne s0, t0, .sync_next
+
+jal uart_read_word
+mv s2, a0
+li t0, IRAM_SIZE
+bltu t0, s2, .bad
+andi t0, s2, 3
+bnez t0, .bad
+
+li s3, IRAM_BASE
+add s4, s3, s2
+li s5, 0
+.load:
+beq s3, s4, .check
+jal uart_read_word
+sw a0, 0(s3)
+add s5, s5, a0
+addi s3, s3, 4
+j .load
+
+.check:
+jal uart_read_word
+bne a0, s5, .bad
+
+li a0, 'O'
+jal uart_print_char
+li t0, IRAM_BASE
+jr t0
+
+.bad:
+li a0, 'E'
+jal uart_print_char
+j .sync
+
+# returns byte in a0
+.globl uart_read_char
+uart_read_char:
+li a1, 0x10000000
+
+# wait until status bit 1 (rx ready) is set
+.wait_rx:
+lb t1, 0(a1)
+andi t1, t1, 2
+beqz t1, .wait_rx
+
+lbu a0, 4(a1)
+jr ra
+
+# returns little endian word in a0
+uart_read_word:
+addi sp, sp, -8
+sw ra, 0(sp)
+sw s6, 4(sp)
+
+li s6, 0
+li t2, 0
+.word_loop:
+jal uart_read_char
+sll a0, a0, t2
+or s6, s6, a0
+addi t2, t2, 8
+li t0, 32
+bne t2, t0, .word_loop
+
+mv a0, s6
+lw s6, 4(sp)
+lw ra, 0(sp)
+addi sp, sp, 8
+jr ra
+
+magic:
+.ascii "BOOT"
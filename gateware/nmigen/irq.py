@@ -0,0 +1,108 @@
+from nmigen import *
+from wb import WishboneBus
+from simtest import sim_test
+
+# Register offsets.
+IRQ_PENDING = 0x0
+IRQ_ENABLE = 0x4
+
+
+class WishboneIRQController(Elaboratable):
+    """
+        Collects peripheral interrupts into the one line a core has.
+
+        Bit ``i`` of ``IRQ_PENDING`` is set while ``sources[i]`` is high
+        and stays set until firmware writes a 1 to it, so short pulses are
+        not lost and level sources that are still active come straight
+        back. ``irq`` is raised while any pending source is enabled in
+        ``IRQ_ENABLE``.
+
+    Parameters
+    ----------
+    sources : list of Signal
+        One bit each, in pending bit order.
+    """
+    def __init__(self, sources):
+        self.sources = sources
+
+        self.bus = WishboneBus()
+        self.pending = Signal(len(sources))
+        self.enable = Signal(len(sources))
+        self.irq = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+
+        clear = Signal.like(self.pending)
+        m.d.sync += self.pending.eq((self.pending & ~clear) | Cat(*self.sources))
+        m.d.comb += self.irq.eq((self.pending & self.enable).any())
+
+        with m.If(bus.cyc & ~bus.ack):
+            with m.Switch(bus.addr[:3]):
+                with m.Case(IRQ_PENDING):
+                    m.d.sync += bus.r_dat.eq(self.pending)
+                    with m.If(bus.we):
+                        m.d.comb += clear.eq(bus.w_dat)
+                with m.Case(IRQ_ENABLE):
+                    m.d.sync += bus.r_dat.eq(self.enable)
+                    with m.If(bus.we):
+                        m.d.sync += self.enable.eq(bus.w_dat)
+        m.d.sync += bus.ack.eq(bus.cyc & ~bus.ack)
+
+        return m
+
+
+@sim_test()
+def sim_irq():
+    from nmigen.back.pysim import Simulator
+
+    level = Signal()
+    pulse = Signal()
+    irqc = WishboneIRQController([level, pulse])
+    bus = irqc.bus
+
+    def access(addr, we=0, data=0):
+        yield bus.addr.eq(addr)
+        yield bus.we.eq(we)
+        yield bus.w_dat.eq(data)
+        yield bus.cyc.eq(1)
+        yield
+        while not (yield bus.ack):
+            yield
+        result = yield bus.r_dat
+        yield bus.cyc.eq(0)
+        yield
+        return result
+
+    def proc():
+        yield pulse.eq(1)
+        yield
+        yield pulse.eq(0)
+        yield
+        # Latched, but masked.
+        assert (yield from access(IRQ_PENDING)) == 0b10
+        assert not (yield irqc.irq)
+
+        yield from access(IRQ_ENABLE, 1, 0b11)
+        assert (yield irqc.irq)
+        yield from access(IRQ_PENDING, 1, 0b10)
+        assert (yield from access(IRQ_PENDING)) == 0
+        assert not (yield irqc.irq)
+
+        # A level source can't be cleared while it is active.
+        yield level.eq(1)
+        yield
+        yield
+        yield from access(IRQ_PENDING, 1, 0b01)
+        assert (yield from access(IRQ_PENDING)) == 0b01
+        yield level.eq(0)
+        yield from access(IRQ_PENDING, 1, 0b01)
+        assert (yield from access(IRQ_PENDING)) == 0
+        assert not (yield irqc.irq)
+
+    sim = Simulator(irqc)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
@@ -50,10 +50,11 @@ class N64Platform(LatticeICE40Platform):
             Clock(25e6), Attrs(GLOBAL=True, IO_STANDARD="SB_LVCMOS")
         ),
 
-        Resource("sck", 0, Pins("67", dir="o")),
-        Resource("do", 0, Pins("68", dir="o")),
-        Resource("di", 0, Pins("70", dir="o")),
-        Resource("cs", 0, Pins("71", dir="o")),
+        # The configuration flash, pins as in gateware/litex.
+        *SPIFlashResources(0,
+            cs="71", clk="70", mosi="67", miso="68", wp="62", hold="61",
+            attrs=Attrs(IO_STANDARD="SB_LVCMOS")
+        ),
 
         #Resource("extra_io", 0, Pins("37 38 39 41 42 43 44 45", dir="io")),
         Resource("io", 0, Pins("37", dir="io")),
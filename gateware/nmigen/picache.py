@@ -0,0 +1,523 @@
+from nmigen import *
+from wb import WishboneBus
+from sdram import SDRAMPort, CMD_READ, BURST_WORDS, ROW_WORDS
+from simtest import sim_test
+
+# Control register offsets, all read only. Writing anywhere flushes.
+PICACHE_HITS = 0x0
+PICACHE_MISSES = 0x4
+PICACHE_STALE = 0x8
+
+
+class PICache(Elaboratable):
+    """
+        Set associative, read only cache of ROM lines in front of the
+        SDRAM, for PI reads.
+
+        ``data`` is the word at ``addr`` (in words) a clock later. The PI
+        can't be held off, so a miss marks its line valid right away and
+        refills it while the console waits out the LAT time. The refill
+        starts at the missed word and reads to the end of the line, so
+        the console only waits for the first word wherever in the line a
+        DMA starts. The words before it follow in a second, shorter read.
+        Victims are picked round robin within each set.
+
+        With ``prefetch``, a miss reads the next line in the same burst
+        too, unless it is in the next SDRAM row, and once that line is read
+        the one after it is fetched. Neighbouring lines sit in different
+        sets, so the console drains one while the other fills, and
+        sequential reads don't wait on the SDRAM when they cross into the
+        next line. A miss while a prefetch is still coming in drops the
+        prefetched line, or the line whose first words are still to come,
+        and sends its own read at once.
+
+        ``ready`` is ``hit`` a clock later, unless ``data`` was served
+        before the refill got to it. Every ``read`` without it is counted
+        in ``stale``.
+
+        A lookup is counted when ``addr`` moves to another line and on
+        every ``access``, so repeated DMAs of the same region show up as
+        hits. ``ctrl`` exposes the counters; writing to it invalidates
+        every line, e.g. after loading a new ROM. So does ``invalidate``,
+        for when something else writes to the SDRAM. ``written`` only
+        drops the lines in the burst at ``written_addr``, for writes of a
+        single one like those of SaveMemory.
+
+    Parameters
+    ----------
+    ways : int
+        Lines per set, a power of two.
+    line_words : int
+        Words per line, a power of two from 4 up to ``BURST_WORDS``.
+    depth : int
+        Words of block RAM, a multiple of ``ways * line_words``.
+    prefetch : bool
+        Fetch the line after the one being read. Needs at least two sets
+        and two lines to a burst.
+    """
+    def __init__(self, ways=2, line_words=64, depth=256, addr_width=25, prefetch=True):
+        assert ways & (ways - 1) == 0
+        assert line_words & (line_words - 1) == 0 and 4 <= line_words <= BURST_WORDS
+        assert depth % (ways * line_words) == 0
+
+        self.ways = ways
+        self.line_words = line_words
+        self.sets = depth // (ways * line_words)
+        assert self.sets & (self.sets - 1) == 0
+        assert not prefetch or (self.sets > 1 and 2 * line_words <= BURST_WORDS)
+        self.prefetch = prefetch
+        self.buffer = Memory(width=16, depth=depth)
+
+        self.addr = Signal(addr_width)
+        self.data = Signal(16)
+        self.access = Signal()
+        self.invalidate = Signal()
+        self.written = Signal()
+        self.written_addr = Signal(addr_width)
+        self.hit = Signal()
+        self.read = Signal()
+        self.ready = Signal()
+
+        self.port = SDRAMPort(addr_width)
+        self.ctrl = WishboneBus()
+
+        self.hits = Signal(32)
+        self.misses = Signal(32)
+        self.stale = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        port = self.port
+        ctrl = self.ctrl
+
+        offset_bits = (self.line_words - 1).bit_length()
+        set_bits = (self.sets - 1).bit_length()
+        way_bits = (self.ways - 1).bit_length()
+        lines = self.ways * self.sets
+
+        offset = self.addr[:offset_bits]
+        index = self.addr[offset_bits:offset_bits + set_bits]
+        tag = self.addr[offset_bits + set_bits:]
+        line = self.addr[offset_bits:]
+
+        tags = Array(Signal.like(tag) for _ in range(lines))
+        valid = Signal(lines)
+        victims = Array(Signal(way_bits) for _ in range(self.sets))
+
+        m.submodules.buffer_r = buffer_r = self.buffer.read_port()
+        m.submodules.buffer_w = buffer_w = self.buffer.write_port()
+
+        # Lines are numbered way first, so a set is contiguous.
+        way = Signal(way_bits)
+        for w in reversed(range(self.ways)):
+            n = Cat(Const(w, way_bits), index)
+            with m.If(valid.bit_select(n, 1) & (tags[n] == tag)):
+                m.d.comb += [
+                    self.hit.eq(1),
+                    way.eq(w),
+                ]
+
+        next_line = Signal.like(line)
+        next_index = next_line[:set_bits]
+        next_tag = next_line[set_bits:]
+        next_hit = Signal()
+        m.d.comb += next_line.eq(line + 1)
+        for w in range(self.ways):
+            n = Cat(Const(w, way_bits), next_index)
+            with m.If(valid.bit_select(n, 1) & (tags[n] == next_tag)):
+                m.d.comb += next_hit.eq(1)
+
+        m.d.comb += [
+            buffer_r.addr.eq(Cat(offset, way, index)),
+            self.data.eq(buffer_r.data),
+        ]
+
+        last_line = Signal.like(line)
+        m.d.sync += last_line.eq(line)
+        with m.If(self.access | (line != last_line)):
+            with m.If(self.hit):
+                m.d.sync += self.hits.eq(self.hits + 1)
+            with m.Else():
+                m.d.sync += self.misses.eq(self.misses + 1)
+
+        flush = Signal()
+        fill_way = Signal(way_bits)
+        fill_index = Signal(set_bits)
+        fill_line = Signal.like(line)
+        # A miss rather than a prefetch.
+        fill_demand = Signal()
+        # Second line of a burst, kept when ``fill_next`` is set.
+        fill_next = Signal()
+        fill_next_way = Signal(way_bits)
+        fill_next_index = Signal(set_bits)
+        # The missed word the first read starts at, and whether the second
+        # one, of the words before it, is under way.
+        fill_start = Signal(offset_bits)
+        fill_head = Signal()
+        fill_end = Signal(range(2 * self.line_words + 1))
+        m.d.comb += fill_end.eq(Mux(fill_head, fill_start,
+            Mux(fill_next, 2 * self.line_words, self.line_words)))
+        # Position of the next word in the line, or past it in the next
+        # one, and words of a dropped read still to come before it.
+        count = Signal(range(2 * self.line_words + 1))
+        drop = Signal(range(2 * self.line_words + 1))
+        second = count >= self.line_words
+
+        # Bursts wrap around within a row, so the second line has to be in
+        # the same one.
+        row_end = line[:(ROW_WORDS - 1).bit_length() - offset_bits].all()
+
+        m.d.comb += [
+            port.cmd.eq(CMD_READ),
+            port.addr.eq(Cat(Mux(fill_head, 0, fill_start), fill_line)),
+            port.rd_words.eq(fill_end - Mux(fill_head, 0, fill_start)),
+            buffer_w.addr.eq(Mux(second,
+                Cat(count[:offset_bits], fill_next_way, fill_next_index),
+                Cat(count[:offset_bits], fill_way, fill_index))),
+            buffer_w.data.eq(port.rd_data),
+        ]
+
+        def claim(index, tag):
+            victim = victims[index]
+            n = Cat(victim, index)
+            m.d.sync += [
+                tags[n].eq(tag),
+                valid.bit_select(n, 1).eq(1),
+                victim.eq(victim + 1),
+            ]
+            return victim
+
+        def fill(line, index, tag, demand, start=0):
+            m.d.sync += [
+                fill_way.eq(claim(index, tag)),
+                fill_index.eq(index),
+                fill_line.eq(line),
+                fill_demand.eq(demand),
+                fill_next.eq(0),
+                fill_start.eq(start),
+                fill_head.eq(0),
+                count.eq(start),
+            ]
+            m.next = "CMD"
+
+        def miss():
+            fill(line, index, tag, 1, offset)
+            # The next line comes in the same burst, by the time it is
+            # read a prefetch couldn't have caught up.
+            if self.prefetch:
+                with m.If(~next_hit & ~row_end):
+                    m.d.sync += [
+                        fill_next_way.eq(claim(next_index, next_tag)),
+                        fill_next_index.eq(next_index),
+                        fill_next.eq(1),
+                    ]
+
+        with m.FSM() as fsm:
+            with m.State("IDLE"):
+                with m.If(~self.hit & ~flush):
+                    miss()
+                if self.prefetch:
+                    with m.Elif(~next_hit & ~flush):
+                        fill(next_line, next_index, next_tag, 0)
+
+            with m.State("CMD"):
+                m.d.comb += [
+                    port.req.eq(1),
+                    port.cmd_en.eq(1),
+                ]
+                with m.If(port.cmd_rdy):
+                    m.next = "FILL"
+
+            with m.State("FILL"):
+                m.d.comb += [
+                    port.req.eq(1),
+                    port.rd_en.eq(1),
+                ]
+                popped = Signal()
+                m.d.comb += popped.eq(port.rd_rdy)
+                with m.If(popped):
+                    with m.If(drop != 0):
+                        m.d.sync += drop.eq(drop - 1)
+                    with m.Else():
+                        m.d.comb += buffer_w.en.eq(1)
+                        m.d.sync += count.eq(count + 1)
+                        with m.If(count == fill_end - 1):
+                            with m.If(~fill_head & (fill_start != 0)):
+                                m.d.sync += [
+                                    fill_head.eq(1),
+                                    count.eq(0),
+                                ]
+                                m.next = "CMD"
+                            with m.Else():
+                                m.next = "IDLE"
+
+                # Neither a prefetch nor the words before a missed one are
+                # waited for, their line is dropped instead. Both fill a
+                # single line.
+                with m.If((~fill_demand | fill_head) & ~self.hit & ~flush):
+                    m.d.sync += [
+                        valid.bit_select(Cat(fill_way, fill_index), 1).eq(0),
+                        drop.eq(fill_end - count - popped),
+                    ]
+                    miss()
+
+        # Whether the word at ``addr`` has been written yet, when its line
+        # is the one being filled.
+        pos = Signal(range(2 * self.line_words))
+        pending = Signal()
+        with m.If(line == fill_line):
+            m.d.comb += [
+                pos.eq(offset),
+                pending.eq(1),
+            ]
+        with m.Elif(fill_next & (line == fill_line + 1)):
+            m.d.comb += [
+                pos.eq(offset + self.line_words),
+                pending.eq(1),
+            ]
+        written = Mux(fill_head, (pos < count) | (pos >= fill_start),
+            (pos >= fill_start) & (pos < count))
+        filling = fsm.ongoing("CMD") | fsm.ongoing("FILL")
+        m.d.sync += self.ready.eq(self.hit & ~(filling & pending & ~written))
+        with m.If(self.read & ~self.ready):
+            m.d.sync += self.stale.eq(self.stale + 1)
+
+        # Control
+        with m.If(ctrl.cyc & ~ctrl.ack):
+            with m.Switch(ctrl.addr[:4]):
+                with m.Case(PICACHE_HITS):
+                    m.d.sync += ctrl.r_dat.eq(self.hits)
+                with m.Case(PICACHE_MISSES):
+                    m.d.sync += ctrl.r_dat.eq(self.misses)
+                with m.Case(PICACHE_STALE):
+                    m.d.sync += ctrl.r_dat.eq(self.stale)
+        m.d.sync += ctrl.ack.eq(ctrl.cyc & ~ctrl.ack)
+        m.d.comb += flush.eq((ctrl.cyc & ctrl.we & ~ctrl.ack) | self.invalidate)
+        burst_bits = (BURST_WORDS - 1).bit_length()
+        with m.If(self.written):
+            for n in range(lines):
+                line_addr = Cat(Const(n >> way_bits, set_bits), tags[n])
+                with m.If(line_addr[burst_bits - offset_bits:] == self.written_addr[burst_bits:]):
+                    m.d.sync += valid.bit_select(n, 1).eq(0)
+        with m.If(flush):
+            m.d.sync += valid.eq(0)
+
+        return m
+
+
+@sim_test()
+def sim_picache():
+    """ Two ways of two sets of 16 words, against a model of the SDRAM
+    port where each word holds its own address. """
+    from nmigen.back.pysim import Simulator, Passive
+
+    cache = PICache(ways=2, line_words=16, depth=64, prefetch=False)
+    port = cache.port
+    bursts = []
+
+    def sdram():
+        yield Passive()
+        while True:
+            yield port.cmd_rdy.eq(1)
+            yield
+            if not (yield port.cmd_en):
+                continue
+            addr = yield port.addr
+            words = (yield port.rd_words) or BURST_WORDS
+            bursts.append((addr, words))
+            yield port.cmd_rdy.eq(0)
+            yield port.rd_rdy.eq(1)
+            i = 0
+            while i < words:
+                yield port.rd_data.eq((addr + i) & 0xffff)
+                yield
+                if (yield port.rd_en):
+                    i += 1
+            yield port.rd_rdy.eq(0)
+
+    def read(addr):
+        yield cache.addr.eq(addr)
+        yield
+        # Wait out a refill of the line.
+        while (yield port.req) or not (yield cache.hit):
+            yield
+        yield
+        yield
+        return (yield cache.data)
+
+    def proc():
+        # A, then C and E in the same set, B in the other one.
+        a, b, c, e = 0x100, 0x210, 0x320, 0x440
+        assert (yield from read(a + 5)) == a + 5
+        assert (yield from read(a + 6)) == a + 6
+        assert (yield from read(b)) == b
+        assert (yield from read(c + 15)) == c + 15
+        assert (yield from read(a)) == a
+        # Misses start at their word, the words before it come next.
+        assert bursts == [(0, 16), (a + 5, 11), (a, 5), (b, 16), (c + 15, 1), (c, 15)]
+
+        # E evicts A, the oldest in its set.
+        assert (yield from read(e)) == e
+        assert (yield from read(c)) == c
+        assert (yield from read(a)) == a
+        assert [addr for addr, _ in bursts[6:]] == [e, a]
+
+        # Line 0, fetched out of reset, is never looked up. The second
+        # read of A stays in the line, so only 7 lookups are counted.
+        assert (yield cache.hits) == 2
+        assert (yield cache.misses) == 5
+
+        # A DMA counts as a lookup even in the same line.
+        yield cache.access.eq(1)
+        yield
+        yield cache.access.eq(0)
+        yield
+        yield
+        assert (yield cache.hits) == 3
+
+        # Writing to ctrl flushes.
+        yield cache.ctrl.cyc.eq(1)
+        yield cache.ctrl.we.eq(1)
+        yield
+        yield cache.ctrl.cyc.eq(0)
+        yield cache.ctrl.we.eq(0)
+        assert (yield from read(a)) == a
+        assert [addr for addr, _ in bursts[6:]] == [e, a, a]
+
+        # A write to the burst holding A drops only A.
+        assert (yield from read(c)) == c
+        yield cache.written_addr.eq(a & ~(BURST_WORDS - 1))
+        yield cache.written.eq(1)
+        yield
+        yield cache.written.eq(0)
+        assert (yield from read(c)) == c
+        assert (yield from read(a)) == a
+        assert [addr for addr, _ in bursts[9:]] == [c, a]
+
+    sim = Simulator(cache)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(sdram)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+@sim_test(case=["prefetch", "no_prefetch", "jump", "row_end", "line_end"])
+def sim_prefetch(case):
+    """ Sequential reads at PI pace across several lines, through the
+    crossing to a model of the controller at twice the clock, where
+    commands run into a refresh whenever one is due. With prefetch no read finds its
+    word missing, without it each missing word is counted as stale. For
+    ``jump`` a second DMA starts elsewhere right as the first one's
+    prefetch goes out. Its read goes out at once, but the prefetched words
+    still pass through at a word per clock, so its first two words are
+    stale. For ``row_end`` the first miss is in the last line of a row,
+    where a burst would wrap around to the start of the row. For
+    ``line_end`` it is in the last words of a line, which come first. """
+    from nmigen.back.pysim import Simulator, Passive
+    from sdram import SDRAMController, SDRAMCrossing
+
+    # Clocks per word, about twice as fast as the PI at 50 MHz.
+    pace = 8
+    # LAT of domain 1, in clocks at 50 MHz.
+    lat = 52
+    # Activate and CAS latency, after a refresh every tREF/8192.
+    latency = 3 + 3
+    t_refresh = 780
+    t_rc = 10
+
+    ctrl = SDRAMController(100e6)
+    xing = SDRAMCrossing(ctrl, sdram_domain="sdram")
+    cache = PICache(prefetch=case != "no_prefetch")
+
+    m = Module()
+    m.domains.sdram = ClockDomain("sdram")
+    m.submodules.xing = xing
+    m.submodules.cache = cache
+    m.d.comb += cache.port.connect_to(xing.port)
+
+    def controller():
+        yield Passive()
+        since = t_refresh
+        while True:
+            cmd = yield ctrl.cmd
+            if not cmd:
+                yield ctrl.cmd_ack.eq(0)
+                yield
+                since += 1
+                continue
+            addr = yield ctrl.addr
+            words = (yield ctrl.rd_words) or BURST_WORDS
+            wait = latency
+            if since >= t_refresh:
+                wait += t_rc
+                since = 0
+            since += wait + words + 2
+            for _ in range(wait):
+                yield
+            yield ctrl.cmd_ack.eq(cmd)
+            yield
+            yield ctrl.rd_valid.eq(1)
+            yield
+            row = addr & ~(ROW_WORDS - 1)
+            for i in range(words):
+                col = (addr + i) & (ROW_WORDS - 1)
+                yield ctrl.data_in.eq((row | col) & 0xffff)
+                if i == words - 1:
+                    yield ctrl.rd_valid.eq(0)
+                yield
+
+    def dma(start, words):
+        missing = 0
+        # The console waits out the LAT time after the address.
+        yield cache.addr.eq(start)
+        yield cache.access.eq(1)
+        yield
+        yield cache.access.eq(0)
+        for _ in range(lat):
+            yield
+
+        for addr in range(start, start + words):
+            yield cache.addr.eq(addr)
+            for _ in range(pace - 1):
+                yield
+            yield cache.read.eq(1)
+            if (yield cache.data) != addr & 0xffff:
+                missing += 1
+            yield
+            yield cache.read.eq(0)
+        return missing
+
+    def proc():
+        # Let the fills of address 0 out of reset finish.
+        for _ in range(BURST_WORDS * 2):
+            yield
+
+        line = cache.line_words
+        if case == "jump":
+            # Ends on the first word of the third line, which sends the
+            # prefetch of the fourth.
+            missing = yield from dma(0x1008, 3 * line - 8 + 1)
+            assert missing == 0
+            missing = yield from dma(0x3000, 2 * line)
+            assert missing == 2
+        elif case == "row_end":
+            missing = yield from dma(0x1400 - line + 8, 4 * line)
+            assert missing == 0
+        elif case == "line_end":
+            missing = yield from dma(0x1000 + line - 3, 4 * line)
+            assert missing == 0
+        else:
+            missing = yield from dma(0x1008, 4 * line)
+            assert (missing == 0) == (case == "prefetch")
+
+        for _ in range(4):
+            yield
+        assert (yield cache.stale) == missing
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_clock(0.5e-6, domain="sdram")
+    sim.add_sync_process(controller, domain="sdram")
+    sim.add_sync_process(proc)
+    sim.run()
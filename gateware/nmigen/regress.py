@@ -0,0 +1,198 @@
+"""
+Runs every simulation test in the gateware in parallel.
+
+Tests are plain functions marked with ``@sim_test(...)`` from simtest.py,
+in any module of this directory or of scripts/. Each keyword argument of
+the decorator is a list of values and the test runs once per combination. A test fails by
+raising ``AssertionError`` and can skip itself with ``unittest.SkipTest``.
+
+    python regress.py                    # everything, one process per core
+    python regress.py -k uart -j 4
+    python regress.py --json results.json --junit results.xml
+"""
+
+import concurrent.futures
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import subprocess
+import time
+import traceback
+import unittest
+from xml.etree import ElementTree
+
+from simtest import sim_test, WITH_SDRAM
+
+
+def gateware_dir():
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def sim_verilog(sys_clk, with_sdram):
+    """ Verilog for CartSim, cached under build/cache/ between runs. """
+    from build_cache import cached_verilog
+    from top import CartSim
+
+    text = cached_verilog(lambda: CartSim(sys_clk=sys_clk, with_sdram=with_sdram))
+    key = hashlib.sha256(text.encode()).hexdigest()[:16]
+    path = os.path.join("build", "regress", "cart-sim-{}.v".format(key))
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+    return path
+
+
+def require_tool(name):
+    from shutil import which
+    if which(name) is None:
+        raise unittest.SkipTest("{} not found".format(name))
+
+
+@sim_test(with_sdram=WITH_SDRAM)
+def sim_iverilog(with_sdram):
+    """ verilog/cart_tb.v under iverilog; the Micron model reports timing
+    violations as ERROR lines. """
+    require_tool("iverilog")
+    require_tool("yosys")
+
+    v = sim_verilog(0.5, with_sdram)
+    out = os.path.join("build", "regress", "cart_tb-{}".format(os.path.basename(v)[:-2]))
+    flags = ["-DIVERILOG", "-Isdram", "-Iserv/rtl", "-Dden512Mb", "-Dsg67", "-Dx16"]
+    sources = ["verilog/cart_tb.v", v]
+    if with_sdram:
+        flags.append("-DWITH_SDRAM")
+        sources.append("sdram/sdr.v")
+
+    from sim_cxxrtl import SERV_V_FILES
+    subprocess.check_call(["iverilog", "-o", out, *flags, *sources, *SERV_V_FILES])
+    log = subprocess.check_output([os.path.abspath(out)], cwd=os.path.dirname(out)).decode()
+    errors = [line for line in log.splitlines() if "ERROR" in line]
+    assert not errors, "\n".join(errors)
+
+
+@sim_test()
+def sim_cxxrtl():
+    require_tool("yosys")
+
+    from sim_cxxrtl import build, CxxrtlSim
+    with CxxrtlSim(build()) as sim:
+        sim.run(10000)
+
+
+def test_modules():
+    """ Modules of this directory, and those in scripts/ with tests. The
+    scripts are standalone tools, some needing packages the gateware
+    doesn't, so only those that mark tests are imported. """
+    names = []
+    for name in sorted(os.listdir(gateware_dir())):
+        if name.endswith(".py"):
+            names.append(name[:-3])
+    scripts = os.path.join(gateware_dir(), "scripts")
+    for name in sorted(os.listdir(scripts)):
+        if name.endswith(".py"):
+            with open(os.path.join(scripts, name)) as f:
+                if "@sim_test" in f.read():
+                    names.append("scripts." + name[:-3])
+    return names
+
+
+def discover(pattern=None):
+    """ Returns ``(module, function, params)`` for every test case. """
+    cases = []
+    for module_name in test_modules():
+        module = importlib.import_module(module_name)
+        for attr in dir(module):
+            fn = getattr(module, attr)
+            params = getattr(fn, "sim_test_params", None)
+            if params is None or fn.__module__ != module_name:
+                continue
+            keys = sorted(params)
+            for values in itertools.product(*(params[k] for k in keys)):
+                case = (module_name, attr, dict(zip(keys, values)))
+                if pattern is None or pattern in case_name(*case):
+                    cases.append(case)
+    return cases
+
+
+def case_name(module, function, params):
+    args = ",".join("{}={}".format(k, v) for k, v in sorted(params.items()))
+    return "{}.{}[{}]".format(module, function, args)
+
+
+def run_case(module, function, params):
+    os.chdir(gateware_dir())
+    result = dict(name=case_name(module, function, params), status="passed", message="")
+    start = time.perf_counter()
+    try:
+        getattr(importlib.import_module(module), function)(**params)
+    except unittest.SkipTest as e:
+        result.update(status="skipped", message=str(e))
+    except AssertionError:
+        result.update(status="failed", message=traceback.format_exc())
+    except Exception:
+        result.update(status="error", message=traceback.format_exc())
+    result["time"] = time.perf_counter() - start
+    return result
+
+
+def write_junit(results, path):
+    suite = ElementTree.Element("testsuite", name="gateware",
+        tests=str(len(results)),
+        failures=str(sum(r["status"] == "failed" for r in results)),
+        errors=str(sum(r["status"] == "error" for r in results)),
+        skipped=str(sum(r["status"] == "skipped" for r in results)))
+    for r in results:
+        classname, name = r["name"].split(".", 1)
+        case = ElementTree.SubElement(suite, "testcase",
+            classname=classname, name=name, time="{:.3f}".format(r["time"]))
+        if r["status"] == "failed":
+            ElementTree.SubElement(case, "failure").text = r["message"]
+        elif r["status"] == "error":
+            ElementTree.SubElement(case, "error").text = r["message"]
+        elif r["status"] == "skipped":
+            ElementTree.SubElement(case, "skipped", message=r["message"])
+    ElementTree.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", dest="pattern", default=None, help="only run tests containing this")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--json", default=None)
+    parser.add_argument("--junit", default=None)
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args()
+
+    os.chdir(gateware_dir())
+    cases = discover(args.pattern)
+    if args.list:
+        for case in cases:
+            print(case_name(*case))
+        sys.exit(0)
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_case, *case) for case in cases]
+        for future in concurrent.futures.as_completed(futures):
+            r = future.result()
+            results.append(r)
+            print("{:8s} {:7.2f}s {}".format(r["status"].upper(), r["time"], r["name"]))
+            if r["status"] in ("failed", "error"):
+                print(r["message"])
+
+    results.sort(key=lambda r: r["name"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.junit:
+        write_junit(results, args.junit)
+
+    counts = {s: sum(r["status"] == s for r in results) for s in ("passed", "failed", "error", "skipped")}
+    print(", ".join("{} {}".format(n, s) for s, n in counts.items()))
+    sys.exit(1 if counts["failed"] or counts["error"] else 0)
@@ -0,0 +1,480 @@
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
+from sdram import SDRAMPort, CMD_READ, CMD_WRITE, BURST_WORDS
+from simtest import sim_test
+
+# Save types, what the cart answers in domain 2.
+SAVE_NONE = 0
+SAVE_SRAM = 1
+SAVE_FLASH = 2
+
+# Words of SDRAM kept for saves, enough for 128KB of FlashRAM or three
+# 32KB SRAM banks. They sit at the top, past the largest ROMs but one.
+SAVE_WORDS = 2 ** 16
+
+# Clocks without writes before a dirty page goes back to SDRAM.
+SAVE_IDLE = 4096
+
+# FlashRAM commands, top byte of a 32 bit write to FLASH_CMD_ADDR.
+FLASH_CMD_ADDR = 0x10000
+FLASH_CHIP_ERASE = 0x3c
+FLASH_SECTOR_ERASE = 0x4b
+FLASH_EXECUTE_ERASE = 0x78
+FLASH_PROGRAM = 0xa5
+FLASH_PAGE_PROGRAM = 0xb4
+FLASH_STATUS = 0xd2
+FLASH_ID = 0xe1
+FLASH_READ_ARRAY = 0xf0
+
+# Status bits, in the low byte of the first word read in status mode.
+FLASH_WRITE_BUSY = 1 << 0
+FLASH_ERASE_BUSY = 1 << 1
+FLASH_WRITE_OK = 1 << 2
+FLASH_ERASE_OK = 1 << 3
+
+# What reads return in ID mode, a Macronix MX29L1100.
+FLASH_SILICON_ID = 0x1111800100c2001e
+
+# Programmed a 128 byte page at a time, erased by 16KB sectors.
+FLASH_PAGE_WORDS = 64
+FLASH_SECTOR_PAGES = 128
+
+
+class SaveMemory(Elaboratable):
+    """
+        Cartridge save memory in domain 2, kept in SDRAM.
+
+        Cart forwards its PI address and the strobes of accesses while
+        ``addr`` is in domain 2. Writes to the memory go into a queue right
+        away, so the console can write at full speed, and are applied to
+        ``stage``, a copy of one SDRAM burst. Writing outside it puts the
+        staged page back first and loads the new one, the queue covers the
+        writes arriving meanwhile. A dirty page is also put back after
+        ``SAVE_IDLE`` clocks without writes, so SDRAM holds the whole save.
+
+        Reads of the staged page are answered from it, ``hit`` says so.
+        Otherwise ``sdram_addr`` is the word to read from SDRAM. ``written``
+        pulses when a page was put back to the burst at ``written_addr``,
+        anything caching SDRAM has to drop what it holds of it. Reads
+        don't see writes still in the queue.
+
+        With ``SAVE_FLASH``, writes to ``FLASH_CMD_ADDR`` are FlashRAM
+        commands. Programming and erasing go through the same queue, the
+        status says busy until they are done.
+
+        ``overflow`` is set when a console write found the queue full and
+        was dropped, until ``clear`` pulses.
+
+    Parameters
+    ----------
+    base : int
+        First SDRAM word of the save area, the top ``SAVE_WORDS`` by
+        default.
+    depth : int
+        Writes the queue holds.
+    """
+    def __init__(self, addr_width=25, base=None, depth=128):
+        self.base = 2 ** addr_width - SAVE_WORDS if base is None else base
+        self.depth = depth
+        self.stage = Memory(width=16, depth=BURST_WORDS)
+        self.page_buffer = Memory(width=16, depth=FLASH_PAGE_WORDS)
+
+        self.save_type = Signal(2)
+        self.addr = Signal(32)
+        self.start = Signal()
+        self.read = Signal()
+        self.write = Signal()
+        self.w_data = Signal(16)
+
+        self.hit = Signal()
+        self.data = Signal(16)
+        self.sdram_addr = Signal(addr_width)
+
+        self.port = SDRAMPort(addr_width)
+        self.written = Signal()
+        self.written_addr = Signal(addr_width)
+
+        self.overflow = Signal()
+        self.clear = Signal()
+
+        self.flash_mode = Signal(8, reset=FLASH_READ_ARRAY)
+        self.flash_status = Signal(8)
+        self.busy = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        port = self.port
+        addr = self.addr
+        flash = self.save_type == SAVE_FLASH
+
+        # Word in the save area. FlashRAM reads twice the address, SRAM
+        # banks are 256KB apart.
+        offset = Signal(16)
+        with m.If(self.start):
+            m.d.sync += offset.eq(Mux(flash, addr[:16], Cat(addr[1:15], addr[18:20])))
+        with m.Elif(self.read | self.write):
+            m.d.sync += offset.eq(offset + 1)
+        m.d.comb += self.sdram_addr.eq(self.base + offset)
+
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=32, depth=self.depth)
+        m.submodules.stage_r = stage_r = self.stage.read_port()
+        m.submodules.stage_wb = stage_wb = self.stage.read_port()
+        m.submodules.stage_w = stage_w = self.stage.write_port()
+        m.submodules.page_r = page_r = self.page_buffer.read_port()
+        m.submodules.page_w = page_w = self.page_buffer.write_port()
+
+        stage_page = Signal(8)
+        stage_valid = Signal()
+        dirty = Signal()
+
+        # Reads.
+        flash_words = Signal(64)
+        with m.If(self.flash_mode == FLASH_ID):
+            m.d.comb += flash_words.eq(FLASH_SILICON_ID)
+        with m.Else():
+            m.d.comb += flash_words.eq(Cat(Const(FLASH_SILICON_ID & 0xffffffff, 32),
+                self.flash_status, Const(FLASH_SILICON_ID >> 40, 24)))
+
+        m.d.comb += stage_r.addr.eq(offset[:8])
+        with m.If(flash & (self.flash_mode != FLASH_READ_ARRAY)):
+            m.d.comb += [
+                self.hit.eq(1),
+                self.data.eq(flash_words.word_select(~addr[1:3], 16)),
+            ]
+        with m.Else():
+            m.d.comb += [
+                self.hit.eq(stage_valid & (offset[8:] == stage_page)),
+                self.data.eq(stage_r.data),
+            ]
+
+        # Writes, from the console or from programming and erasing.
+        pi_push = Signal()
+        seq_offset = Signal(16)
+        seq_left = Signal(range(SAVE_WORDS + 1))
+        seq_erase = Signal()
+        seq_push = Signal()
+
+        m.d.comb += [
+            seq_push.eq((seq_left != 0) & ~pi_push & fifo.w_rdy),
+            fifo.w_en.eq(pi_push | seq_push),
+            # Programming and erasing cover whole pages, so between them
+            # the low bits of seq_offset are 0 and page_r starts at word 0.
+            page_r.addr.eq(Mux(seq_push, seq_offset[:6] + 1, seq_offset[:6])),
+            page_w.addr.eq(offset[:6]),
+            page_w.data.eq(self.w_data),
+        ]
+        with m.If(pi_push):
+            m.d.comb += fifo.w_data.eq(Cat(self.w_data, offset))
+        with m.Else():
+            m.d.comb += fifo.w_data.eq(Cat(Mux(seq_erase, 0xffff, page_r.data), seq_offset))
+        with m.If(seq_push):
+            m.d.sync += [
+                seq_offset.eq(seq_offset + 1),
+                seq_left.eq(seq_left - 1),
+            ]
+
+        command_hi = Signal(16)
+        erase_page = Signal(10)
+        erase_pages = Signal(range(SAVE_WORDS // FLASH_PAGE_WORDS + 1))
+
+        with m.If(self.write & ~flash):
+            m.d.comb += pi_push.eq(1)
+        # The console doesn't wait, a write to a full queue is lost.
+        with m.If(pi_push & ~fifo.w_rdy):
+            m.d.sync += self.overflow.eq(1)
+        with m.If(self.clear):
+            m.d.sync += self.overflow.eq(0)
+        with m.If(self.write & flash):
+            with m.If(addr[:17] == FLASH_CMD_ADDR):
+                m.d.sync += command_hi.eq(self.w_data)
+            with m.Elif(addr[:17] == FLASH_CMD_ADDR + 2):
+                page = self.w_data[:10]
+                with m.Switch(command_hi[8:]):
+                    with m.Case(FLASH_CHIP_ERASE):
+                        m.d.sync += [
+                            erase_page.eq(0),
+                            erase_pages.eq(SAVE_WORDS // FLASH_PAGE_WORDS),
+                        ]
+                    with m.Case(FLASH_SECTOR_ERASE):
+                        m.d.sync += [
+                            erase_page.eq(Cat(Const(0, 7), page[7:])),
+                            erase_pages.eq(FLASH_SECTOR_PAGES),
+                        ]
+                    with m.Case(FLASH_EXECUTE_ERASE):
+                        m.d.sync += [
+                            seq_offset.eq(erase_page << 6),
+                            seq_left.eq(erase_pages << 6),
+                            seq_erase.eq(1),
+                            self.flash_status.eq(FLASH_ERASE_BUSY),
+                        ]
+                    with m.Case(FLASH_PROGRAM):
+                        m.d.sync += [
+                            seq_offset.eq(page << 6),
+                            seq_left.eq(FLASH_PAGE_WORDS),
+                            seq_erase.eq(0),
+                            self.flash_status.eq(FLASH_WRITE_BUSY),
+                        ]
+                    with m.Case(FLASH_PAGE_PROGRAM, FLASH_STATUS, FLASH_ID, FLASH_READ_ARRAY):
+                        m.d.sync += self.flash_mode.eq(command_hi[8:])
+            with m.Elif(self.flash_mode == FLASH_PAGE_PROGRAM):
+                m.d.comb += page_w.en.eq(1)
+            with m.Elif(self.flash_mode == FLASH_STATUS):
+                m.d.sync += self.flash_status.eq(0)
+
+        # Done once the last write landed in the stage.
+        drain_idle = Signal()
+        m.d.comb += self.busy.eq((seq_left != 0) | (fifo.level != 0) | ~drain_idle)
+        with m.If(~self.busy & self.flash_status[0]):
+            m.d.sync += self.flash_status.eq(FLASH_WRITE_OK)
+        with m.If(~self.busy & self.flash_status[1]):
+            m.d.sync += self.flash_status.eq(FLASH_ERASE_OK)
+
+        # Queue to stage, and the stage to and from SDRAM.
+        entry_data = fifo.r_data[:16]
+        entry_offset = fifo.r_data[16:]
+        entry_page = entry_offset[8:]
+        load_page = Signal(8)
+        # 0 outside bursts, so stage_wb starts at word 0.
+        count = Signal(range(BURST_WORDS))
+        last_word = count == BURST_WORDS - 1
+        idle = Signal(range(SAVE_IDLE))
+
+        m.d.comb += [
+            self.written_addr.eq(self.base + Cat(Const(0, 8), stage_page)),
+            stage_wb.addr.eq(Mux(port.wr_en & port.wr_rdy, count + 1, count)),
+            port.wr_data.eq(stage_wb.data),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                m.d.comb += drain_idle.eq(1)
+                with m.If(fifo.r_rdy):
+                    m.d.sync += idle.eq(0)
+                    with m.If(stage_valid & (entry_page == stage_page)):
+                        m.d.comb += [
+                            stage_w.addr.eq(entry_offset[:8]),
+                            stage_w.data.eq(entry_data),
+                            stage_w.en.eq(1),
+                            fifo.r_en.eq(1),
+                        ]
+                        m.d.sync += dirty.eq(1)
+                    with m.Elif(dirty):
+                        m.next = "WB_FILL"
+                    with m.Else():
+                        m.d.sync += [
+                            load_page.eq(entry_page),
+                            stage_valid.eq(0),
+                        ]
+                        m.next = "LOAD_CMD"
+                with m.Elif(dirty):
+                    m.d.sync += idle.eq(idle + 1)
+                    with m.If(idle == SAVE_IDLE - 1):
+                        m.next = "WB_FILL"
+
+            with m.State("WB_FILL"):
+                m.d.comb += [
+                    port.req.eq(1),
+                    port.wr_en.eq(1),
+                ]
+                with m.If(port.wr_rdy):
+                    m.d.sync += count.eq(count + 1)
+                    with m.If(last_word):
+                        m.next = "WB_CMD"
+
+            with m.State("WB_CMD"):
+                m.d.comb += [
+                    port.req.eq(1),
+                    port.cmd.eq(CMD_WRITE),
+                    port.cmd_en.eq(1),
+                    port.addr.eq(self.written_addr),
+                ]
+                with m.If(port.cmd_rdy):
+                    m.d.comb += self.written.eq(1)
+                    m.d.sync += [
+                        dirty.eq(0),
+                        idle.eq(0),
+                    ]
+                    m.next = "IDLE"
+
+            with m.State("LOAD_CMD"):
+                m.d.comb += [
+                    port.req.eq(1),
+                    port.cmd.eq(CMD_READ),
+                    port.cmd_en.eq(1),
+                    port.addr.eq(self.base + Cat(Const(0, 8), load_page)),
+                ]
+                with m.If(port.cmd_rdy):
+                    m.next = "LOAD"
+
+            with m.State("LOAD"):
+                m.d.comb += [
+                    port.req.eq(1),
+                    port.rd_en.eq(1),
+                ]
+                with m.If(port.rd_rdy):
+                    m.d.comb += [
+                        stage_w.addr.eq(count),
+                        stage_w.data.eq(port.rd_data),
+                        stage_w.en.eq(1),
+                    ]
+                    m.d.sync += count.eq(count + 1)
+                    with m.If(last_word):
+                        m.d.sync += [
+                            stage_page.eq(load_page),
+                            stage_valid.eq(1),
+                        ]
+                        m.next = "IDLE"
+
+        return m
+
+
+@sim_test(save_type=["sram", "flash"])
+def sim_save(save_type):
+    """ Saves written and read back through Cart, against a model of the
+    SDRAM port. """
+    from nmigen.back.pysim import Simulator, Passive
+    from cart import Cart, CART_SAVE_TYPE, pi_address, pi_read, pi_write, bus_access
+
+    cart = Cart(50, pi_pwd=None, save=True)
+    save = cart.save
+    port = save.port
+    sdram = {}
+    written = []
+
+    def sdram_model():
+        yield Passive()
+        pending = []
+        yield port.wr_rdy.eq(1)
+        while True:
+            yield port.cmd_rdy.eq(1)
+            yield
+            if (yield port.wr_en):
+                pending.append((yield port.wr_data))
+            if not (yield port.cmd_en):
+                continue
+            addr = yield port.addr
+            if (yield port.cmd) == CMD_WRITE:
+                for i, word in enumerate(pending[:BURST_WORDS]):
+                    sdram[addr + i] = word
+                pending = pending[BURST_WORDS:]
+                written.append(addr - save.base)
+                continue
+            yield port.cmd_rdy.eq(0)
+            yield port.rd_rdy.eq(1)
+            i = 0
+            while i < BURST_WORDS:
+                yield port.rd_data.eq(sdram.get(addr + i, 0))
+                yield
+                if (yield port.rd_en):
+                    i += 1
+            yield port.rd_rdy.eq(0)
+
+    def rom(addr):
+        return sdram.get(addr >> 1 & (2 ** len(port.addr) - 1), 0)
+
+    def wait():
+        yield
+        while (yield save.busy):
+            yield
+
+    def command(word):
+        yield from pi_write(cart, 0x08010000, [word >> 16, word & 0xffff])
+
+    def status():
+        yield from command(FLASH_STATUS << 24)
+        return (yield from pi_read(cart, 0x08000000, 2, rom))
+
+    def proc():
+        # Nothing answers in domain 2 without a save type.
+        yield from pi_address(cart, 0x08000000)
+        yield cart.n64.read.eq(0)
+        for _ in range(8):
+            yield
+            assert not (yield cart.n64.ad_oe)
+        yield cart.n64.read.eq(1)
+
+        if save_type == "sram":
+            yield from bus_access(cart, CART_SAVE_TYPE, 1, SAVE_SRAM)
+
+            # Back to back, the first page loads meanwhile. The next
+            # ones put it back, the second bank is 256KB on.
+            first = [0x1000 + i for i in range(32)]
+            yield from pi_write(cart, 0x08000010, first, pace=2)
+            yield from pi_write(cart, 0x08000400, [0x2000, 0x2001])
+            yield from pi_write(cart, 0x08040000, [0x3000, 0x3001])
+            yield from wait()
+            assert written == [0x000, 0x200]
+            assert [sdram[save.base + 8 + i] for i in range(32)] == first
+
+            assert (yield from pi_read(cart, 0x0800000e, 34, rom)) == [0] + first + [0]
+            assert (yield from pi_read(cart, 0x08040000, 2, rom)) == [0x3000, 0x3001]
+
+            # Idle long enough, the last page goes back too.
+            for _ in range(SAVE_IDLE):
+                yield
+            assert written == [0x000, 0x200, 0x4000]
+            assert sdram[save.base + 0x4001] == 0x3001
+        else:
+            yield from bus_access(cart, CART_SAVE_TYPE, 1, SAVE_FLASH)
+
+            yield from command(FLASH_ID << 24)
+            ident = yield from pi_read(cart, 0x08000000, 4, rom)
+            assert ident == [FLASH_SILICON_ID >> (48 - 16 * i) & 0xffff for i in range(4)]
+
+            # Program the first page of the second sector.
+            page = [0x4000 + i for i in range(FLASH_PAGE_WORDS)]
+            yield from command(FLASH_PAGE_PROGRAM << 24)
+            yield from pi_write(cart, 0x08000000, page)
+            yield from command(FLASH_PROGRAM << 24 | FLASH_SECTOR_PAGES)
+            assert (yield from status())[1] & 0xff == FLASH_WRITE_BUSY
+            yield from wait()
+            assert (yield from status())[1] & 0xff == FLASH_WRITE_OK
+            yield from pi_write(cart, 0x08000000, [0, 0])
+            assert (yield from status())[1] & 0xff == 0
+
+            # Erase the first sector, from any page in it.
+            yield from command(FLASH_SECTOR_ERASE << 24 | 5)
+            yield from command(FLASH_EXECUTE_ERASE << 24)
+            assert (yield from status())[1] & 0xff == FLASH_ERASE_BUSY
+            yield from wait()
+            assert (yield from status())[1] & 0xff == FLASH_ERASE_OK
+
+            # Reads take twice the address.
+            yield from command(FLASH_READ_ARRAY << 24)
+            sector = FLASH_SECTOR_PAGES * FLASH_PAGE_WORDS
+            assert (yield from pi_read(cart, 0x08000000 + sector, len(page), rom)) == page
+            assert (yield from pi_read(cart, 0x08000000 + sector - 2, 2, rom)) == [0xffff] * 2
+            assert all(sdram[save.base + i] == 0xffff for i in range(sector - BURST_WORDS))
+
+    sim = Simulator(cart)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(sdram_model)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+@sim_test()
+def sim_save_overflow():
+    """ With SDRAM stalled, writes past a full queue set the overflow bit
+    in ``CART_SAVE_STATUS``. """
+    from nmigen.back.pysim import Simulator
+    from cart import Cart, CART_SAVE_TYPE, CART_SAVE_STATUS, pi_write, bus_access
+
+    cart = Cart(50, pi_pwd=None, save=True)
+    save = cart.save
+
+    def proc():
+        yield from bus_access(cart, CART_SAVE_TYPE, 1, SAVE_SRAM)
+        # The first write waits for its page to load, which never happens.
+        yield from pi_write(cart, 0x08000000, range(save.depth), pace=2)
+        assert (yield from bus_access(cart, CART_SAVE_STATUS)) == 0
+        yield from pi_write(cart, 0x08000000 + 2 * save.depth, [0], pace=2)
+        assert (yield from bus_access(cart, CART_SAVE_STATUS)) == 1
+        yield from bus_access(cart, CART_SAVE_STATUS, 1)
+        assert (yield from bus_access(cart, CART_SAVE_STATUS)) == 0
+
+    sim = Simulator(cart)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
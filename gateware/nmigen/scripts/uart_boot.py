@@ -0,0 +1,63 @@
+"""
+Host side of the UART bootloader in irom/boot.s. Sends a raw binary
+(linked at the IRAM base, 0x10000) and reports the load throughput.
+Start it before resetting the board, or while the ROM waits for a frame.
+
+    python scripts/uart_boot.py /dev/ttyUSB0 app.bin
+"""
+
+import argparse
+import struct
+import sys
+import time
+
+import serial
+
+IRAM_SIZE = 0x800
+
+
+def frame(image):
+    image += b"\0" * (-len(image) % 4)
+    if len(image) > IRAM_SIZE:
+        raise ValueError("image is {} bytes, IRAM holds {}".format(len(image), IRAM_SIZE))
+    checksum = sum(w for (w,) in struct.iter_unpack("<I", image)) & 0xffffffff
+    return b"BOOT" + struct.pack("<I", len(image)) + image + struct.pack("<I", checksum)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port")
+    parser.add_argument("image")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--timeout", type=float, default=5)
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        data = frame(f.read())
+
+    with serial.Serial(args.port, args.baud, timeout=args.timeout) as port:
+        # The banner and whatever the ROM prints before its 'B' prompt can
+        # hold an 'O' as well, so wait for the prompt and drop all of it.
+        # If it doesn't come, the ROM printed it before the port was opened
+        # and is waiting already.
+        while port.read(1) not in (b"B", b""):
+            pass
+        port.reset_input_buffer()
+
+        start = time.perf_counter()
+        port.write(data)
+        port.flush()
+
+        while True:
+            reply = port.read(1)
+            if reply in (b"O", b"E", b""):
+                break
+        elapsed = time.perf_counter() - start
+
+    if reply != b"O":
+        sys.exit("load failed: {}".format("bad frame" if reply == b"E" else "no reply"))
+
+    # 10 bits per byte on the wire with 8N1.
+    line_rate = args.baud / 10
+    print("loaded {} bytes in {:.3f}s: {:.0f} B/s ({:.0%} of line rate)".format(
+        len(data), elapsed, len(data) / elapsed, len(data) / elapsed / line_rate))
@@ -0,0 +1,440 @@
+"""
+Streaming analyzer for simulation dumps (top.py sim, cart_tb, cxxrtl).
+
+Reconstructs PI bus transactions and SDRAM commands from a VCD without
+loading it into memory, writes one CSV row per PI transaction and prints
+bus utilization, SDRAM row-hit rate and refresh collisions, refreshes
+issued while /RD or /WR is low.
+
+    python scripts/vcd_analyze.py /tmp/cart.vcd -o pi.csv --sdram-csv sdram.csv
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+# For the test, run by regress.py.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from simtest import sim_test
+
+TIME_UNITS = {"s": 1e9, "ms": 1e6, "us": 1e3, "ns": 1, "ps": 1e-3, "fs": 1e-6}
+
+
+def parse_value(text):
+    """ VCD value to int, x/z bits read as 0. """
+    text = text.lower().translate(str.maketrans("xzu-", "0000"))
+    return int(text, 2) if text else 0
+
+
+class VCDReader:
+    """
+    Reads the header on construction, then iterating yields
+    ``(timestamp, changes)`` per timestamp, ``changes`` being a dict of
+    identifier code to new value. Only one timestamp is held at a time.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.vars = {}
+        self.widths = {}
+        self.timescale_ns = 1
+
+        scope = []
+        tokens = self._header_tokens()
+        for token in tokens:
+            if token == "$scope":
+                next(tokens)
+                scope.append(next(tokens))
+            elif token == "$upscope":
+                scope.pop()
+            elif token == "$var":
+                next(tokens)
+                width = int(next(tokens))
+                ident = next(tokens)
+                name = next(tokens)
+                self.vars[".".join(scope + [name])] = ident
+                self.widths[ident] = width
+            elif token == "$timescale":
+                text = ""
+                for token in tokens:
+                    if token == "$end":
+                        break
+                    text += token
+                number = text.rstrip("abcdefghijklmnopqrstuvwxyz")
+                self.timescale_ns = int(number) * TIME_UNITS[text[len(number):]]
+            elif token == "$enddefinitions":
+                break
+
+    def _header_tokens(self):
+        for line in self.f:
+            for token in line.split():
+                yield token
+                if token == "$enddefinitions":
+                    return
+
+    def find(self, suffix):
+        """ Identifier of the first variable whose full name ends with ``suffix``. """
+        for name, ident in self.vars.items():
+            if name == suffix or name.endswith("." + suffix):
+                return ident
+        raise KeyError(suffix)
+
+    def __iter__(self):
+        timestamp = 0
+        changes = {}
+        for line in self.f:
+            line = line.strip()
+            if not line or line[0] == "$":
+                continue
+
+            c = line[0]
+            if c == "#":
+                if changes:
+                    yield timestamp, changes
+                    changes = {}
+                timestamp = int(line[1:])
+            elif c in "bB":
+                value, ident = line[1:].split()
+                changes[ident] = parse_value(value)
+            elif c in "rRsS":
+                # Reals and strings (e.g. FSM state names) aren't needed.
+                continue
+            else:
+                changes[line[1:]] = parse_value(c)
+
+        if changes:
+            yield timestamp, changes
+
+
+class PIAnalyzer:
+    """
+    Follows the PI address/data bus. Like Cart, an address phase takes the
+    high half from the bus while ale_h and ale_l are both high and the low
+    half while only ale_l is; every read/write strobe after that transfers
+    one 16-bit word and bumps the address by 2. The bus is active while
+    /RD or /WR is low.
+    """
+    def __init__(self, vcd, writer):
+        self.ale_h = vcd.find("n64_ale_h_i")
+        self.ale_l = vcd.find("n64_ale_l_i")
+        self.read = vcd.find("n64_read_i")
+        self.write = vcd.find("n64_write_i")
+        self.ad_i = vcd.find("n64_data_i")
+        self.ad_o = vcd.find("n64_data_o")
+        self.idents = [self.ale_h, self.ale_l, self.read, self.write, self.ad_i, self.ad_o]
+
+        self.writer = writer
+        self.transaction = None
+        self.busy_time = 0
+        self.count = 0
+        self.hi = 0
+        self.lo = 0
+        self.strobe = False
+
+    def active(self):
+        return self.strobe
+
+    def finish(self):
+        t = self.transaction
+        if t is None:
+            return
+        if t["words"]:
+            self.busy_time += t["end"] - t["start"]
+            self.count += 1
+            self.writer.writerow([t["start"], t["end"], t["kind"] or "",
+                "{:08x}".format(t["addr"]), len(t["words"]),
+                " ".join("{:04x}".format(w) for w in t["words"])])
+        self.transaction = None
+
+    def step(self, time, prev, cur):
+        def rose(ident):
+            return not prev[ident] and cur[ident]
+        def fell(ident):
+            return prev[ident] and not cur[ident]
+
+        self.strobe = not cur[self.read] or not cur[self.write]
+
+        if rose(self.ale_h):
+            self.finish()
+            self.transaction = dict(start=time, end=time, kind=None, addr=0, words=[])
+        # What the bus held up to now.
+        if prev[self.ale_l]:
+            if prev[self.ale_h]:
+                self.hi = prev[self.ad_i]
+            else:
+                self.lo = prev[self.ad_i]
+        if fell(self.ale_l) and self.transaction is not None:
+            self.transaction["addr"] = self.hi << 16 | self.lo
+
+        t = self.transaction
+        if t is None:
+            return
+        if rose(self.read):
+            t["kind"] = "read"
+            t["words"].append(prev[self.ad_o])
+            t["end"] = time
+        if rose(self.write):
+            t["kind"] = "write"
+            t["words"].append(prev[self.ad_i])
+            t["end"] = time
+
+
+class SDRAMAnalyzer:
+    """
+    Decodes the controller's active-high command outputs on every rising
+    clock edge. A column command is a row hit if its bank saw no activate
+    since the previous column command to it.
+    """
+    COMMANDS = {
+        # (ras, cas, we)
+        (1, 0, 0): "ACT",
+        (0, 1, 0): "READ",
+        (0, 1, 1): "WRITE",
+        (1, 0, 1): "PRE",
+        (1, 1, 0): "REF",
+        (1, 1, 1): "MRS",
+        (0, 0, 1): "BST",
+    }
+
+    def __init__(self, vcd, writer, prefix="sdram__"):
+        self.clk = vcd.find("clk")
+        self.cs = vcd.find(prefix + "cs")
+        self.ras = vcd.find(prefix + "ras")
+        self.cas = vcd.find(prefix + "cas")
+        self.we = vcd.find(prefix + "we")
+        self.ba = vcd.find(prefix + "ba")
+        self.addr = vcd.find(prefix + "addr")
+        self.idents = [self.clk, self.cs, self.ras, self.cas, self.we, self.ba, self.addr]
+
+        self.writer = writer
+        self.activated = set()
+        self.column_cmds = 0
+        self.row_hits = 0
+        self.refreshes = 0
+        self.refresh_collisions = 0
+
+    def step(self, time, prev, cur, pi_active):
+        if prev[self.clk] or not cur[self.clk] or not cur[self.cs]:
+            return
+
+        cmd = self.COMMANDS.get((cur[self.ras], cur[self.cas], cur[self.we]))
+        if cmd is None:
+            return
+        bank = cur[self.ba]
+
+        if cmd == "ACT":
+            self.activated.add(bank)
+        elif cmd in ("READ", "WRITE"):
+            self.column_cmds += 1
+            if bank not in self.activated:
+                self.row_hits += 1
+            self.activated.discard(bank)
+        elif cmd == "REF":
+            self.refreshes += 1
+            if pi_active:
+                self.refresh_collisions += 1
+
+        if self.writer is not None:
+            self.writer.writerow([time, cmd, bank, "{:x}".format(cur[self.addr])])
+
+
+def analyze(f, pi_csv, sdram_csv=None, sdram_prefix="sdram__"):
+    """ Either side is skipped if its signals aren't in the dump. """
+    vcd = VCDReader(f)
+
+    pi = None
+    try:
+        pi_writer = csv.writer(pi_csv)
+        pi = PIAnalyzer(vcd, pi_writer)
+        pi_writer.writerow(["start_ns", "end_ns", "kind", "addr", "words", "data"])
+    except KeyError:
+        pass
+
+    sdram = None
+    try:
+        sdram_writer = sdram_csv and csv.writer(sdram_csv)
+        sdram = SDRAMAnalyzer(vcd, sdram_writer, sdram_prefix)
+        if sdram_writer:
+            sdram_writer.writerow(["time_ns", "cmd", "bank", "addr"])
+    except KeyError:
+        pass
+
+    if pi is None and sdram is None:
+        raise ValueError("no PI or SDRAM signals in dump")
+
+    idents = (pi.idents if pi else []) + (sdram.idents if sdram else [])
+    cur = {ident: 0 for ident in idents}
+    first_time = None
+    time = 0
+
+    for timestamp, changes in vcd:
+        time = round(timestamp * vcd.timescale_ns, 3)
+        if first_time is None:
+            first_time = time
+
+        prev = dict(cur)
+        for ident, value in changes.items():
+            if ident in cur:
+                cur[ident] = value
+
+        if pi is not None:
+            pi.step(time, prev, cur)
+        if sdram is not None:
+            sdram.step(time, prev, cur, pi is not None and pi.active())
+
+    duration = time - (first_time or 0)
+    stats = {"duration_ns": duration}
+    if pi is not None:
+        pi.finish()
+        stats.update({
+            "pi_transactions": pi.count,
+            "pi_bus_utilization": pi.busy_time / duration if duration else 0.0,
+        })
+    if sdram is not None:
+        stats.update({
+            "sdram_column_cmds": sdram.column_cmds,
+            "sdram_row_hit_rate": sdram.row_hits / sdram.column_cmds if sdram.column_cmds else 0.0,
+            "sdram_refreshes": sdram.refreshes,
+            "sdram_refresh_collisions": sdram.refresh_collisions,
+        })
+    return stats
+
+
+# One address phase and two reads. The bus still holds junk when ale_l
+# rises and the refreshes at 60 and 300 fall outside the strobes, the
+# one at 105 is during the first /RD. Between the reads and the last
+# refresh, an activate and two reads of bank 1, the second a row hit.
+VCD_SAMPLE = """\
+$timescale 1ns $end
+$scope module top $end
+$var wire 1 ! clk $end
+$var wire 1 " n64_ale_h_i $end
+$var wire 1 # n64_ale_l_i $end
+$var wire 1 $ n64_read_i $end
+$var wire 1 % n64_write_i $end
+$var wire 16 & n64_data_i $end
+$var wire 16 ' n64_data_o $end
+$var wire 1 ( sdram__cs $end
+$var wire 1 ) sdram__ras $end
+$var wire 1 * sdram__cas $end
+$var wire 1 + sdram__we $end
+$var wire 2 , sdram__ba $end
+$var wire 13 - sdram__addr $end
+$upscope $end
+$enddefinitions $end
+#0
+0!
+0"
+0#
+1$
+1%
+b0 &
+b0 '
+0(
+0)
+0*
+0+
+b0 ,
+b0 -
+#10
+1"
+b1101111010101101 &
+#20
+1#
+#30
+b1000000000000 &
+#40
+0"
+b1000000 &
+#50
+0#
+#60
+1!
+1(
+1)
+1*
+#61
+0!
+0(
+#100
+0$
+b1001000110100 '
+#105
+1!
+1(
+#106
+0!
+0(
+#110
+1$
+#120
+0$
+b101011001111000 '
+#130
+1$
+#200
+1!
+1(
+0*
+b1 ,
+#201
+0!
+0(
+#220
+1!
+1(
+0)
+1*
+#221
+0!
+0(
+#240
+1!
+1(
+#241
+0!
+0(
+#300
+1!
+1(
+1)
+#301
+0!
+0(
+"""
+
+
+@sim_test()
+def sim_vcd_analyze():
+    """ On a hand-written dump. """
+    import io
+
+    pi_csv = io.StringIO()
+    stats = analyze(io.StringIO(VCD_SAMPLE), pi_csv)
+    rows = list(csv.reader(io.StringIO(pi_csv.getvalue())))
+    assert rows[1:] == [["10", "130", "read", "10000040", "2", "1234 5678"]]
+    # From ale_h rising to the end of the last read.
+    assert stats["pi_bus_utilization"] == 120 / 301
+    assert stats["sdram_column_cmds"] == 2
+    assert stats["sdram_row_hit_rate"] == 0.5
+    assert stats["sdram_refreshes"] == 3
+    assert stats["sdram_refresh_collisions"] == 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("vcd", help="VCD file, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="PI transaction CSV")
+    parser.add_argument("--sdram-csv", default=None, help="SDRAM command CSV")
+    parser.add_argument("--sdram-prefix", default="sdram__")
+    args = parser.parse_args()
+
+    vcd_file = sys.stdin if args.vcd == "-" else open(args.vcd)
+    pi_csv = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    sdram_csv = args.sdram_csv and open(args.sdram_csv, "w", newline="")
+
+    stats = analyze(vcd_file, pi_csv, sdram_csv, args.sdram_prefix)
+    for name, value in stats.items():
+        if isinstance(value, float):
+            value = "{:.4f}".format(value)
+        sys.stderr.write("{:26s} {}\n".format(name, value))
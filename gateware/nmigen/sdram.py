@@ -1,8 +1,32 @@
 from nmigen import *
+from nmigen.lib.fifo import AsyncFIFO, SyncFIFOBuffered
 import math
 
+from simtest import sim_test
+
+# SDRAMController.cmd values.
+CMD_NOP = 0
+CMD_WRITE = 1
+CMD_READ = 3
+
+# Words in each full page read or write burst.
+BURST_WORDS = 256
+
+# Words in a row, bursts wrap around within one.
+ROW_WORDS = 1024
+
 class SDRAMController(Elaboratable):
-	def __init__(self, sys_clk):
+	"""
+	Parameters
+	----------
+	sys_clk : float
+		Controller clock in Hz.
+	fast_init : bool
+		Shorten the power-up wait and mode register delays for simulation.
+		The command sequence is unchanged, only the idle time between
+		commands shrinks to the datasheet minimums.
+	"""
+	def __init__(self, sys_clk, fast_init=False):
 		self.sdram = Record([
 			("cke", 1),
 			("cs", 1),
@@ -20,7 +44,7 @@ class SDRAMController(Elaboratable):
 		self.row_bits = 13
 		self.col_bits = 10
 
-		# 0 = nop, 1 = read short, 2 = read long, 3 = write long
+		# 0 = nop, 1 and 2 = write, 3 = read, see CMD_*
 		self.cmd = Signal(2)
 		self.cmd_ack = Signal(2)
 
@@ -28,12 +52,20 @@ class SDRAMController(Elaboratable):
 		self.data_out = Signal(16)
 
 		self.addr = Signal(self.bank_bits + self.row_bits + self.col_bits)
+		# Words in a read burst, at least 3, 0 for a whole page. Held
+		# like addr.
+		self.rd_words = Signal(8)
 
 		# rd and wr valid go high _1 cycle_ before actual valid.
 		self.rd_valid = Signal()
 		self.wr_valid = Signal()
 
+		# Takes read data one clock later, for boards where the round trip
+		# to the chip doesn't fit the CAS latency. See sdram_cal.py.
+		self.read_stage = Signal()
+
 		self.sys_clk = sys_clk
+		self.fast_init = fast_init
 
 
 	def elaborate(self, platform):
@@ -53,6 +85,17 @@ class SDRAMController(Elaboratable):
 		#t_mrd = 2
 		t_mrd = 200
 		cas = 3
+		# Idle to idle, with a clock to change state in each step.
+		t_burst = t_rcd + cas + BURST_WORDS + t_rp + 4
+		# At most one early refresh per interval, even when a burst takes
+		# longer than one.
+		t_early = max(t_refresh - t_burst, t_refresh // 2)
+
+		if self.fast_init:
+			# The simulation model doesn't check the 100us power-up delay,
+			# tMRD is 2 clocks.
+			t_init = 8
+			t_mrd = 2
 
 		ram = self.sdram
 
@@ -184,6 +227,16 @@ class SDRAMController(Elaboratable):
 		banks_active = Signal(2**bank_bits)
 		rows_active = Array([ Signal(row_bits) for x in range(0,2**bank_bits) ])
 
+		# The read window moves with read_stage, data_in samples the pins
+		# on every clock.
+		rd_valid = Signal()
+		rd_valid_late = Signal()
+		m.d.sync += [
+			rd_valid_late.eq(rd_valid),
+			self.data_in.eq(self.sdram.data_in),
+		]
+		m.d.comb += self.rd_valid.eq(Mux(self.read_stage, rd_valid_late, rd_valid))
+
 		bank_addr = Signal(bank_bits)
 		row_addr = Signal(row_bits)
 		col_addr = Signal(col_bits)
@@ -195,7 +248,10 @@ class SDRAMController(Elaboratable):
 					m.next = "idle"
 
 			with m.State("idle"):
-				with m.If(refresh_timer > t_refresh):
+				# Refresh early in gaps between commands, once a burst
+				# could run past the next one being due. Refreshes pushed
+				# out by a burst are caught up on afterwards.
+				with m.If((refresh_timer > t_refresh) | ((self.cmd == 0) & (refresh_timer > t_early))):
 					m.next = "refresh"
 				with m.Else():
 					with m.If(self.cmd != 0):
@@ -208,10 +264,11 @@ class SDRAMController(Elaboratable):
 				counter = Signal(4)
 				with m.If(counter == 0):
 					m.d.sync += cmd.eq(0b0001)
+					# Early refreshes don't leave credit for later ones.
+					m.d.sync += refresh_timer.eq(Mux(refresh_timer > t_refresh, refresh_timer - t_refresh, 0))
 				with m.If(counter < t_rc-1):
 					m.d.sync += counter.eq(counter+1)
 				with m.Else():
-					m.d.sync += refresh_timer.eq(refresh_timer - t_refresh)
 					m.d.sync += counter.eq(0)
 					m.next = "idle"
 
@@ -247,22 +304,21 @@ class SDRAMController(Elaboratable):
 				with m.If(counter < cas-1):
 					m.d.sync += counter.eq(counter+1)
 				with m.Else():
-					m.d.sync += self.rd_valid.eq(1)
+					m.d.sync += rd_valid.eq(1)
 					m.d.sync += counter.eq(0)
 					m.next = "read_data"
 			
 			with m.State("read_data"):
 				counter = Signal(8)
 
-				m.d.sync += self.data_in.eq(self.sdram.data_in)
-
-				with m.If(counter == 253):
+				# Wraps around to 253 and 255 for a whole page.
+				with m.If(counter == (self.rd_words - 3)[:8]):
 					m.d.sync += [
 						cmd.eq(0b0110), # Burst Terminate
 					]
-				with m.If(counter == 255):
+				with m.If(counter == (self.rd_words - 1)[:8]):
 					m.d.sync += counter.eq(0)
-					m.d.sync += self.rd_valid.eq(0)
+					m.d.sync += rd_valid.eq(0)
 					m.next = "precharge"
 				with m.Else():
 					m.d.sync += counter.eq(counter+1)
@@ -305,4 +361,410 @@ class SDRAMController(Elaboratable):
 				with m.Else():
 					m.d.sync += counter.eq(0)
 					m.next = "idle"
-		return m
\ No newline at end of file
+		return m
+
+class SDRAMPort(Record):
+	"""
+		Requester side of SDRAMCrossing, with the handshakes of nmigen's
+		FIFOs: commands go through ``cmd``/``addr``/``cmd_en``/``cmd_rdy``,
+		read bursts come back through ``rd_data``/``rd_rdy``/``rd_en`` and
+		write bursts are taken from ``wr_data``/``wr_en``/``wr_rdy``.
+		``rd_words`` cuts a read burst short, 0 reads all ``BURST_WORDS``.
+		``req`` is held while a master uses the port, see SDRAMArbiter.
+	"""
+	def __init__(self, addr_width=25):
+		super().__init__([
+			("req", 1),
+			("cmd", 2),
+			("addr", addr_width),
+			("rd_words", 8),
+			("cmd_en", 1),
+			("cmd_rdy", 1),
+			("rd_data", 16),
+			("rd_en", 1),
+			("rd_rdy", 1),
+			("wr_data", 16),
+			("wr_en", 1),
+			("wr_rdy", 1),
+			])
+
+	def connect_to(self, other):
+		return [
+			other.req.eq(self.req),
+			other.cmd.eq(self.cmd),
+			other.addr.eq(self.addr),
+			other.rd_words.eq(self.rd_words),
+			other.cmd_en.eq(self.cmd_en),
+			other.rd_en.eq(self.rd_en),
+			other.wr_data.eq(self.wr_data),
+			other.wr_en.eq(self.wr_en),
+
+			self.cmd_rdy.eq(other.cmd_rdy),
+			self.rd_data.eq(other.rd_data),
+			self.rd_rdy.eq(other.rd_rdy),
+			self.wr_rdy.eq(other.wr_rdy),
+		]
+
+
+class SDRAMCrossing(Elaboratable):
+	"""
+		Clock domain crossing in front of SDRAMController, so the
+		controller can run at its own, faster clock. With both in the same
+		domain the FIFOs are synchronous, which saves the synchronizer
+		latency on every command and burst.
+
+		``port`` is in ``domain``. Each write moves ``BURST_WORDS`` words,
+		each read ``rd_words`` of them. The words of a write have to be
+		queued before its command. ``cmd_rdy`` holds back reads until the
+		read FIFO has room for the whole burst, so it never overflows.
+
+	Parameters
+	----------
+	controller : SDRAMController
+		Runs in ``sdram_domain``.
+	domain : str
+		Domain of the requester.
+	sdram_domain : str
+		Domain of the controller.
+	depth : int
+		Words of each data FIFO, at least one burst. By default two for a
+		crossing, so a burst can come in while the last one is read, and
+		one within a domain.
+	"""
+	def __init__(self, controller, domain="sync", sdram_domain="sync", depth=None):
+		if depth is None:
+			depth = BURST_WORDS if domain == sdram_domain else 2 * BURST_WORDS
+		assert depth >= BURST_WORDS
+		self.controller = controller
+		self.domain = domain
+		self.sdram_domain = sdram_domain
+		self.depth = depth
+
+		self.port = SDRAMPort(len(controller.addr))
+
+	def elaborate(self, platform):
+		m = Module()
+
+		ctrl = self.controller
+		port = self.port
+		sdram_d = m.d[self.sdram_domain]
+
+		if self.domain == self.sdram_domain:
+			def fifo(width, depth, w_domain, r_domain):
+				return DomainRenamer(w_domain)(SyncFIFOBuffered(width=width, depth=depth))
+		else:
+			fifo = AsyncFIFO
+
+		m.submodules.cmd_fifo = cmd_fifo = fifo(width=len(port.cmd) + len(port.addr) + len(port.rd_words), depth=4,
+			w_domain=self.domain, r_domain=self.sdram_domain)
+		m.submodules.rd_fifo = rd_fifo = fifo(width=16, depth=self.depth,
+			w_domain=self.sdram_domain, r_domain=self.domain)
+		m.submodules.wr_fifo = wr_fifo = fifo(width=16, depth=self.depth,
+			w_domain=self.domain, r_domain=self.sdram_domain)
+
+		# Requester side. Free words in the read FIFO, counting the bursts
+		# that are still on their way.
+		credits = Signal(range(rd_fifo.depth + 1), reset=rd_fifo.depth)
+		is_read = port.cmd == CMD_READ
+		rd_words = Mux(port.rd_words == 0, BURST_WORDS, port.rd_words)
+		m.d.comb += [
+			port.cmd_rdy.eq(cmd_fifo.w_rdy & (~is_read | (credits >= rd_words))),
+			cmd_fifo.w_en.eq(port.cmd_en & port.cmd_rdy),
+			cmd_fifo.w_data.eq(Cat(port.cmd, port.addr, port.rd_words)),
+
+			port.rd_data.eq(rd_fifo.r_data),
+			port.rd_rdy.eq(rd_fifo.r_rdy),
+			rd_fifo.r_en.eq(port.rd_en),
+
+			wr_fifo.w_data.eq(port.wr_data),
+			wr_fifo.w_en.eq(port.wr_en),
+			port.wr_rdy.eq(wr_fifo.w_rdy),
+		]
+		popped = rd_fifo.r_en & rd_fifo.r_rdy
+		with m.If(cmd_fifo.w_en & is_read):
+			m.d[self.domain] += credits.eq(credits - rd_words + popped)
+		with m.Else():
+			m.d[self.domain] += credits.eq(credits + popped)
+
+		# Controller side. The controller looks at ``cmd`` while idle and
+		# at ``addr`` and ``rd_words`` for the whole transaction, so they
+		# are held here until it acknowledges the command and then returns
+		# to idle, where ``cmd_ack`` follows the cleared ``cmd``.
+		busy = Signal()
+		with m.If(~busy):
+			m.d.comb += cmd_fifo.r_en.eq(1)
+			with m.If(cmd_fifo.r_rdy):
+				sdram_d += [
+					Cat(ctrl.cmd, ctrl.addr, ctrl.rd_words).eq(cmd_fifo.r_data),
+					busy.eq(1),
+				]
+		with m.Elif((ctrl.cmd != CMD_NOP) & (ctrl.cmd_ack == ctrl.cmd)):
+			sdram_d += ctrl.cmd.eq(CMD_NOP)
+		with m.Elif((ctrl.cmd == CMD_NOP) & (ctrl.cmd_ack == CMD_NOP)):
+			sdram_d += busy.eq(0)
+
+		# rd_valid and wr_valid lead the data by a cycle. Writes sample
+		# data_out from the first cycle of wr_valid, but it stays up for
+		# one more cycle than the burst is long.
+		rd_valid = Signal()
+		sdram_d += rd_valid.eq(ctrl.rd_valid)
+		m.d.comb += [
+			rd_fifo.w_en.eq(rd_valid),
+			rd_fifo.w_data.eq(ctrl.data_in),
+		]
+
+		wr_left = Signal(range(BURST_WORDS + 1))
+		with m.If(~busy & cmd_fifo.r_rdy):
+			sdram_d += wr_left.eq(BURST_WORDS)
+		with m.Elif(wr_fifo.r_en & wr_fifo.r_rdy):
+			sdram_d += wr_left.eq(wr_left - 1)
+		m.d.comb += [
+			wr_fifo.r_en.eq(ctrl.wr_valid & (wr_left != 0)),
+			ctrl.data_out.eq(wr_fifo.r_data),
+		]
+
+		return m
+
+
+class SDRAMArbiter(Elaboratable):
+	"""
+		Shares one SDRAMPort between ``masters``, the lowest index first.
+		A master keeps the port for as long as it holds ``req``, so it gets
+		back the data of the reads it queued.
+	"""
+	def __init__(self, masters, addr_width=25):
+		self.masters = [SDRAMPort(addr_width) for _ in range(masters)]
+		self.port = SDRAMPort(addr_width)
+
+	def elaborate(self, platform):
+		m = Module()
+
+		requests = Cat(master.req for master in self.masters)
+		owner = Signal(range(len(self.masters)))
+		locked = Signal()
+
+		pick = Signal.like(owner)
+		for i in reversed(range(len(self.masters))):
+			with m.If(requests[i]):
+				m.d.comb += pick.eq(i)
+
+		current = Mux(locked, owner, pick)
+		m.d.sync += [
+			owner.eq(current),
+			locked.eq(requests.bit_select(current, 1)),
+		]
+
+		with m.Switch(current):
+			for i, master in enumerate(self.masters):
+				with m.Case(i):
+					m.d.comb += master.connect_to(self.port)
+
+		return m
+
+
+@sim_test(sys_clk=[50e6, 75e6, 100e6])
+def sim_refresh(sys_clk):
+	""" Reads with gaps of varying length in between, so the refresh timer
+	runs out both during bursts and during gaps. Refreshing in the gaps
+	keeps the refresh rate up, and a refresh a burst pushes out is late by
+	no more than the burst. Where bursts take longer than tREF/8192, the
+	missed refreshes are caught up on, and long gaps still get no more
+	than one early refresh per interval. """
+	from nmigen.back.pysim import Simulator, Passive
+
+	ctrl = SDRAMController(sys_clk, fast_init=True)
+	t_refresh = math.floor((32e-3/8192) * ctrl.sys_clk)
+	t_rc = 10
+	# A read burst, idle to idle, see SDRAMController.
+	t_burst = 3 + 3 + BURST_WORDS + 3 + 4
+
+	refreshes = []
+	clock = [0]
+
+	def monitor():
+		yield Passive()
+		while True:
+			yield
+			clock[0] += 1
+			pins = yield Cat(ctrl.sdram.we, ctrl.sdram.cas, ctrl.sdram.ras, ctrl.sdram.cs)
+			if pins == ~0b0001 & 0xf:
+				refreshes.append(clock[0])
+
+	def requester():
+		for _ in range(100):
+			yield
+		latencies = []
+		for gap in list(range(12, 400, 29)) + [4 * t_refresh]:
+			for _ in range(gap):
+				yield
+			yield ctrl.cmd.eq(CMD_READ)
+			latency = 0
+			while (yield ctrl.cmd_ack) != CMD_READ:
+				latency += 1
+				yield
+			latencies.append(latency)
+			yield ctrl.cmd.eq(0)
+			while not (yield ctrl.rd_valid):
+				yield
+			while (yield ctrl.rd_valid):
+				yield
+
+		# A command waits out the refreshes a burst pushed out.
+		owed = -(-t_burst // t_refresh)
+		assert max(latencies) <= min(latencies) + owed * t_rc, latencies
+		intervals = [b - a for a, b in zip(refreshes, refreshes[1:])]
+		assert max(intervals) <= t_refresh + t_burst, intervals
+		# At least the rate tREF asks for, at most twice that.
+		elapsed = refreshes[-1] - refreshes[0]
+		assert len(intervals) >= elapsed / t_refresh, (len(intervals), elapsed)
+		assert len(intervals) <= 2 * elapsed / t_refresh + 1, (len(intervals), elapsed)
+
+	sim = Simulator(ctrl)
+	sim.add_clock(1 / sys_clk)
+	sim.add_sync_process(monitor)
+	sim.add_sync_process(requester)
+	sim.run()
+
+
+@sim_test(rd_words=[0, 128, 16])
+def sim_read_words(rd_words):
+	""" A read burst lasts ``rd_words`` words, a whole page for 0, and is
+	terminated two clocks before its end. """
+	from nmigen.back.pysim import Simulator
+
+	ctrl = SDRAMController(100e6, fast_init=True)
+	words = rd_words or BURST_WORDS
+
+	def requester():
+		for _ in range(100):
+			yield
+		yield ctrl.rd_words.eq(rd_words)
+		yield ctrl.cmd.eq(CMD_READ)
+		while (yield ctrl.cmd_ack) != CMD_READ:
+			yield
+		yield ctrl.cmd.eq(0)
+		while not (yield ctrl.rd_valid):
+			yield
+		valid = 0
+		terminate = None
+		while (yield ctrl.rd_valid):
+			valid += 1
+			yield
+			pins = yield Cat(ctrl.sdram.we, ctrl.sdram.cas, ctrl.sdram.ras, ctrl.sdram.cs)
+			if pins == ~0b0110 & 0xf:
+				terminate = valid
+		assert valid == words, valid
+		assert terminate == words - 2, terminate
+
+	sim = Simulator(ctrl)
+	sim.add_clock(10e-9)
+	sim.add_sync_process(requester)
+	sim.run()
+
+
+@sim_test()
+def sim_crossing():
+	""" SDRAMCrossing between two unrelated clocks, against a model of the
+	controller's command and data handshakes. """
+	from nmigen.back.pysim import Simulator, Passive
+
+	ctrl = SDRAMController(100e6)
+	xing = SDRAMCrossing(ctrl, domain="pi", sdram_domain="sdram")
+
+	m = Module()
+	m.domains.pi = ClockDomain("pi")
+	m.domains.sdram = ClockDomain("sdram")
+	m.submodules.xing = xing
+
+	written = []
+	bursts = []
+
+	def controller():
+		yield Passive()
+		while True:
+			cmd = yield ctrl.cmd
+			if not cmd:
+				yield ctrl.cmd_ack.eq(0)
+				yield
+				continue
+			addr = yield ctrl.addr
+			yield ctrl.cmd_ack.eq(cmd)
+			for _ in range(3):
+				yield
+			bursts.append((cmd, addr))
+			if cmd == CMD_READ:
+				yield ctrl.rd_valid.eq(1)
+				yield
+				for i in range(BURST_WORDS):
+					yield ctrl.data_in.eq((addr + i) & 0xffff)
+					if i == BURST_WORDS - 1:
+						yield ctrl.rd_valid.eq(0)
+					yield
+			else:
+				yield ctrl.wr_valid.eq(1)
+				for i in range(BURST_WORDS + 1):
+					yield
+					if i < BURST_WORDS:
+						written.append((yield ctrl.data_out))
+				yield ctrl.wr_valid.eq(0)
+			# Precharge.
+			for _ in range(3):
+				yield
+
+	def command(cmd, addr):
+		yield xing.port.cmd.eq(cmd)
+		yield xing.port.addr.eq(addr)
+		yield xing.port.cmd_en.eq(1)
+		yield
+		while not (yield xing.port.cmd_rdy):
+			yield
+		yield xing.port.cmd_en.eq(0)
+
+	def read_burst(addr):
+		yield xing.port.rd_en.eq(1)
+		i = 0
+		while i < BURST_WORDS:
+			yield
+			if (yield xing.port.rd_rdy):
+				assert (yield xing.port.rd_data) == (addr + i) & 0xffff
+				i += 1
+		yield xing.port.rd_en.eq(0)
+
+	def requester():
+		# Two bursts fit the read FIFO, the third waits for room.
+		yield from command(CMD_READ, 0x1000)
+		yield from command(CMD_READ, 0x2000)
+		yield xing.port.cmd.eq(CMD_READ)
+		for _ in range(BURST_WORDS * 3):
+			yield
+		assert not (yield xing.port.cmd_rdy)
+
+		yield from read_burst(0x1000)
+		yield from command(CMD_READ, 0x3000)
+		yield from read_burst(0x2000)
+		yield from read_burst(0x3000)
+
+		# Both pages queued up front, each burst takes only its own.
+		pages = [[i ^ 0x5a5a for i in range(BURST_WORDS)], [i ^ 0xa5a5 for i in range(BURST_WORDS)]]
+		for page in pages:
+			for word in page:
+				yield xing.port.wr_data.eq(word)
+				yield xing.port.wr_en.eq(1)
+				yield
+				assert (yield xing.port.wr_rdy)
+		yield xing.port.wr_en.eq(0)
+		yield from command(CMD_WRITE, 0x4000)
+		yield from command(CMD_WRITE, 0x5000)
+		while len(written) < 2 * BURST_WORDS:
+			yield
+
+		assert bursts == [(CMD_READ, 0x1000), (CMD_READ, 0x2000), (CMD_READ, 0x3000),
+			(CMD_WRITE, 0x4000), (CMD_WRITE, 0x5000)]
+		assert written == pages[0] + pages[1]
+
+	sim = Simulator(m)
+	sim.add_clock(10e-9, domain="sdram")
+	sim.add_clock(16e-9, domain="pi")
+	sim.add_sync_process(controller, domain="sdram")
+	sim.add_sync_process(requester, domain="pi")
+	sim.run()
@@ -0,0 +1,302 @@
+from nmigen import *
+from wb import WishboneBus
+from sdram import SDRAMPort, CMD_READ, CMD_WRITE, BURST_WORDS
+from save import SAVE_WORDS
+from simtest import sim_test
+
+# Register offsets.
+CAL_CTRL = 0x0
+CAL_SETTING = 0x4
+CAL_PASS = 0x8
+
+# CAL_CTRL bits. Writing CAL_START sweeps again.
+CAL_START = 1 << 0
+CAL_BUSY = 1 << 0
+CAL_DONE = 1 << 1
+CAL_FAILED = 1 << 2
+
+# Clocks between changing the setting and the next burst, for the
+# synchronizers into the SDRAM domain and the PLL.
+CAL_SETTLE = 16
+
+
+def cal_pattern(i, setting):
+    """ Test word ``i`` of the burst for ``setting``. Every bit toggles
+    between neighbouring words and the setting is mixed in, so data left
+    over from the previous setting doesn't pass. """
+    return ((i ^ setting) & 0xff) | (~i & 0xff) << 8
+
+
+class SDRAMCalibration(Elaboratable):
+    """
+        Finds where to capture SDRAM read data on this board.
+
+        For every setting, writes a burst of ``cal_pattern`` words and
+        reads it back through ``port``, held while it is ``busy``. The low
+        bits of a setting are ``delay``, fine delay taps of the PLL, then
+        come ``invert_clk`` for half a clock and ``read_stage`` for a
+        whole one. All the taps together are much less than half a
+        clock, so the capture point only moves later with the taps
+        within each coarse setting of the other two. Runs of passing
+        settings are therefore counted within a coarse setting, and at
+        the end the middle of the longest one is applied, so it has the
+        most margin on both sides. Without taps the coarse settings do
+        move the capture point later one by one, and a run spans them.
+        A sweep runs out of reset and again on writes of ``CAL_START``.
+
+        The pattern goes to the burst at ``pattern_addr``, right below the
+        save area of SaveMemory, so a sweep leaves the ROM alone.
+        ``written`` pulses at the end of each sweep all the same, for
+        caches of the SDRAM.
+
+        Passing settings read back as a bitmap from ``CAL_PASS``, low word
+        first. ``CAL_SETTING`` reads the applied setting and can be
+        written to override it.
+
+    Parameters
+    ----------
+    delay_bits : int
+        Width of the PLL fine delay, 0 without a phase shifted SDRAM
+        clock.
+    """
+    def __init__(self, delay_bits=0, addr_width=25):
+        self.delay_bits = delay_bits
+        self.settings = 2 ** (delay_bits + 2)
+
+        self.bus = WishboneBus()
+        self.port = SDRAMPort(addr_width)
+        self.setting = Signal(delay_bits + 2)
+        self.passed = Signal(self.settings)
+        self.busy = Signal()
+        self.done = Signal()
+        self.failed = Signal()
+        self.written = Signal()
+        self.pattern_addr = 2 ** addr_width - SAVE_WORDS - BURST_WORDS
+
+        self.delay = self.setting[:delay_bits]
+        self.invert_clk = self.setting[delay_bits]
+        self.read_stage = self.setting[delay_bits + 1]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        port = self.port
+
+        start = Signal()
+        auto_start = Signal(reset=1)
+
+        count = Signal(range(BURST_WORDS))
+        settle = Signal(range(CAL_SETTLE + 1))
+        errors = Signal()
+        last_word = count == BURST_WORDS - 1
+        expected = Cat(count[:8] ^ self.setting, ~count[:8])
+
+        # Longest run of passing settings so far.
+        run_start = Signal.like(self.setting)
+        run_len = Signal(range(self.settings + 1))
+        best_start = Signal.like(self.setting)
+        best_len = Signal.like(run_len)
+
+        m.d.comb += [
+            port.req.eq(self.busy),
+            port.addr.eq(self.pattern_addr),
+            port.wr_data.eq(expected),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(start | auto_start):
+                    m.d.sync += [
+                        auto_start.eq(0),
+                        self.busy.eq(1),
+                        self.done.eq(0),
+                        self.setting.eq(0),
+                        self.passed.eq(0),
+                        run_len.eq(0),
+                        best_len.eq(0),
+                        settle.eq(0),
+                    ]
+                    m.next = "SETTLE"
+
+            with m.State("SETTLE"):
+                m.d.sync += settle.eq(settle + 1)
+                with m.If(settle == CAL_SETTLE):
+                    m.d.sync += count.eq(0)
+                    m.next = "FILL"
+
+            with m.State("FILL"):
+                m.d.comb += port.wr_en.eq(1)
+                with m.If(port.wr_rdy):
+                    m.d.sync += count.eq(count + 1)
+                    with m.If(last_word):
+                        m.next = "WRITE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    port.cmd.eq(CMD_WRITE),
+                    port.cmd_en.eq(1),
+                ]
+                with m.If(port.cmd_rdy):
+                    m.next = "READ_CMD"
+
+            with m.State("READ_CMD"):
+                m.d.comb += [
+                    port.cmd.eq(CMD_READ),
+                    port.cmd_en.eq(1),
+                ]
+                with m.If(port.cmd_rdy):
+                    m.d.sync += errors.eq(0)
+                    m.next = "READ"
+
+            with m.State("READ"):
+                m.d.comb += port.rd_en.eq(1)
+                with m.If(port.rd_rdy):
+                    m.d.sync += [
+                        count.eq(count + 1),
+                        errors.eq(errors | (port.rd_data != expected)),
+                    ]
+                    with m.If(last_word):
+                        m.next = "CHECK"
+
+            with m.State("CHECK"):
+                # Tap 0 of a coarse setting starts a new run.
+                run = Signal.like(run_len)
+                if self.delay_bits:
+                    m.d.comb += run.eq(Mux(self.delay == 0, 0, run_len))
+                else:
+                    m.d.comb += run.eq(run_len)
+                with m.If(~errors):
+                    m.d.sync += [
+                        self.passed.eq(self.passed | (Const(1, self.settings) << self.setting)),
+                        run_len.eq(run + 1),
+                    ]
+                    with m.If(run == 0):
+                        m.d.sync += run_start.eq(self.setting)
+                    with m.If(run + 1 > best_len):
+                        m.d.sync += [
+                            best_len.eq(run + 1),
+                            best_start.eq(Mux(run == 0, self.setting, run_start)),
+                        ]
+                with m.Else():
+                    m.d.sync += run_len.eq(0)
+
+                with m.If(self.setting == self.settings - 1):
+                    m.next = "APPLY"
+                with m.Else():
+                    m.d.sync += [
+                        self.setting.eq(self.setting + 1),
+                        settle.eq(0),
+                    ]
+                    m.next = "SETTLE"
+
+            with m.State("APPLY"):
+                m.d.comb += self.written.eq(1)
+                m.d.sync += [
+                    self.setting.eq(Mux(best_len != 0, best_start + ((best_len - 1) >> 1), 0)),
+                    self.failed.eq(best_len == 0),
+                    self.busy.eq(0),
+                    self.done.eq(1),
+                ]
+                m.next = "IDLE"
+
+        regs = {
+            CAL_PASS: self.passed[:32],
+            CAL_PASS + 4: self.passed[32:],
+        }
+
+        with m.If(bus.cyc & ~bus.ack):
+            with m.Switch(bus.addr[:4]):
+                with m.Case(CAL_CTRL):
+                    m.d.sync += bus.r_dat.eq(Cat(self.busy, self.done, self.failed))
+                    with m.If(bus.we & ~self.busy):
+                        m.d.comb += start.eq(bus.w_dat[0])
+                with m.Case(CAL_SETTING):
+                    m.d.sync += bus.r_dat.eq(self.setting)
+                    with m.If(bus.we & ~self.busy):
+                        m.d.sync += self.setting.eq(bus.w_dat)
+                for offset, reg in regs.items():
+                    with m.Case(offset):
+                        m.d.sync += bus.r_dat.eq(reg)
+        m.d.sync += bus.ack.eq(bus.cyc & ~bus.ack)
+
+        return m
+
+
+@sim_test(window=["middle", "two_runs", "tap_wrap", "none"])
+def sim_calibration(window):
+    """ Against a model of the controller that only reads back correctly
+    at some settings. With two delay bits, four taps make a coarse
+    setting, so ``tap_wrap`` passes at taps 2 and 3 of the first and 0
+    to 2 of the second, which isn't one window. """
+    from nmigen.back.pysim import Simulator, Passive
+    from sdram import SDRAMController, SDRAMCrossing
+
+    passing = {
+        "middle": {5, 6, 7, 8},
+        "two_runs": {1, 2, 5, 6, 7, 8, 9},
+        "tap_wrap": {2, 3, 4, 5, 6},
+        "none": set(),
+    }[window]
+    applied = {"middle": 6, "two_runs": 6, "tap_wrap": 5, "none": 0}[window]
+
+    ctrl = SDRAMController(100e6)
+    xing = SDRAMCrossing(ctrl)
+    cal = SDRAMCalibration(delay_bits=2)
+
+    m = Module()
+    m.submodules.xing = xing
+    m.submodules.cal = cal
+    m.d.comb += cal.port.connect_to(xing.port)
+
+    memory = [0] * BURST_WORDS
+    addrs = set()
+
+    def controller():
+        yield Passive()
+        while True:
+            cmd = yield ctrl.cmd
+            if not cmd:
+                yield ctrl.cmd_ack.eq(0)
+                yield
+                continue
+            setting = yield cal.setting
+            addrs.add((yield ctrl.addr))
+            yield ctrl.cmd_ack.eq(cmd)
+            yield
+            if cmd == CMD_READ:
+                yield ctrl.rd_valid.eq(1)
+                yield
+                for i in range(BURST_WORDS):
+                    word = memory[i] if setting in passing else memory[i] ^ (1 << (i % 16))
+                    yield ctrl.data_in.eq(word)
+                    if i == BURST_WORDS - 1:
+                        yield ctrl.rd_valid.eq(0)
+                    yield
+            else:
+                yield ctrl.wr_valid.eq(1)
+                for i in range(BURST_WORDS + 1):
+                    yield
+                    if i < BURST_WORDS:
+                        memory[i] = yield ctrl.data_out
+                yield ctrl.wr_valid.eq(0)
+
+    def proc():
+        yield
+        written = 0
+        while (yield cal.busy):
+            written += yield cal.written
+            yield
+        assert written == 1
+        assert addrs == {cal.pattern_addr}
+        assert (yield cal.done)
+        assert (yield cal.failed) == (not passing)
+        assert (yield cal.passed) == sum(1 << s for s in passing)
+        assert (yield cal.setting) == applied
+        assert memory == [cal_pattern(i, cal.settings - 1) for i in range(BURST_WORDS)]
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(controller)
+    sim.add_sync_process(proc)
+    sim.run()
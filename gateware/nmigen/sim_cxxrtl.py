@@ -0,0 +1,254 @@
+import ctypes
+import hashlib
+import os
+import subprocess
+import tempfile
+import time
+
+SERV_V_FILES = [
+    "serv/rtl/serv_shift.v", "serv/rtl/serv_bufreg.v", "serv/rtl/serv_alu.v",
+    "serv/rtl/serv_csr.v", "serv/rtl/serv_ctrl.v", "serv/rtl/serv_decode.v",
+    "serv/rtl/serv_mem_if.v", "serv/rtl/serv_rf_if.v", "serv/rtl/serv_rf_ram_if.v",
+    "serv/rtl/serv_rf_ram.v", "serv/rtl/serv_state.v", "serv/rtl/serv_top.v",
+    "serv/rtl/serv_rf_top.v"
+]
+
+PICORV32_V_FILES = ["picorv32/picorv32.v"]
+CPU_V_FILES = {"serv": SERV_V_FILES, "picorv32": PICORV32_V_FILES}
+
+SIM_V = "build/cart-sim.v"
+V_FILES = ["verilog/cart_tb.v", SIM_V] + SERV_V_FILES
+CXX_FILES = ["cxxrtl/sim.cpp"]
+CXXFLAGS = ["-O2", "-shared", "-fPIC"]
+
+# Same reset window as cxxrtl/main.cpp.
+DEFAULT_STIMULUS = [(1, "rst", 1), (10, "rst", 0)]
+
+
+def generate_sim_verilog(path=SIM_V, sys_clk=0.5, **kwargs):
+    """ Elaborate CartSim to Verilog, ``kwargs`` go to ``Top``. The file is
+    only rewritten when the output changes, so the RTL hash stays stable
+    across runs. """
+    from build_cache import cached_verilog
+    from top import CartSim
+
+    cached_verilog(lambda: CartSim(sys_clk=sys_clk, **kwargs), path=path)
+    return path
+
+
+def yosys_datdir():
+    return subprocess.check_output(["yosys-config", "--datdir"]).decode().strip()
+
+
+def rtl_hash(v_files=V_FILES):
+    h = hashlib.sha256()
+    for name in v_files + CXX_FILES:
+        h.update(name.encode())
+        with open(name, "rb") as f:
+            h.update(f.read())
+    h.update(" ".join(CXXFLAGS).encode())
+    return h.hexdigest()[:16]
+
+
+def build(force=False, sim_v=SIM_V, sys_clk=0.5, cpu="serv", **kwargs):
+    """ Build the cxxrtl model as a shared library, reusing the cached one
+    if the RTL hasn't changed. Returns the path to the library. """
+    generate_sim_verilog(sim_v, sys_clk, cpu=cpu, **kwargs)
+    v_files = ["verilog/cart_tb.v", sim_v] + CPU_V_FILES[cpu]
+    key = rtl_hash(v_files)
+    build_dir = os.path.join("build", "cxxrtl", key)
+    lib = os.path.join(build_dir, "cart_tb.so")
+    if os.path.exists(lib) and not force:
+        return lib
+
+    os.makedirs(build_dir, exist_ok=True)
+    cpp = os.path.join(build_dir, "cart_tb.cpp")
+    script = os.path.join(build_dir, "proc.ys")
+    with open(script, "w") as f:
+        f.write("read_verilog {}\n".format(" ".join(v_files)))
+        f.write("hierarchy -check -top top\n")
+        f.write("write_cxxrtl -Og {}\n".format(cpp))
+    subprocess.check_call(["yosys", "-q", script])
+
+    subprocess.check_call(["g++", *CXXFLAGS,
+        "-I" + os.path.join(yosys_datdir(), "include"),
+        "-DTOP=\"{}\"".format(os.path.abspath(cpp)),
+        "-o", lib + ".tmp", *CXX_FILES])
+    os.replace(lib + ".tmp", lib)
+    return lib
+
+
+class CxxrtlSim:
+    """
+    Parameters
+    ----------
+    lib : str
+        Path to the shared library from ``build()``.
+    vcd : str
+        Waveform file, only used if ``dump_level`` is nonzero. A ``.fst``
+        path is compressed on the fly through ``vcd2fst``.
+    dump_level : int
+        0 = no trace, 1 = everything, 2 = no memories, 3 = wires only.
+    """
+    def __init__(self, lib, vcd=None, dump_level=0):
+        self.lib = ctypes.CDLL(os.path.abspath(lib))
+
+        c_sim = ctypes.c_void_p
+        u64 = ctypes.c_uint64
+        self.lib.sim_create.restype = c_sim
+        self.lib.sim_create.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        self.lib.sim_destroy.argtypes = [c_sim]
+        self.lib.sim_trace_window.argtypes = [c_sim, u64, u64]
+        self.lib.sim_trace_trigger.argtypes = [c_sim, ctypes.c_char_p, u64, u64]
+        self.lib.sim_poke.argtypes = [c_sim, ctypes.c_char_p, u64]
+        self.lib.sim_peek.argtypes = [c_sim, ctypes.c_char_p, ctypes.POINTER(u64)]
+        self.lib.sim_cycle.restype = u64
+        self.lib.sim_cycle.argtypes = [c_sim]
+        self.lib.sim_run.argtypes = [c_sim, u64]
+
+        # The model writes VCD to a path; for FST, that path is a fifo
+        # read by vcd2fst.
+        self.fifo = None
+        self.converter = None
+        if dump_level and vcd and vcd.endswith(".fst"):
+            self.fifo = os.path.join(tempfile.mkdtemp(), "waves.vcd")
+            os.mkfifo(self.fifo)
+            self.converter = subprocess.Popen(["vcd2fst", "-v", self.fifo, "-f", vcd])
+            vcd = self.fifo
+
+        self.handle = self.lib.sim_create((vcd or "").encode(), dump_level)
+
+    def close(self):
+        if self.handle:
+            self.lib.sim_destroy(self.handle)
+            self.handle = None
+        if self.converter is not None:
+            self.converter.wait()
+            os.unlink(self.fifo)
+            os.rmdir(os.path.dirname(self.fifo))
+            self.converter = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def cycle(self):
+        return self.lib.sim_cycle(self.handle)
+
+    def trace_window(self, start=0, stop=None):
+        self.lib.sim_trace_window(self.handle, start, stop if stop is not None else 2**64-1)
+
+    def trace_trigger(self, name, value, length=0):
+        """ Start tracing at the first cycle inside the trace window where
+        ``name`` equals ``value``, for ``length`` cycles (0 = until the
+        window ends). """
+        if not self.lib.sim_trace_trigger(self.handle, name.encode(), value, length):
+            raise KeyError(name)
+
+    def poke(self, name, value):
+        if not self.lib.sim_poke(self.handle, name.encode(), value):
+            raise KeyError(name)
+
+    def peek(self, name):
+        value = ctypes.c_uint64()
+        if not self.lib.sim_peek(self.handle, name.encode(), ctypes.byref(value)):
+            raise KeyError(name)
+        return value.value
+
+    def run(self, cycles, stimulus=DEFAULT_STIMULUS):
+        """ Run for ``cycles`` clocks. ``stimulus`` is a list of
+        ``(cycle, signal, value)`` pokes applied before that cycle; the
+        model runs uninterrupted in C between them. """
+        end = self.cycle + cycles
+        for at, name, value in sorted(stimulus):
+            if at >= end:
+                break
+            if at >= self.cycle:
+                self.lib.sim_run(self.handle, at - self.cycle)
+                self.poke(name, value)
+        self.lib.sim_run(self.handle, end - self.cycle)
+
+
+def bench_cxxrtl(cycles):
+    lib = build()
+    with CxxrtlSim(lib) as sim:
+        start = time.perf_counter()
+        sim.run(cycles)
+        return cycles / (time.perf_counter() - start)
+
+
+def bench_pysim(cycles):
+    from nmigen.back import pysim
+    from top import CartSim
+
+    cart = CartSim(sys_clk=50)
+    sim = pysim.Simulator(cart)
+    sim.add_clock(1/50e6)
+
+    def do_nothing():
+        for i in range(0, cycles):
+            yield
+    sim.add_sync_process(do_nothing)
+
+    start = time.perf_counter()
+    sim.run()
+    return cycles / (time.perf_counter() - start)
+
+
+def bench_iverilog():
+    # verilog/cart_tb.v runs for 1ms with a 20ns clock.
+    cycles = 1000000 // 20
+    subprocess.check_call(["make", "build/cart_tb"])
+    start = time.perf_counter()
+    subprocess.check_call(["./build/cart_tb"], stdout=subprocess.DEVNULL)
+    return cycles / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+    from waves import TraceWindow
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=100000)
+    p_action = parser.add_subparsers(dest="action")
+    p_action.add_parser("build")
+    p_run = p_action.add_parser("run")
+    p_run.add_argument("--vcd", default="cart_cxxrtl.vcd")
+    p_run.add_argument("--dump-level", type=int, default=0)
+    p_run.add_argument("--trace-start", type=int, default=0)
+    p_run.add_argument("--trace-stop", type=int, default=None)
+    p_run.add_argument("--trigger", type=TraceWindow.parse_trigger, default=None,
+        help="start tracing when a signal matches, e.g. 'top n64 n64_read_i=0'")
+    p_run.add_argument("--trace-length", type=int, default=0)
+    p_action.add_parser("bench")
+
+    args = parser.parse_args()
+
+    if args.action == "build":
+        print(build(force=True))
+
+    if args.action == "run":
+        with CxxrtlSim(build(), args.vcd, args.dump_level) as sim:
+            sim.trace_window(args.trace_start, args.trace_stop)
+            if args.trigger is not None:
+                sim.trace_trigger(*args.trigger, args.trace_length)
+            start = time.perf_counter()
+            sim.run(args.cycles)
+            rate = args.cycles / (time.perf_counter() - start)
+        print("cxxrtl: {} cycles, {:.0f} cycles/s".format(args.cycles, rate))
+
+    if args.action == "bench":
+        runners = [
+            ("cxxrtl", lambda: bench_cxxrtl(args.cycles)),
+            ("pysim", lambda: bench_pysim(min(args.cycles, 10000))),
+            ("iverilog", bench_iverilog),
+        ]
+        for name, runner in runners:
+            try:
+                rate = runner()
+                print("{:10s} {:12.0f} cycles/s".format(name, rate))
+            except Exception as e:
+                print("{:10s} skipped ({})".format(name, e))
@@ -0,0 +1,16 @@
+"""
+The ``@sim_test`` marker regress.py collects tests by, see there. Kept
+apart from the runner and free of dependencies, so that importing a
+gateware module doesn't pull the runner in.
+"""
+
+# Values the cart-level tests are run with.
+SYS_CLKS = [25, 50, 75]
+WITH_SDRAM = [False, True]
+
+
+def sim_test(**params):
+    def decorator(fn):
+        fn.sim_test_params = params
+        return fn
+    return decorator
@@ -0,0 +1,196 @@
+from nmigen import *
+from wb import WishboneBus
+from simtest import sim_test
+
+# SPI flash read command, no dummy cycles.
+SPI_READ = 0x03
+
+
+class WishboneSPIFlash(Elaboratable):
+    """
+        Read only window onto a SPI flash, for code that doesn't fit in
+        block RAM. Word ``n`` of ``bus`` is the four bytes at
+        ``offset + 4 * n``, little endian.
+
+        SCK runs at half the clock, in mode 0. A read sends ``SPI_READ``
+        and the address and shifts in 32 bits, about 130 clocks. CS stays
+        low afterwards, so reading the next word, like a burst or straight
+        line code does, only shifts in another 32 bits.
+
+        ``spi`` has the pins, ``cs`` is active high.
+
+    Parameters
+    ----------
+    offset : int
+        Byte address in the flash of word 0, past the bitstream.
+    size : int
+        Bytes in the window, a power of two.
+    """
+    def __init__(self, offset=0, size=0x100000):
+        assert size & (size - 1) == 0
+        self.offset = offset
+        self.size = size
+
+        self.bus = WishboneBus()
+        self.spi = Record([
+            ("cs", 1),
+            ("clk", 1),
+            ("mosi", 1),
+            ("miso", 1),
+            ])
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        spi = self.spi
+
+        addr = Signal(24)
+        m.d.comb += addr.eq(self.offset + Cat(Const(0, 2), bus.addr[2:(self.size - 1).bit_length()]))
+
+        # The flash sends the bytes from ``next_addr`` on while CS is low.
+        next_addr = Signal(24)
+        shift = Signal(32)
+        count = Signal(range(32))
+
+        m.d.comb += [
+            spi.mosi.eq(shift[31]),
+            bus.r_dat.eq(Cat(shift[24:], shift[16:24], shift[8:16], shift[:8])),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(bus.cyc & bus.stb):
+                    with m.If(spi.cs & (addr == next_addr)):
+                        m.next = "READ"
+                    with m.Else():
+                        m.d.sync += spi.cs.eq(0)
+                        m.next = "SELECT"
+
+            with m.State("SELECT"):
+                m.d.sync += [
+                    spi.cs.eq(1),
+                    shift.eq(Cat(addr, Const(SPI_READ, 8))),
+                ]
+                m.next = "CMD"
+
+            # The flash samples MOSI on the rising edge of SCK and changes
+            # MISO after the falling one, so both sides sample in the
+            # middle of a bit.
+            with m.State("CMD"):
+                m.d.sync += spi.clk.eq(~spi.clk)
+                with m.If(spi.clk):
+                    m.d.sync += [
+                        shift.eq(shift << 1),
+                        count.eq(count + 1),
+                    ]
+                    with m.If(count == 31):
+                        m.next = "READ"
+
+            # Ends on the falling edge after the last bit, with the next
+            # word's first bit on MISO, once ``count`` has wrapped around.
+            with m.State("READ"):
+                m.d.sync += spi.clk.eq(~spi.clk)
+                with m.If(~spi.clk):
+                    m.d.sync += [
+                        shift.eq(Cat(spi.miso, shift[:31])),
+                        count.eq(count + 1),
+                    ]
+                with m.Elif(count == 0):
+                    m.d.sync += next_addr.eq(addr + 4)
+                    m.next = "ACK"
+
+            with m.State("ACK"):
+                m.d.comb += bus.ack.eq(1)
+                m.next = "IDLE"
+
+        return m
+
+
+def spi_flash_model(spi, image):
+    """ Process for a SPI flash holding ``image`` (bytes), which only
+    knows ``SPI_READ``. Returns it and a list that collects the address of
+    every command. MISO changes right after the edge of SCK, like the
+    flash does within a few ns. """
+    from nmigen.back.pysim import Passive, Settle
+
+    commands = []
+
+    def proc():
+        yield Passive()
+        last_clk = 0
+        bits = 0
+        cmd = 0
+        while True:
+            yield
+            yield Settle()
+            cs = yield spi.cs
+            clk = yield spi.clk
+            if not cs:
+                bits = 0
+                cmd = 0
+            elif clk and not last_clk:
+                if bits < 32:
+                    cmd = cmd << 1 | (yield spi.mosi)
+                bits += 1
+                if bits == 32:
+                    assert cmd >> 24 == SPI_READ
+                    commands.append(cmd & 0xffffff)
+            elif not clk and last_clk and bits >= 32:
+                n = bits - 32
+                byte = image[(cmd & 0xffffff) + n // 8]
+                yield spi.miso.eq(byte >> (7 - n % 8) & 1)
+            last_clk = clk
+
+    return proc, commands
+
+
+@sim_test()
+def sim_spiflash():
+    from nmigen.back.pysim import Simulator
+
+    offset = 0x100
+    image = bytes(range(256)) * 4
+    flash = WishboneSPIFlash(offset=offset, size=0x200)
+    bus = flash.bus
+    model, commands = spi_flash_model(flash.spi, image)
+
+    def read(addr):
+        yield bus.addr.eq(addr)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        yield
+        cycles = 1
+        while not (yield bus.ack):
+            yield
+            cycles += 1
+        result = yield bus.r_dat
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield
+        return result, cycles
+
+    def word(addr):
+        return int.from_bytes(image[offset + addr:offset + addr + 4], "little")
+
+    def proc():
+        first, jump = yield from read(0x10)
+        assert first == word(0x10), hex(first)
+        # The next word follows without a new command.
+        second, follow = yield from read(0x14)
+        assert second == word(0x14), hex(second)
+        assert commands == [offset + 0x10]
+        assert follow < jump * 2 // 3, (follow, jump)
+
+        # Anything else starts over, and the window wraps around.
+        data, _ = yield from read(0x208)
+        assert data == word(0x8)
+        data, _ = yield from read(0x1fc)
+        assert data == word(0x1fc)
+        assert commands == [offset + 0x10, offset + 0x8, offset + 0x1fc]
+
+    sim = Simulator(flash)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(model)
+    sim.add_sync_process(proc)
+    sim.run()
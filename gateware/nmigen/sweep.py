@@ -0,0 +1,111 @@
+"""
+Builds the board design over a grid of PLL frequencies and nextpnr seeds,
+one build per worker process, and reports what each achieved.
+
+    python sweep.py --freqs 50 60 70 80 --seeds 1 2 3 4 --json sweep.json
+
+Builds go through build_cache, so rerunning a sweep only builds the new
+points.
+"""
+
+import concurrent.futures
+import os
+import re
+
+# Reports numbers for failing builds instead of aborting them.
+NEXTPNR_OPTS = "--timing-allow-fail"
+
+_fmax = re.compile(r"Max frequency for clock\s+'([^']+)':\s+([\d.]+) MHz \((PASS|FAIL) at ([\d.]+) MHz\)")
+_util = re.compile(r"(ICESTORM_LC|ICESTORM_RAM|SB_IO|ICESTORM_PLL):\s+(\d+)/\s*(\d+)")
+_endpoint = re.compile(r"(Source|Sink)\s+(\S+)")
+
+
+def parse_nextpnr_log(log):
+    """ Pulls Fmax per clock, resource use and the critical path endpoints
+    out of a nextpnr-ice40 log. Later reports (post-route) win. """
+    result = dict(clocks={}, util={}, critical_path=[])
+
+    for clock, fmax, status, target in _fmax.findall(log):
+        result["clocks"][clock] = dict(fmax=float(fmax), target=float(target), passed=status == "PASS")
+    for name, used, total in _util.findall(log):
+        result["util"][name] = (int(used), int(total))
+
+    # Only keep the last critical path report.
+    reports = log.split("Critical path report")
+    if len(reports) > 1:
+        endpoints = _endpoint.findall(reports[-1])
+        if endpoints:
+            result["critical_path"] = [endpoints[0][1], endpoints[-1][1]]
+
+    clocks = result["clocks"].values()
+    result["fmax"] = min((c["fmax"] for c in clocks), default=0.0)
+    result["passed"] = bool(clocks) and all(c["passed"] for c in clocks)
+    return result
+
+
+def build_point(sys_clk, seed):
+    from build_cache import cached_build
+    from n64_board import N64Platform
+    from top import CartConcretePLL
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    platform = N64Platform()
+    concrete = CartConcretePLL(sys_clk=sys_clk, uart_baud=115200, uart_delay=10000)
+    products = cached_build(platform, concrete, read_verilog_opts="-I../serv/rtl",
+        nextpnr_opts="{} --seed {}".format(NEXTPNR_OPTS, seed))
+
+    result = parse_nextpnr_log(products.get("top.tim", "t"))
+    result.update(sys_clk=sys_clk, seed=seed)
+    return result
+
+
+def pick_best(results):
+    """ Best seed at the highest frequency where some seed met timing. """
+    passing = [r for r in results if r["passed"]]
+    if not passing:
+        return None
+    return max(passing, key=lambda r: (r["sys_clk"], r["fmax"]))
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--freqs", type=float, nargs="+", default=[50, 55, 60, 65, 70])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--json", default=None)
+    args = parser.parse_args()
+
+    points = [(f, s) for f in args.freqs for s in args.seeds]
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(build_point, *p): p for p in points}
+        for future in concurrent.futures.as_completed(futures):
+            sys_clk, seed = futures[future]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("{} MHz seed {}: build failed ({})".format(sys_clk, seed, e))
+
+    results.sort(key=lambda r: (r["sys_clk"], r["seed"]))
+    print("{:>8s} {:>5s} {:>9s} {:>6s} {:>10s} {:>6s}  {}".format(
+        "sys_clk", "seed", "fmax", "timing", "LUTs", "EBR", "critical path"))
+    for r in results:
+        lc = r["util"].get("ICESTORM_LC", (0, 0))
+        ram = r["util"].get("ICESTORM_RAM", (0, 0))
+        print("{:8.2f} {:5d} {:9.2f} {:>6s} {:>10s} {:>6s}  {}".format(
+            r["sys_clk"], r["seed"], r["fmax"], "PASS" if r["passed"] else "FAIL",
+            "{}/{}".format(*lc), "{}/{}".format(*ram), " -> ".join(r["critical_path"])))
+
+    best = pick_best(results)
+    if best is None:
+        print("no build met timing")
+    else:
+        print("best: {} MHz with seed {} (fmax {:.2f} MHz)".format(best["sys_clk"], best["seed"], best["fmax"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(results=results, best=best), f, indent=2)
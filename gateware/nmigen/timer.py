@@ -0,0 +1,89 @@
+from nmigen import *
+from wb import WishboneBus
+from simtest import sim_test
+
+# Offsets in the CLINT layout, the block is mapped at 0x02000000.
+MTIMECMP = 0x4000
+MTIME = 0xbff8
+
+
+class WishboneTimer(Elaboratable):
+    """
+        RISC-V machine timer. ``mtime`` counts clock cycles, ``irq`` is
+        raised while ``mtime >= mtimecmp``. Both read and write as two
+        words, low word first. ``mtimecmp`` resets to all ones, so the
+        interrupt stays off until firmware sets it.
+    """
+    def __init__(self):
+        self.bus = WishboneBus()
+        self.mtime = Signal(64)
+        self.mtimecmp = Signal(64, reset=-1)
+        self.irq = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+
+        m.d.sync += self.mtime.eq(self.mtime + 1)
+        m.d.comb += self.irq.eq(self.mtime >= self.mtimecmp)
+
+        regs = {
+            MTIMECMP: self.mtimecmp[:32],
+            MTIMECMP + 4: self.mtimecmp[32:],
+            MTIME: self.mtime[:32],
+            MTIME + 4: self.mtime[32:],
+        }
+
+        with m.If(bus.cyc & ~bus.ack):
+            with m.Switch(bus.addr[:16]):
+                for offset, reg in regs.items():
+                    with m.Case(offset):
+                        m.d.sync += bus.r_dat.eq(reg)
+                        with m.If(bus.we):
+                            m.d.sync += reg.eq(bus.w_dat)
+        m.d.sync += bus.ack.eq(bus.cyc & ~bus.ack)
+
+        return m
+
+
+@sim_test()
+def sim_timer():
+    from nmigen.back.pysim import Simulator
+
+    timer = WishboneTimer()
+    bus = timer.bus
+
+    def access(addr, we=0, data=0):
+        yield bus.addr.eq(addr)
+        yield bus.we.eq(we)
+        yield bus.w_dat.eq(data)
+        yield bus.cyc.eq(1)
+        yield
+        while not (yield bus.ack):
+            yield
+        result = yield bus.r_dat
+        yield bus.cyc.eq(0)
+        yield
+        return result
+
+    def proc():
+        assert not (yield timer.irq)
+        now = yield from access(MTIME)
+        assert 0 < now < 10
+
+        yield from access(MTIMECMP + 4, 1, 0)
+        yield from access(MTIMECMP, 1, now + 20)
+        assert not (yield timer.irq)
+        for _ in range(20):
+            yield
+        assert (yield timer.irq)
+
+        # Writing mtime moves it like any other register.
+        yield from access(MTIME, 1, 0)
+        assert not (yield timer.irq)
+
+    sim = Simulator(timer)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
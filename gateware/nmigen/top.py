@@ -2,26 +2,72 @@ import os
 import struct
 
 from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
 from n64_board import *
 from uart import UART
 from ice40_pll import PLL
-from wb import WishboneRAM, WishboneUART, WishboneAddressDecoder, Peripheral
-from cpu import SERV, PicoRV32
-from cart import Cart
-from sdram import SDRAMController
+from wb import WishboneRAM, WishboneDualPortRAM, WishboneUART, WishboneAddressDecoder, WishboneCrossbar, Peripheral
+from dma import WishboneDMA
+from icache import WishboneICache
+from spiflash import WishboneSPIFlash
+from timer import WishboneTimer
+from irq import WishboneIRQController
+from cpu import CPUS
+from cart import Cart, PI_PWD_DEFAULT
+from sdram import SDRAMController, SDRAMCrossing, SDRAMArbiter
+from sdram_cal import SDRAMCalibration
+from picache import PICache
+from test import MockN64
+from simtest import sim_test, SYS_CLKS
+from firmware import load_irom, placeholder, IROM, IROM_WORDS, IRAM_BASE, IRAM_WORDS, \
+    FLASH_BASE, FLASH_OFFSET, FLASH_SIZE
+
+# IRQ_PENDING/IRQ_ENABLE bits, see irq.py.
+IRQ_UART = 0
+IRQ_DMA = 1
+IRQ_CART = 2
 
 class Top(Elaboratable):
-    def __init__(self, sys_clk, with_sdram):
+    def __init__(self, sys_clk, with_sdram, sdram_fast_init=False, irom_placeholder=False,
+                 icache_lines=0, cpu="serv", firmware=IROM, sdram_clk=None, sdram_delay_bits=0,
+                 pi_sync_stages=1, pi_ddr=False, pi_pwd=PI_PWD_DEFAULT, fast_pi=False,
+                 flash_code=False):
         self.sys_clk = sys_clk * 1e6
         self.with_sdram = with_sdram
-
-        self.cart = Cart(sys_clk)
-        self.cpu = SERV()
-        self.sdram = SDRAMController(self.sys_clk)
-        #self.uart = UART(int(self.sys_clk//115200))
-        self.buffer = Memory(width=16, depth=256)
+        # With its own clock, the SDRAM controller runs in the "sdram"
+        # domain and talks to the rest through self.sdram_port.
+        self.sdram_domain = "sdram" if sdram_clk else "sync"
+        sdram_clk = (sdram_clk or sys_clk) * 1e6
+        # Build with patchable placeholder ROMs, see firmware.py.
+        self.irom_placeholder = irom_placeholder
+        self.firmware = firmware
+
+        self.cart = Cart(sys_clk, sync_stages=pi_sync_stages, ddr=pi_ddr, pi_pwd=pi_pwd,
+            fast_pi=fast_pi, save=with_sdram)
+        self.cpu = CPUS[cpu]()
+        # PicoRV32 fetches through its only bus, on the data side.
+        self.split_bus = hasattr(self.cpu, "ibus")
+
+        # Instruction cache in front of the ibus interconnect, 0 for none.
+        # It pays off for code in the SPI flash, block RAM is as fast.
+        if (icache_lines or flash_code) and not self.split_bus:
+            raise ValueError("The instruction cache and code in flash need a core with a separate ibus")
+        self.icache = WishboneICache(lines=icache_lines) if icache_lines else None
+        self.spiflash = WishboneSPIFlash(FLASH_OFFSET, FLASH_SIZE) if flash_code else None
+        self.sdram = SDRAMController(sdram_clk, fast_init=sdram_fast_init)
+        self.sdram_port = SDRAMCrossing(self.sdram, sdram_domain=self.sdram_domain)
+        # Read capture settings, applied by the board, see CartConcrete.
+        self.sdram_cal = SDRAMCalibration(delay_bits=sdram_delay_bits)
+        # ROM reads from the PI, see picache.py.
+        self.picache = PICache()
+        # Calibration goes first, it only runs before there is a ROM. Saves
+        # are queued, so they come last.
+        self.sdram_arbiter = SDRAMArbiter(3)
 
         self.wb_uart = WishboneUART(int(self.sys_clk//115200))
+        self.dma = WishboneDMA()
+        self.timer = WishboneTimer()
+        self.irqc = WishboneIRQController([self.wb_uart.irq, self.dma.irq, self.cart.access])
 
     def elaborate(self, platform):
         m = Module()
@@ -30,123 +76,94 @@ class Top(Elaboratable):
         m.submodules.cpu = self.cpu
         
         if self.with_sdram:
-            m.submodules.sdram_ctrl = self.sdram
+            m.submodules.sdram_ctrl = DomainRenamer({"sync": self.sdram_domain})(self.sdram)
+            m.submodules.sdram_port = self.sdram_port
+            m.submodules.sdram_cal = self.sdram_cal
+            m.submodules.picache = self.picache
+            m.submodules.sdram_arbiter = self.sdram_arbiter
+            m.d.comb += [
+                self.sdram_cal.port.connect_to(self.sdram_arbiter.masters[0]),
+                self.picache.port.connect_to(self.sdram_arbiter.masters[1]),
+                self.cart.save.port.connect_to(self.sdram_arbiter.masters[2]),
+                self.sdram_arbiter.port.connect_to(self.sdram_port.port),
+                self.picache.addr.eq(self.cart.rom_addr[1:]),
+                self.picache.access.eq(self.cart.access),
+                self.picache.read.eq(self.cart.rom_read),
+                self.picache.invalidate.eq(self.sdram_cal.written),
+                self.picache.written.eq(self.cart.save.written),
+                self.picache.written_addr.eq(self.cart.save.written_addr),
+                self.cart.rom_data.eq(self.picache.data),
+            ]
+            m.submodules += FFSynchronizer(self.sdram_cal.read_stage, self.sdram.read_stage,
+                o_domain=self.sdram_domain)
+
+        if self.irom_placeholder:
+            irom_init = placeholder("irom")
+            drom_init = placeholder("drom")
+        else:
+            irom_init = drom_init = load_irom(self.firmware)
 
-        with open("irom/irom.bin", "rb") as irom_file:
-            irom_init = list(map(lambda a: a[0], struct.iter_unpack("<I",irom_file.read())))
-
-        irom_init += [0xbeeffac0] * (128-len(irom_init))
         irom = WishboneRAM(init=irom_init)
-        
-        drom_init = [0xbeeffac0] * (128)
-        drom = WishboneRAM(init=irom_init)
-
-        decoder = WishboneAddressDecoder(decodes = [
-            Peripheral(drom, 0, 128 * 4),
-            Peripheral(self.wb_uart, 0x10000000, 0x8)
-        ])
-
+        # Programs loaded by the boot ROM, see irom/boot.s.
+        iram = WishboneDualPortRAM(depth=IRAM_WORDS)
         m.submodules.irom = irom
-        m.submodules.drom = drom
-        m.submodules.wb_uart = self.wb_uart
-        m.submodules.decoder = decoder
-
-        m.d.comb += self.cpu.ibus.connect_to(irom.bus)
-        m.d.comb += self.cpu.dbus.connect_to(decoder.bus)
-
-        a_counter = Signal(16)
-        d_counter = Signal(16)
-        data = Signal(16)
+        m.submodules.iram = iram
+
+        # With a split bus, data reads of the ROM go to a copy of it.
+        if self.split_bus:
+            drom = WishboneRAM(init=drom_init)
+            m.submodules.drom = drom
+        else:
+            drom = irom
+
+        # The CPU data bus and the DMA engine share the data side.
+        xbar = WishboneCrossbar(2, decodes = [
+            Peripheral(drom, 0, IROM_WORDS * 4),
+            Peripheral(iram, IRAM_BASE, IRAM_WORDS * 4),
+            Peripheral(self.timer, 0x02000000, 0x10000),
+            Peripheral(self.wb_uart, 0x10000000, 0x8),
+            Peripheral(self.dma, 0x10001000, 0x20),
+            Peripheral(self.irqc, 0x10003000, 0x8),
+            Peripheral(self.cart, 0x10005000, 0x10),
+        ] + ([
+            Peripheral(self.icache, 0x10002000, 0x8, bus=self.icache.ctrl)
+        ] if self.icache else []) + ([
+            Peripheral(self.sdram_cal, 0x10004000, 0x10),
+            Peripheral(self.picache, 0x10006000, 0x10, bus=self.picache.ctrl),
+        ] if self.with_sdram else []))
 
-        write_happened = Signal()
-        read_happened = Signal()
-
-        buffer_r = self.buffer.read_port()
-        buffer_w = self.buffer.write_port()
-        m.d.comb += buffer_r.addr.eq(a_counter)
-        m.d.comb += buffer_w.addr.eq(a_counter)
-
-        m.submodules += buffer_r
-        m.submodules += buffer_w
-
-        #m.submodules.uart = uart = self.uart
-        """
-        m.d.sync += uart.tx_rdy.eq(0)
-        m.d.sync += buffer_w.en.eq(0)
+        m.submodules.wb_uart = self.wb_uart
+        m.submodules.dma = self.dma
+        m.submodules.timer = self.timer
+        m.submodules.irqc = self.irqc
+        m.submodules.xbar = xbar
+
+        if self.split_bus:
+            idecoder = WishboneAddressDecoder(decodes = [
+                Peripheral(irom, 0, IROM_WORDS * 4),
+                Peripheral(iram, IRAM_BASE, IRAM_WORDS * 4, bus=iram.ibus),
+            ] + ([
+                Peripheral(self.spiflash, FLASH_BASE, FLASH_SIZE),
+            ] if self.spiflash else []))
+            m.submodules.idecoder = idecoder
+            if self.spiflash:
+                m.submodules.spiflash = self.spiflash
+
+            if self.icache:
+                m.submodules.icache = self.icache
+                m.d.comb += self.cpu.ibus.connect_to(self.icache.bus)
+                m.d.comb += self.icache.master.connect_to(idecoder.bus)
+            else:
+                m.d.comb += self.cpu.ibus.connect_to(idecoder.bus)
+            m.d.comb += self.cpu.dbus.connect_to(xbar.masters[0])
+        else:
+            m.d.comb += self.cpu.bus.connect_to(xbar.masters[0])
+        m.d.comb += self.dma.master.connect_to(xbar.masters[1])
+
+        # Both cores take a single interrupt, the handler tells the timer
+        # from the rest by IRQ_PENDING.
+        m.d.comb += self.cpu.timer_irq.eq(self.timer.irq | self.irqc.irq)
 
-        if self.with_sdram:
-            m.d.sync += self.sdram.data_out.eq(0xff)
-
-            with m.FSM() as fsm:
-                with m.State("wait_sdram"):
-                    m.d.sync += self.sdram.cmd.eq(1)
-                    with m.If(self.sdram.cmd_ack == 1):
-                        m.d.sync += self.sdram.cmd.eq(0)
-                        m.next = "write"
-                with m.State("write"):
-                    with m.If(self.sdram.wr_valid):
-                        m.d.sync += write_happened.eq(1)
-                        
-                        #with m.If(d_counter == 64):
-                        #    m.d.sync += d_counter.eq(0)
-                        #with m.Else():
-                        m.d.sync += d_counter.eq(d_counter+1)
-                        m.d.sync += self.sdram.data_out.eq(d_counter)
-                        #with m.If(write_happened):
-                        #    m.d.sync += a_counter.eq(a_counter+1)
-                    with m.Else():
-                        with m.If(write_happened):
-                            m.d.sync += write_happened.eq(0)
-                            m.next = "read_req"
-                
-                with m.State("wait"):
-                    counter = Signal(8)
-                    with m.If(counter == 255):
-                        m.d.sync += counter.eq(0)
-                        m.next = "read_req"
-                    with m.Else():
-                        m.d.sync += counter.eq(counter+1)
-                with m.State("read_req"):
-                    m.d.sync += self.sdram.cmd.eq(3)
-                    with m.If(self.sdram.cmd_ack == 3):
-                        m.d.sync += self.sdram.cmd.eq(0)
-                        m.d.sync += a_counter.eq(0)
-                        m.next = "read"
-                with m.State("read"):
-                    with m.If(self.sdram.rd_valid):
-                        m.d.sync += read_happened.eq(1)
-
-                        m.d.sync += a_counter.eq(a_counter+1)
-                        m.d.sync += buffer_w.en.eq(1)
-                        m.d.sync += buffer_w.data.eq(self.sdram.data_in)
-
-                    with m.Elif(read_happened):
-                        m.d.sync += read_happened.eq(0)
-                        m.d.sync += a_counter.eq(0)
-                        m.next = "readout"
-                with m.State("readout"):
-                    with m.If(a_counter < 0x100):
-                        m.d.sync += [
-                            uart.tx_data.eq(buffer_r.data[0:8]),
-                            uart.tx_rdy.eq(1),
-                            a_counter.eq(a_counter+1)
-                        ]
-                        m.next = "wait_uart"
-                    with m.Else():
-                        m.next = "done"
-                with m.State("wait_uart"):
-                    with m.If(uart.tx_ack):
-                        m.next = "wait_char_delay"
-                with m.State("wait_char_delay"):
-                    timer = Signal(16)
-                    m.d.sync += timer.eq(timer+1)
-                    with m.If(timer > 10000):
-                        m.d.sync += timer.eq(0)
-                        m.next = "readout"
-                with m.State("done"):
-                    pass
-        return m
-        """
         return m
 
     def ports(self):
@@ -154,15 +171,30 @@ class Top(Elaboratable):
 
 
 class CartConcrete(Elaboratable):
-    def __init__(self, sys_clk, uart_baud, uart_delay):
+    def __init__(self, sys_clk, uart_baud, uart_delay, irom_placeholder=False, cpu="serv",
+                 sdram_clk=None, pi_sync_stages=1, pi_ddr=False, fast_pi=False, flash_code=False):
         self.sys_clk = sys_clk
+        self.sdram_clk = sdram_clk
+        self.pi_sync_stages = pi_sync_stages
+        self.pi_ddr = pi_ddr
+        self.fast_pi = fast_pi
         self.uart_baud = uart_baud
         self.uart_delay = uart_delay
+        self.irom_placeholder = irom_placeholder
+        self.cpu = cpu
+        # Code in the SPI flash, behind the instruction cache.
+        self.flash_code = flash_code
+        # Domain that clocks the SDRAM clock pin, see CartConcretePLL.
+        self.sdram_clk_domain = "sdram" if sdram_clk else "sync"
+        # Fine delay taps of that clock, set by CartConcretePLL.
+        self.sdram_delay_bits = 0
 
     def elaborate(self, platform):
         m = Module()
 
-        n64 = platform.request("n64", xdr={'ad': 1, 'read': 1, 'write': 1, 'ale_l': 1, 'ale_h': 1})
+        strobe_xdr = 2 if self.pi_ddr else 1
+        n64 = platform.request("n64", xdr={'ad': 1, 'read': strobe_xdr, 'write': strobe_xdr,
+            'ale_l': strobe_xdr, 'ale_h': strobe_xdr})
 
         sdram = platform.request("sdram", xdr = 
             { 
@@ -182,9 +214,23 @@ class CartConcrete(Elaboratable):
         uart_tx = platform.request("io",6)
         uart_rx = platform.request("io",7)
 
-        top = Top(self.sys_clk, with_sdram=True)
+        top = Top(self.sys_clk, with_sdram=True, irom_placeholder=self.irom_placeholder,
+            cpu=self.cpu, sdram_clk=self.sdram_clk, sdram_delay_bits=self.sdram_delay_bits,
+            pi_sync_stages=self.pi_sync_stages, pi_ddr=self.pi_ddr, fast_pi=self.fast_pi,
+            flash_code=self.flash_code, icache_lines=16 if self.flash_code else 0)
+        self.top = top
         cart = top.cart
 
+        if self.flash_code:
+            flash = platform.request("spi_flash_1x")
+            spi = top.spiflash.spi
+            m.d.comb += [
+                flash.cs.o.eq(spi.cs),
+                flash.clk.o.eq(spi.clk),
+                flash.mosi.o.eq(spi.mosi),
+                spi.miso.eq(flash.miso.i),
+            ]
+
         m.d.comb += [
             uart_tx.oe.eq(1),
             uart_rx.oe.eq(0),
@@ -203,23 +249,26 @@ class CartConcrete(Elaboratable):
         ]
 
         m.d.comb += [
-            sdram.dq.o.eq(cart.n64.ad_o),
+            n64.ad.o.eq(cart.n64.ad_o),
 
             n64.ad.oe.eq(cart.n64.ad_oe),
 
             cart.n64.ad_i.eq(n64.ad.i),
-            cart.n64.read.eq(n64.read.i),
-            cart.n64.write.eq(n64.write.i),
-            cart.n64.ale_l.eq(n64.ale_l.i),
-            cart.n64.ale_h.eq(n64.ale_h.i),
         ]
+        for name in ["read", "write", "ale_l", "ale_h"]:
+            pin = getattr(n64, name)
+            m.d.comb += getattr(cart.n64, name).eq(Cat(pin.i0, pin.i1) if self.pi_ddr else pin.i)
 
-        clk = ClockSignal()
+        clk = ClockSignal(top.sdram_domain)
         sdram_ctrl = top.sdram.sdram
+        # Inverting the clock moves the read capture by half a cycle. It
+        # only changes between calibration bursts, so a glitch there does
+        # no harm.
+        invert_clk = top.sdram_cal.invert_clk
         m.d.comb += [
-            sdram.clk.o0.eq(0),
-            sdram.clk.o1.eq(1),
-            sdram.clk.o_clk.eq(clk),
+            sdram.clk.o0.eq(invert_clk),
+            sdram.clk.o1.eq(~invert_clk),
+            sdram.clk.o_clk.eq(ClockSignal(self.sdram_clk_domain)),
 
             sdram.clk_en.o.eq(sdram_ctrl.cke),
             sdram.clk_en.o_clk.eq(clk),
@@ -258,31 +307,58 @@ class CartConcrete(Elaboratable):
         return m
 
 class CartConcretePLL(CartConcrete):
-    def __init__(self, *args, **kwargs):
+    """ With ``sdram_phase``, the SDRAM clock pin runs from a second PLL
+    output 90 degrees behind the controller clock, with the PLL's fine
+    delay swept by the read calibration. With ``sdram_clk``,
+    the SDRAM controller gets the second PLL of the HX4K to itself, the
+    PI front end and the CPU stay at ``sys_clk``. """
+    def __init__(self, *args, sdram_phase=False, **kwargs):
         super().__init__(*args, **kwargs)
+        self.sdram_phase = sdram_phase
+        if sdram_phase:
+            self.sdram_clk_domain = "sdram_clk"
+            self.sdram_delay_bits = 4
 
     def elaborate(self, platform):
         m = Module()
         clk_pin = ClockSignal("sync")
 
-        pll = PLL(freq_in_mhz=25, freq_out_mhz=self.sys_clk)
-        m.domains += pll.domain
-        m.submodules += [pll]
-        m.d.comb += [
-            pll.clk_pin.eq(clk_pin),
-        ]
+        sdram_phase_domain = "sdram_clk" if self.sdram_phase else None
+        pll = PLL(freq_in_mhz=25, freq_out_mhz=self.sys_clk,
+            phase_domain_name=None if self.sdram_clk else sdram_phase_domain,
+            dynamic_delay=self.sdram_phase and not self.sdram_clk)
+        plls = [pll]
+        if self.sdram_clk:
+            plls.append(PLL(freq_in_mhz=25, freq_out_mhz=self.sdram_clk, domain_name="sdram",
+                phase_domain_name=sdram_phase_domain, dynamic_delay=self.sdram_phase))
+
+        for p in plls:
+            m.domains += p.domain
+            if p.phase_domain_name is not None:
+                m.domains += p.phase_domain
+            m.submodules += p
+            m.d.comb += p.clk_pin.eq(clk_pin)
         cap = super().elaborate(platform)
         m.submodules.top = DomainRenamer({'sync': 'pll'})(cap)
+
+        for p in plls:
+            if p.dynamic_delay:
+                m.d.comb += p.delay.eq(self.top.sdram_cal.delay)
         return m
 
-from test import MockN64
 class CartSim(Elaboratable):
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
-        kwargs["with_sdram"] = False
-
-        self.uart_tx = Signal()
+        kwargs.setdefault("with_sdram", False)
+        # Only the SDRAM model in sdram/sdr.v takes the shortened
+        # power-up sequence, see SDRAMController.
+        if kwargs["with_sdram"]:
+            kwargs.setdefault("sdram_fast_init", True)
+        # MockN64 counts its delays in clocks, not ns.
+        kwargs.setdefault("pi_pwd", None)
+
+        self.uart_tx = Signal(name="uart_tx")
         self.uart_rx = Signal()
 
         self.n64 = MockN64()
@@ -292,6 +368,9 @@ class CartSim(Elaboratable):
         m = Module()
         m.submodules.sim_wrapper = self.top
 
+        # Firmware output, decoded by bench.py.
+        m.d.comb += self.uart_tx.eq(self.top.wb_uart.uart.tx_o)
+
         cart = self.top.cart
         n64 = self.n64
 
@@ -328,20 +407,61 @@ class CartSim(Elaboratable):
     def ports(self):
         return []
 
+@sim_test(sys_clk=SYS_CLKS)
+def sim_cart(sys_clk, cycles=10000):
+    """ The cart answers MockN64's reads. Without SDRAM only, pysim has no
+    model of it and leaves out ``sdr_wrapper``, so that is up to
+    ``sim_iverilog``. """
+    from nmigen.back import pysim
+
+    cart = CartSim(sys_clk=sys_clk)
+    n64 = cart.n64
+
+    sim = pysim.Simulator(cart)
+    sim.add_clock(1/(sys_clk*1e6))
+
+    def check_reads():
+        driven = 0
+        for i in range(0, cycles):
+            driven += yield n64.ad.oe
+            yield
+        assert driven > 0, "cart never drove the bus"
+
+    sim.add_sync_process(check_reads)
+    sim.run()
+
 if __name__ == "__main__":
     import sys
+    from build_cache import cached_verilog, cached_build
     if len(sys.argv) > 1:
+        # An optional second argument writes the Verilog to that file
+        # instead, leaving it untouched if the design didn't change.
+        out = sys.argv[2] if len(sys.argv) > 2 else None
         if sys.argv[1] == "generate-top":
-            from nmigen.back import rtlil, verilog
-
-            top = Top(sys_clk=0.5)
-            print(verilog.convert(top, ports=top.ports(), name="top"))
+            text = cached_verilog(lambda: Top(sys_clk=0.5, with_sdram=True), path=out)
+            if out is None:
+                print(text)
         if sys.argv[1] == "generate-top-sim":
-            from nmigen.back import rtlil, verilog
-
-            top = CartSim(sys_clk=0.5)
-            print(verilog.convert(top, ports=top.ports(), name="top"))
+            text = cached_verilog(lambda: CartSim(sys_clk=0.5), path=out)
+            if out is None:
+                print(text)
         elif sys.argv[1] == "sim":
+            import argparse
+            from waves import WaveformFile, TraceWindow, add_trace_process
+
+            parser = argparse.ArgumentParser(prog="top.py sim")
+            parser.add_argument("--cycles", type=int, default=10000)
+            parser.add_argument("-o", "--output", default="/tmp/cart.vcd",
+                help="waveform file, .fst is compressed through vcd2fst")
+            parser.add_argument("--full", action="store_true",
+                help="dump every signal in the design for the whole run")
+            parser.add_argument("--trace-start", type=int, default=0)
+            parser.add_argument("--trace-stop", type=int, default=None)
+            parser.add_argument("--trigger", type=TraceWindow.parse_trigger, default=None,
+                help="start tracing when a port matches, e.g. n64_read_i=0")
+            parser.add_argument("--trace-length", type=int, default=None)
+            args = parser.parse_args(sys.argv[2:])
+
             cart = CartSim(sys_clk=50)
             n64 = cart.n64
 
@@ -350,18 +470,29 @@ if __name__ == "__main__":
             sim = pysim.Simulator(cart)
             ports = [n64.ale_h.i, cart.n64.ale_l.i, n64.read.i, n64.write.i, n64.ad.i, n64.ad.o]
 
-            with sim.write_vcd(vcd_file=open("/tmp/cart.vcd", "w"),
-                    gtkw_file=open("/tmp/cart.gtkw", "w"),
-                    traces=ports):
-                sim.add_clock(1/50e6)
-
-                def do_nothing():
-                    for i in range(0, 10000):
-                        yield
-
-                sim.add_sync_process(do_nothing)
+            sim.add_clock(1/50e6)
+
+            def do_nothing():
+                for i in range(0, args.cycles):
+                    yield
+
+            sim.add_sync_process(do_nothing)
+
+            if args.full:
+                waves = WaveformFile(args.output)
+                # The save file takes the size of the VCD, a pipe to
+                # vcd2fst has none.
+                gtkw_file = None if waves.proc else open("/tmp/cart.gtkw", "w")
+                with sim.write_vcd(vcd_file=waves.file, gtkw_file=gtkw_file, traces=ports):
+                    sim.run()
+                waves.close()
+            else:
+                window = TraceWindow(args.trace_start, args.trace_stop,
+                    args.trigger, args.trace_length)
+                waves = add_trace_process(sim, ports, args.output, window)
                 sim.run()
+                waves.close()
     else:
         platform = N64Platform()
         concrete = CartConcretePLL(sys_clk = 50, uart_baud = 115200, uart_delay = 10000)
-        platform.build(concrete, read_verilog_opts="-I../serv/rtl", do_program=True)
\ No newline at end of file
+        cached_build(platform, concrete, read_verilog_opts="-I../serv/rtl", do_program=True)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from nmigen import *
+from simtest import sim_test
 
 
 class UART(Elaboratable):
@@ -86,61 +87,71 @@ class UART(Elaboratable):
         return m
 
 
-if __name__ == "__main__":
+@sim_test()
+def sim_loopback(vcd_file=None, gtkw_file=None):
+    from nmigen.back.pysim import Simulator, Passive
+
     uart = UART(divisor=5)
-    ports = [
-        uart.tx_o, uart.rx_i,
-        uart.tx_data, uart.tx_rdy, uart.tx_ack,
-        uart.rx_data, uart.rx_rdy, uart.rx_err, uart.rx_ovf, uart.rx_ack
-    ]
 
-    import argparse
+    sim = Simulator(uart)
+    sim.add_clock(1e-6)
 
-    parser = argparse.ArgumentParser()
-    p_action = parser.add_subparsers(dest="action")
-    p_action.add_parser("simulate")
-    p_action.add_parser("generate")
+    def loopback_proc():
+        yield Passive()
+        while True:
+            yield uart.rx_i.eq((yield uart.tx_o))
+            yield
+    sim.add_sync_process(loopback_proc)
 
-    args = parser.parse_args()
-    if args.action == "simulate":
-        from nmigen.back.pysim import Simulator, Passive
+    def transmit_proc():
+        assert (yield uart.tx_ack)
+        assert not (yield uart.rx_rdy)
 
-        sim = Simulator(uart)
-        sim.add_clock(1e-6)
+        yield uart.tx_data.eq(0x5A)
+        yield uart.tx_rdy.eq(1)
+        yield
+        yield uart.tx_rdy.eq(0)
+        yield
+        assert not (yield uart.tx_ack)
 
-        def loopback_proc():
-            yield Passive()
-            while True:
-                yield uart.rx_i.eq((yield uart.tx_o))
-                yield
-        sim.add_sync_process(loopback_proc)
+        for _ in range(uart.divisor * 12): yield
 
-        def transmit_proc():
-            assert (yield uart.tx_ack)
-            assert not (yield uart.rx_rdy)
+        assert (yield uart.tx_ack)
+        assert (yield uart.rx_rdy)
+        assert not (yield uart.rx_err)
+        assert (yield uart.rx_data) == 0x5A
 
-            yield uart.tx_data.eq(0x5A)
-            yield uart.tx_rdy.eq(1)
-            yield
-            yield uart.tx_rdy.eq(0)
-            yield
-            assert not (yield uart.tx_ack)
+        yield uart.rx_ack.eq(1)
+        yield
+    sim.add_sync_process(transmit_proc)
 
-            for _ in range(uart.divisor * 12): yield
+    if vcd_file is not None:
+        with sim.write_vcd(vcd_file, gtkw_file):
+            sim.run()
+    else:
+        sim.run()
 
-            assert (yield uart.tx_ack)
-            assert (yield uart.rx_rdy)
-            assert not (yield uart.rx_err)
-            assert (yield uart.rx_data) == 0x5A
 
-            yield uart.rx_ack.eq(1)
-            yield
-        sim.add_sync_process(transmit_proc)
+if __name__ == "__main__":
+    import argparse
 
-        with sim.write_vcd("uart.vcd", "uart.gtkw"):
-            sim.run()
+    parser = argparse.ArgumentParser()
+    p_action = parser.add_subparsers(dest="action")
+    p_action.add_parser("simulate")
+    p_action.add_parser("generate")
+
+    args = parser.parse_args()
+    if args.action == "simulate":
+        sim_loopback("uart.vcd", "uart.gtkw")
 
     if args.action == "generate":
         from nmigen.back import verilog
 
+        uart = UART(divisor=5)
+        ports = [
+            uart.tx_o, uart.rx_i,
+            uart.tx_data, uart.tx_rdy, uart.tx_ack,
+            uart.rx_data, uart.rx_rdy, uart.rx_err, uart.rx_ovf, uart.rx_ack
+        ]
+
         print(verilog.convert(uart, ports=ports))
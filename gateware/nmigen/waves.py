@@ -0,0 +1,110 @@
+import subprocess
+
+from nmigen.back.pysim import Passive
+from vcd import VCDWriter
+
+
+class WaveformFile:
+    """
+    Output file for waveforms. Paths ending in ``.fst`` are streamed
+    through GTKWave's ``vcd2fst`` so the uncompressed VCD never hits the
+    disk; anything else is written as plain VCD.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.proc = None
+        self.writer = None
+
+        if path.endswith(".fst"):
+            self.proc = subprocess.Popen(["vcd2fst", "-v", "-", "-f", path],
+                stdin=subprocess.PIPE, universal_newlines=True)
+            self.file = self.proc.stdin
+        else:
+            self.file = open(path, "w")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.file.close()
+        if self.proc is not None:
+            self.proc.wait()
+
+
+class TraceWindow:
+    """
+    Which cycles of a simulation end up in the waveform.
+
+    Parameters
+    ----------
+    start : int
+        First cycle to record.
+    stop : int or None
+        Cycle to stop recording at, ``None`` records until the end.
+    trigger : (str, int) or None
+        Signal name and value. Recording starts at the first cycle at or
+        after ``start`` where the signal has that value and runs for
+        ``length`` cycles.
+    length : int or None
+        Number of cycles to record after the trigger fired.
+    """
+    def __init__(self, start=0, stop=None, trigger=None, length=None):
+        self.start = start
+        self.stop = stop
+        self.trigger = trigger
+        self.length = length
+
+    @staticmethod
+    def parse_trigger(text):
+        """ Parse ``name=value`` as given on the command line. """
+        name, value = text.split("=")
+        return name, int(value, 0)
+
+
+def add_trace_process(sim, signals, path, window=TraceWindow(), clk_period=1/50e6):
+    """
+    Record ``signals`` to ``path`` from a passive sync process, only for
+    the cycles selected by ``window``. Unlike ``Simulator.write_vcd``,
+    this doesn't dump every signal in the design for the whole run.
+
+    Returns the ``WaveformFile``, which must be closed after the run.
+    """
+    out = WaveformFile(path)
+    out.writer = writer = VCDWriter(out.file, timescale="1 ns", comment="Generated by waves.py")
+
+    variables = []
+    for signal in signals:
+        var = writer.register_var(scope="top", name=signal.name,
+            var_type="wire", size=signal.width, init=signal.reset)
+        variables.append((signal, var))
+
+    by_name = {signal.name: signal for signal in signals}
+    if window.trigger is not None:
+        trigger_signal = by_name[window.trigger[0]]
+
+    def trace_proc():
+        yield Passive()
+
+        cycle = 0
+        stop = window.stop
+        armed = window.trigger is None
+        last = [None] * len(variables)
+        while True:
+            if cycle >= window.start and not armed:
+                if (yield trigger_signal) == window.trigger[1]:
+                    armed = True
+                    if window.length is not None:
+                        stop = cycle + window.length
+
+            if armed and cycle >= window.start and (stop is None or cycle < stop):
+                timestamp = int(cycle * clk_period * 1e9)
+                for i, (signal, var) in enumerate(variables):
+                    value = yield signal
+                    if value != last[i]:
+                        writer.change(var, timestamp, value)
+                        last[i] = value
+
+            cycle += 1
+            yield
+
+    sim.add_sync_process(trace_proc)
+    return out
@@ -1,5 +1,18 @@
 from nmigen import *
 from uart import UART
+from simtest import sim_test
+
+# Cycle type identifiers.
+CTI_CLASSIC = 0b000
+CTI_CONST_BURST = 0b001
+CTI_INCR_BURST = 0b010
+CTI_END_OF_BURST = 0b111
+
+# Burst type extensions for incrementing bursts.
+BTE_LINEAR = 0b00
+BTE_WRAP_4 = 0b01
+BTE_WRAP_8 = 0b10
+BTE_WRAP_16 = 0b11
 
 class WishboneBus(Record):
     def __init__(self, data_width=32, addr_width=32):
@@ -11,7 +24,12 @@ class WishboneBus(Record):
             ("sel", data_width//8),
             ("addr", addr_width),
             ("r_dat", data_width),
-            ("w_dat", data_width)
+            ("w_dat", data_width),
+            # Registered feedback bursts, see CTI_* and BTE_*.
+            ("cti", 3),
+            ("bte", 2),
+            # Pipelined mode only.
+            ("stall", 1),
             ])
 
 
@@ -31,26 +49,96 @@ class WishboneBus(Record):
             other.we.eq(self.we),
             other.addr.eq(self.addr),
             other.w_dat.eq(self.w_dat),
+            other.cti.eq(self.cti),
+            other.bte.eq(self.bte),
 
             self.ack.eq(other.ack),
-            self.r_dat.eq(other.r_dat)
+            self.r_dat.eq(other.r_dat),
+            self.stall.eq(other.stall)
         ]
 
 class WishboneRAM(Elaboratable):
-    def __init__(self, init):
+    """
+        Single port RAM. Writes honour ``sel``.
+
+        In classic mode an access is acked the cycle after it is requested.
+        Incrementing bursts (``cti`` of ``CTI_INCR_BURST``, wrapped as given
+        by ``bte``) keep ack up and prefetch the next word, so every cycle
+        after the first moves a word until ``CTI_END_OF_BURST``.
+
+        With ``pipelined`` the bus follows the B4 pipelined protocol instead:
+        ``stall`` is never raised, a new request is accepted every cycle and
+        acked one cycle later.
+    """
+    def __init__(self, init, pipelined=False):
         self.init = init
+        self.pipelined = pipelined
         self.bus = WishboneBus()
 
     def elaborate(self, platform):
         m = Module()
 
+        bus = self.bus
+
         backing = Memory(width=32, depth=len(self.init), init=self.init)
         m.submodules.rd = rd = backing.read_port()
-        m.submodules.wr = wr = backing.write_port()
+        m.submodules.wr = wr = backing.write_port(granularity=8)
 
-        stb_delayed = Signal()
+        word = bus.addr[2:]
+        request = bus.cyc & bus.stb
 
-        m.d.sync += wr.en.eq(0)
+        m.d.comb += [
+            wr.addr.eq(word),
+            wr.data.eq(bus.w_dat),
+            bus.r_dat.eq(rd.data),
+        ]
+
+        if self.pipelined:
+            m.d.comb += [
+                bus.stall.eq(0),
+                rd.addr.eq(word),
+            ]
+            m.d.sync += bus.ack.eq(request)
+            with m.If(request & bus.we):
+                m.d.comb += wr.en.eq(bus.sel)
+        else:
+            incr = bus.cti == CTI_INCR_BURST
+
+            # Address the master moves to after this beat of a burst.
+            wrap = Array(Const(n - 1, 4) for n in [0, 4, 8, 16])[bus.bte]
+            wrapped = Cat((word[:4] & ~wrap) | ((word[:4] + 1) & wrap), word[4:])
+            next_word = Signal.like(word)
+            m.d.comb += next_word.eq(Mux(bus.bte == BTE_LINEAR, word + 1, wrapped))
+
+            with m.If(bus.ack & incr):
+                m.d.comb += rd.addr.eq(next_word)
+            with m.Else():
+                m.d.comb += rd.addr.eq(word)
+
+            m.d.sync += bus.ack.eq(request & ~(bus.ack & ~incr))
+            with m.If(request & bus.we & bus.ack):
+                m.d.comb += wr.en.eq(bus.sel)
+
+        return m
+
+class WishboneDualPortRAM(Elaboratable):
+    """
+        RAM with a read/write port on ``bus`` and a read only port on
+        ``ibus``, for code that is written through the data bus and fetched
+        through the instruction bus.
+    """
+    def __init__(self, depth):
+        self.depth = depth
+        self.bus = WishboneBus()
+        self.ibus = WishboneBus()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        backing = Memory(width=32, depth=self.depth)
+        m.submodules.rd = rd = backing.read_port()
+        m.submodules.ird = ird = backing.read_port()
+        m.submodules.wr = wr = backing.write_port(granularity=8)
 
         m.d.comb += wr.addr.eq(self.bus.addr >> 2)
         m.d.comb += rd.addr.eq(self.bus.addr >> 2)
@@ -58,7 +146,13 @@ class WishboneRAM(Elaboratable):
         m.d.comb += self.bus.r_dat.eq(rd.data)
 
         m.d.sync += self.bus.ack.eq(self.bus.cyc & ~self.bus.ack)
-        m.d.sync += wr.en.eq((self.bus.cyc & self.bus.we) & ~wr.en)
+        with m.If(self.bus.cyc & self.bus.we & ~self.bus.ack):
+            m.d.comb += wr.en.eq(self.bus.sel)
+
+        m.d.comb += ird.addr.eq(self.ibus.addr >> 2)
+        m.d.comb += self.ibus.r_dat.eq(ird.data)
+        m.d.sync += self.ibus.ack.eq(self.ibus.cyc & ~self.ibus.ack)
+
         return m
 
 class WishboneUART(Elaboratable):
@@ -68,18 +162,27 @@ class WishboneUART(Elaboratable):
     def __init__(self, divisor):
         self.uart = UART(divisor)
         self.bus = WishboneBus()
+        # A received byte is waiting.
+        self.irq = Signal()
 
     def elaborate(self, platform):
         m = Module()
         m.submodules.uart = self.uart
 
         m.d.sync += self.uart.tx_rdy.eq(0)
-        m.d.sync += self.uart.rx_ack.eq(0)
+
+        # The UART keeps rx_rdy up until the next start bit, so remember
+        # that the byte was read and keep acking until then.
+        rx_taken = Signal()
+        m.d.comb += self.uart.rx_ack.eq(rx_taken)
+        with m.If(~self.uart.rx_rdy):
+            m.d.sync += rx_taken.eq(0)
+        m.d.comb += self.irq.eq(self.uart.rx_rdy & ~rx_taken)
 
         with m.If(self.bus.cyc):
             addr_mask = 8 - 1
             with m.If((self.bus.addr & addr_mask) == 0):
-                m.d.sync += self.bus.r_dat.eq(Cat(self.uart.tx_ack, self.uart.rx_rdy, self.uart.rx_err))
+                m.d.sync += self.bus.r_dat.eq(Cat(self.uart.tx_ack, self.irq, self.uart.rx_err))
             with m.Elif((self.bus.addr & addr_mask) == 4):
                 with m.If(self.bus.we): # write
                     m.d.sync += [
@@ -89,7 +192,7 @@ class WishboneUART(Elaboratable):
                 with m.Else():
                     m.d.sync += [
                         self.bus.r_dat.eq(self.uart.rx_data),
-                        self.uart.rx_ack.eq(1)
+                        rx_taken.eq(1)
                     ]
 
         # drop ack on second cycle
@@ -98,26 +201,474 @@ class WishboneUART(Elaboratable):
         return m
 
 class Peripheral:
-    def __init__(self, dev, start, size):
+    def __init__(self, dev, start, size, bus=None):
         self.dev = dev
-        self.bus = dev.bus
+        # Devices with more than one port pick the one to decode.
+        self.bus = dev.bus if bus is None else bus
 
         self.addr = start
         self.size = size
 
 
+def decode_masks(decodes, width):
+    full = (1 << width) - 1
+    masks = [full & ~(d.size - 1) for d in decodes]
+
+    # Bits where two regions that both decode that bit disagree.
+    distinguishing = 0
+    for i, a in enumerate(decodes):
+        for j, b in enumerate(decodes[i+1:], i+1):
+            distinguishing |= masks[i] & masks[j] & (a.addr ^ b.addr)
+
+    return [(mask & distinguishing, d.addr & mask & distinguishing)
+            for mask, d in zip(masks, decodes)]
+
+
 class WishboneAddressDecoder(Elaboratable):
-    def __init__(self, decodes):
+    """
+        Regions must be power of two sized, aligned to their size and must
+        not overlap. Only the address bits that tell the regions apart are
+        compared, so unmapped addresses alias onto some region.
+
+        With ``registered``, the region select is registered before it
+        reaches the slaves, taking the decode off the critical path at the
+        cost of one cycle per access.
+    """
+    def __init__(self, decodes, registered=False):
         self.decodes = decodes
+        self.registered = registered
         self.bus = WishboneBus()
 
+    @staticmethod
+    def check(decodes):
+        for d in decodes:
+            if d.size <= 0 or d.size & (d.size - 1):
+                raise ValueError("Region at {:#x} has size {:#x}, which is not a power of two"
+                                 .format(d.addr, d.size))
+            if d.addr % d.size:
+                raise ValueError("Region at {:#x} is not aligned to its size {:#x}"
+                                 .format(d.addr, d.size))
+
+        for i, a in enumerate(decodes):
+            for b in decodes[i+1:]:
+                if a.addr < b.addr + b.size and b.addr < a.addr + a.size:
+                    raise ValueError("Regions at {:#x} and {:#x} overlap"
+                                     .format(a.addr, b.addr))
+
+    def decode_masks(self):
+        """ Returns ``(mask, value)`` per region: it is selected when
+        ``addr & mask == value``. """
+        return decode_masks(self.decodes, len(self.bus.addr))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        self.check(self.decodes)
+
+        bus = self.bus
+
+        match = Signal(len(self.decodes))
+        for i, (mask, value) in enumerate(self.decode_masks()):
+            m.d.comb += match[i].eq((bus.addr & mask) == value)
+
+        if self.registered:
+            select = Signal(len(self.decodes))
+            decoded = Signal()
+            # Bursts keep the slave selected until their last beat.
+            with m.If(~bus.cyc | (bus.ack & (bus.cti != CTI_INCR_BURST))):
+                m.d.sync += decoded.eq(0)
+            with m.Else():
+                m.d.sync += [
+                    decoded.eq(1),
+                    select.eq(match)
+                ]
+            cyc = bus.cyc & decoded
+            stb = bus.stb & decoded
+        else:
+            select = match
+            cyc = bus.cyc
+            stb = bus.stb
+
+        ack = 0
+        r_dat = 0
+        for i, d in enumerate(self.decodes):
+            m.d.comb += [
+                d.bus.cyc.eq(cyc & select[i]),
+                d.bus.stb.eq(stb & select[i]),
+                d.bus.sel.eq(bus.sel),
+                d.bus.we.eq(bus.we),
+                d.bus.addr.eq(bus.addr),
+                d.bus.w_dat.eq(bus.w_dat),
+                d.bus.cti.eq(bus.cti),
+                d.bus.bte.eq(bus.bte),
+            ]
+            ack = ack | (d.bus.ack & select[i])
+            r_dat = r_dat | Mux(select[i], d.bus.r_dat, 0)
+
+        m.d.comb += [
+            bus.ack.eq(ack),
+            bus.r_dat.eq(r_dat)
+        ]
+
+        return m
+
+
+class WishboneCrossbar(Elaboratable):
+    """
+        Connects ``masters`` buses to the regions in ``decodes``. Every
+        slave has its own arbiter, so masters working on different slaves
+        run at the same time.
+
+        A master keeps a slave for the whole transfer, or until the last
+        beat of an incrementing burst. Then the slave is arbitrated again,
+        either ``"round_robin"`` or ``"priority"`` (lower master index wins).
+        Masters waiting for a slave see ``stall``.
+    """
+    def __init__(self, masters, decodes, arbitration="round_robin"):
+        if arbitration not in ("round_robin", "priority"):
+            raise ValueError("Unknown arbitration {!r}".format(arbitration))
+        self.decodes = decodes
+        self.arbitration = arbitration
+        self.masters = [WishboneBus() for _ in range(masters)]
+
     def elaborate(self, platform):
         m = Module()
 
-        bus=self.bus
+        WishboneAddressDecoder.check(self.decodes)
+
+        masters = self.masters
+        n = len(masters)
+
+        # match[i][j]: master i addresses slave j
+        match = []
+        for i, bus in enumerate(masters):
+            match.append([])
+            for j, (mask, value) in enumerate(decode_masks(self.decodes, len(bus.addr))):
+                sig = Signal(name="match_m{}_s{}".format(i, j))
+                m.d.comb += sig.eq((bus.addr & mask) == value)
+                match[i].append(sig)
+
+        ack = [0] * n
+        stall = [0] * n
+        r_dat = [0] * n
+
+        for j, d in enumerate(self.decodes):
+            request = Signal(n, name="request_s{}".format(j))
+            m.d.comb += request.eq(Cat(bus.cyc & match[i][j] for i, bus in enumerate(masters)))
+
+            owner = Signal(range(n), name="owner_s{}".format(j))
+            locked = Signal(name="locked_s{}".format(j))
+            pick = Signal(range(n), name="pick_s{}".format(j))
+
+            # Later assignments win, so go from lowest to highest priority.
+            if self.arbitration == "priority":
+                for i in reversed(range(n)):
+                    with m.If(request[i]):
+                        m.d.comb += pick.eq(i)
+            else:
+                with m.Switch(owner):
+                    for last in range(n):
+                        with m.Case(last):
+                            order = [(last + k) % n for k in range(1, n + 1)]
+                            for i in reversed(order):
+                                with m.If(request[i]):
+                                    m.d.comb += pick.eq(i)
+
+            current = Signal(range(n), name="current_s{}".format(j))
+            m.d.comb += current.eq(Mux(locked, owner, pick))
+
+            granted = Signal(n, name="granted_s{}".format(j))
+            m.d.comb += granted.eq(request & (1 << current))
+
+            cti = Array(bus.cti for bus in masters)[current]
+            done = d.bus.ack & (cti != CTI_INCR_BURST)
+            # Idle cycles leave the owner alone, so round robin picks up
+            # after the last master served.
+            with m.If(granted.any() & ~locked):
+                m.d.sync += owner.eq(current)
+            m.d.sync += locked.eq(request.bit_select(current, 1) & ~done)
+
+            m.d.comb += [
+                d.bus.cyc.eq(granted.any()),
+                d.bus.stb.eq(granted.any() & Array(bus.stb for bus in masters)[current]),
+                d.bus.we.eq(Array(bus.we for bus in masters)[current]),
+                d.bus.sel.eq(Array(bus.sel for bus in masters)[current]),
+                d.bus.addr.eq(Array(bus.addr for bus in masters)[current]),
+                d.bus.w_dat.eq(Array(bus.w_dat for bus in masters)[current]),
+                d.bus.cti.eq(cti),
+                d.bus.bte.eq(Array(bus.bte for bus in masters)[current]),
+            ]
+
+            for i in range(n):
+                ack[i] = ack[i] | (d.bus.ack & granted[i])
+                stall[i] = stall[i] | (match[i][j] & (~granted[i] | d.bus.stall))
+                r_dat[i] = r_dat[i] | Mux(granted[i], d.bus.r_dat, 0)
+
+        for i, bus in enumerate(masters):
+            m.d.comb += [
+                bus.ack.eq(ack[i]),
+                bus.stall.eq(bus.cyc & stall[i]),
+                bus.r_dat.eq(r_dat[i]),
+            ]
+
+        return m
+
+@sim_test(registered=[False, True])
+def sim_decoder(registered):
+    from nmigen.back.pysim import Simulator
+
+    low = WishboneRAM(init=[0x11111111, 0x22222222])
+    high = WishboneRAM(init=[0x33333333, 0x44444444])
+    decoder = WishboneAddressDecoder([
+        Peripheral(low, 0x0000, 0x100),
+        Peripheral(high, 0x1000, 0x100),
+    ], registered=registered)
+    assert decoder.decode_masks() == [(0x1000, 0x0000), (0x1000, 0x1000)]
+
+    m = Module()
+    m.submodules += [low, high, decoder]
+    bus = decoder.bus
+
+    def access(addr, we=0, data=0):
+        yield bus.addr.eq(addr)
+        yield bus.we.eq(we)
+        yield bus.sel.eq(0b1111)
+        yield bus.w_dat.eq(data)
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        for _ in range(8):
+            yield
+            if (yield bus.ack):
+                break
+        else:
+            assert False, "no ack for {:#x}".format(addr)
+        result = yield bus.r_dat
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield
+        return result
+
+    def proc():
+        assert (yield from access(0x0004)) == 0x22222222
+        assert (yield from access(0x1000)) == 0x33333333
+        yield from access(0x1004, we=1, data=0xcafef00d)
+        assert (yield from access(0x1004)) == 0xcafef00d
+        assert (yield from access(0x0004)) == 0x22222222
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+    for bad in ([Peripheral(low, 0, 0x300)], [Peripheral(low, 0x80, 0x100)],
+                [Peripheral(low, 0, 0x100), Peripheral(high, 0, 0x10)]):
+        try:
+            WishboneAddressDecoder.check(bad)
+        except ValueError:
+            continue
+        assert False, "accepted bad map"
+
+
+@sim_test(pipelined=[False, True])
+def sim_ram(pipelined):
+    from nmigen.back.pysim import Simulator
+
+    ram = WishboneRAM(init=list(range(0x100, 0x110)), pipelined=pipelined)
+    bus = ram.bus
+
+    def classic_burst(start, count, bte=BTE_LINEAR, we=0, data=None):
+        """ Incrementing burst, returns the read data and the cycle count. """
+        words = []
+        addr = start
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        yield bus.we.eq(we)
+        yield bus.sel.eq(0b1111)
+        yield bus.bte.eq(bte)
+        cycles = 0
+        while len(words) < count:
+            last = len(words) == count - 1
+            yield bus.addr.eq(addr << 2)
+            yield bus.cti.eq(CTI_END_OF_BURST if last else CTI_INCR_BURST)
+            if data is not None:
+                yield bus.w_dat.eq(data[len(words)])
+            yield
+            cycles += 1
+            if (yield bus.ack):
+                words.append((yield bus.r_dat))
+                wrap = [0, 4, 8, 16][bte]
+                addr = (addr & ~(wrap - 1)) | ((addr + 1) & (wrap - 1)) if wrap else addr + 1
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield
+        return words, cycles
+
+    def pipelined_reads(addrs):
+        words = []
+        yield bus.cyc.eq(1)
+        yield bus.we.eq(0)
+        cycles = 0
+        pending = list(addrs)
+        while len(words) < len(addrs):
+            yield bus.stb.eq(bool(pending))
+            if pending:
+                yield bus.addr.eq(pending.pop(0) << 2)
+            yield
+            cycles += 1
+            if (yield bus.ack):
+                words.append((yield bus.r_dat))
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield
+        return words, cycles
+
+    def write_byte(addr, sel, value):
+        yield bus.cyc.eq(1)
+        yield bus.stb.eq(1)
+        yield bus.we.eq(1)
+        yield bus.sel.eq(sel)
+        yield bus.cti.eq(CTI_CLASSIC)
+        yield bus.addr.eq(addr)
+        yield bus.w_dat.eq(value)
+        yield
+        if not pipelined:
+            while not (yield bus.ack):
+                yield
+        yield bus.cyc.eq(0)
+        yield bus.stb.eq(0)
+        yield bus.we.eq(0)
+        yield
+
+    def proc():
+        yield from write_byte(0x4, 0b0010, 0xaaaaaaaa)
+        if pipelined:
+            words, cycles = yield from pipelined_reads([0, 1, 2, 3, 4, 5, 6, 7])
+            assert words == [0x100, 0xaa01, 0x102, 0x103, 0x104, 0x105, 0x106, 0x107], words
+            # One word per cycle after the first.
+            assert cycles == 9, cycles
+        else:
+            words, cycles = yield from classic_burst(0, 8)
+            assert words == [0x100, 0xaa01, 0x102, 0x103, 0x104, 0x105, 0x106, 0x107], words
+            assert cycles == 9, cycles
+
+            words, _ = yield from classic_burst(6, 4, bte=BTE_WRAP_4)
+            assert words == [0x106, 0x107, 0x104, 0x105], words
+
+            yield from classic_burst(8, 3, we=1, data=[1, 2, 3])
+            words, _ = yield from classic_burst(7, 5)
+            assert words == [0x107, 1, 2, 3, 0x10b], words
+
+    sim = Simulator(ram)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(proc)
+    sim.run()
+
+
+@sim_test(arbitration=["round_robin", "priority"])
+def sim_crossbar(arbitration):
+    from nmigen.back.pysim import Simulator
+
+    def run(bases):
+        """ Each master reads 8 words from its base, returns the data and
+        the cycle each read was acked on, per master. """
+        low = WishboneRAM(init=list(range(0x00, 0x10)))
+        high = WishboneRAM(init=list(range(0x10, 0x20)))
+        xbar = WishboneCrossbar(len(bases), [
+            Peripheral(low, 0x0000, 0x100),
+            Peripheral(high, 0x1000, 0x100),
+        ], arbitration=arbitration)
+
+        m = Module()
+        m.submodules += [low, high, xbar]
+
+        logs = [[] for _ in bases]
+
+        def reader(bus, base, log):
+            def proc():
+                cycle = 0
+                for k in range(8):
+                    yield bus.addr.eq(base + k * 4)
+                    yield bus.cyc.eq(1)
+                    yield bus.stb.eq(1)
+                    yield
+                    cycle += 1
+                    while not (yield bus.ack):
+                        yield
+                        cycle += 1
+                    log.append(((yield bus.r_dat), cycle))
+                    yield bus.cyc.eq(0)
+                    yield bus.stb.eq(0)
+                    yield
+                    cycle += 1
+            return proc
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        for bus, base, log in zip(xbar.masters, bases, logs):
+            sim.add_sync_process(reader(bus, base, log))
+        sim.run()
+
+        for log, base in zip(logs, bases):
+            first = base >> 8
+            assert [v for v, _ in log] == list(range(first, first + 8)), log
+        return [[c for _, c in log] for log in logs]
+
+    def run_rounds(rounds):
+        """ Master i reads the same slave at the start of every 8 cycles
+        for which it is in ``rounds``, returns the cycle each read was
+        acked on, per master and round. """
+        ram = WishboneRAM(init=list(range(0x10)))
+        xbar = WishboneCrossbar(2, [Peripheral(ram, 0x0000, 0x100)], arbitration=arbitration)
+
+        m = Module()
+        m.submodules += [ram, xbar]
+
+        logs = [{}, {}]
+
+        def reader(i, bus, log):
+            def proc():
+                cycle = 0
+                for k, masters in enumerate(rounds):
+                    if i not in masters:
+                        continue
+                    while cycle < k * 8:
+                        yield
+                        cycle += 1
+                    yield bus.cyc.eq(1)
+                    yield bus.stb.eq(1)
+                    yield
+                    cycle += 1
+                    while not (yield bus.ack):
+                        yield
+                        cycle += 1
+                    log[k] = cycle
+                    yield bus.cyc.eq(0)
+                    yield bus.stb.eq(0)
+            return proc
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        for i, (bus, log) in enumerate(zip(xbar.masters, logs)):
+            sim.add_sync_process(reader(i, bus, log))
+        sim.run()
+        return logs
 
-        for d in self.decodes:
-            with m.If((bus.addr >= Const(d.addr)) & (bus.addr < Const(d.addr + d.size))):
-                m.d.comb += self.bus.connect_to(d.bus)
+    alone, = run([0x0000])
+    # Different slaves run concurrently at full speed.
+    assert run([0x0000, 0x1000]) == [alone, alone]
 
-        return m
\ No newline at end of file
+    # Same slave: transfers interleave, both finish in about the time of
+    # running one after the other.
+    first, second = run([0x1000, 0x1000])
+    assert max(first[-1], second[-1]) <= 2 * alone[-1]
+    owners = [i for _, i in sorted([(c, 0) for c in first] + [(c, 1) for c in second])]
+    assert all(a != b for a, b in zip(owners, owners[1:])), owners
+    if arbitration == "priority":
+        # Master 0 wins when both ask at once.
+        assert first[0] < second[0]
+    else:
+        # After one master alone and an idle gap, the other one wins when
+        # both ask at once.
+        first, second = run_rounds([{1}, {0, 1}, {0}, {0, 1}])
+        assert first[1] < second[1]
+        assert second[3] < first[3]